@@ -3,23 +3,35 @@
 # Flask API Backend for E2E Encrypted Messenger Web UI
 # OPTIONAL - Only needed if you want to connect the React UI to Python backend
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-import sys
-import os
+import threading
+import time
 
 # Import your modules
 from auth import (
-    setup, hash_password, Verify_password, gen_keypair,
+    setup, hash_password, Verify_password, take_keypair, keypair_pool,
     serialize_public_key, save_private_key, Load_private_key,
-    load_user, save_user, load_all_users
+    load_user, save_user, user_exists, auth_executor
 )
-from encryption import encrypt_message, decrypt_message, EncryptionError, DecryptionError
+from cpu_executor import ExecutorOverloaded
+from encryption import encrypt_message, encrypt_message_multi, EncryptionError
 from message_storage import (
-    setup_messages, save_message, get_messages_for_user,
+    setup_messages, save_message, save_messages,
     get_user_public_key, get_all_users
 )
+from message_bus import message_bus
+from profiling import PROFILE_HEADER, PROFILE_PARAM, profile_requested, request_profiler
+from retention import compaction_worker
+from user_directory import get_user_directory
+from api_common import (
+    optional_int, health_status, metrics_text, new_session_token, new_session, new_session_store,
+    clean_recipients, message_package, read_inbox, stream_inbox, METRICS_CONTENT_TYPE,
+    SSE_HEADERS, SSE_KEEPALIVE, sse_event, stream_start_cursor, longpoll_timeout,
+    stream_session_token, stream_tickets
+)
 from datetime import datetime
+import config
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for React frontend
@@ -27,17 +39,85 @@ CORS(app)  # Enable CORS for React frontend
 # Initialize
 setup()
 setup_messages()
+get_user_directory()  # Build the user index once at startup
+
+# Logged-in sessions by token, with expiry (see sessions.py)
+active_sessions = new_session_store()
+
+# Background helpers are started lazily by the first request, so they
+# always run in the process that serves requests
+_background_started = False
+_background_lock = threading.Lock()
+
+def start_background_services():
+    """Start background helper threads (safe to call more than once)"""
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        keypair_pool.start()
+        compaction_worker.start()  # Only if E2E_COMPACTION_INTERVAL_SECONDS is set
+        active_sessions.start()
+        _background_started = True
+
+@app.before_request
+def _ensure_background_services():
+    if not _background_started:
+        start_background_services()
 
-# Store active sessions (in production, use proper session management)
-active_sessions = {}
+# Opt-in profiling of single requests (see profiling.py)
+@app.before_request
+def _start_profile():
+    if not config.PROFILING_ENABLED:
+        return
+    # The profiler needs to know what else is running (see profiling.py)
+    request_profiler.request_started()
+    g.profile_counted = True
+    if profile_requested(request.headers.get(PROFILE_HEADER), request.args.get(PROFILE_PARAM)):
+        g.profiler = request_profiler.start()
+        g.profile_busy = g.profiler is None
+
+@app.after_request
+def _finish_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        name = request_profiler.ring.new_name(f"{request.method} {request.path}")
+        response.headers['X-Profile-File'] = name
+        # Once the body has been sent, so streamed responses are profiled to the end
+        response.call_on_close(lambda: request_profiler.finish(profiler, name))
+    elif g.pop('profile_busy', False):
+        response.headers['X-Profile-File'] = 'busy'
+    return response
+
+@app.teardown_request
+def _drop_profile(exc):
+    if g.pop('profile_counted', False):
+        request_profiler.request_finished()
+    # Only if _finish_profile never ran; the profiler must not stay enabled
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        request_profiler.finish(profiler, request_profiler.ring.new_name(f"{request.method} {request.path}"))
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
-        'status': 'ok',
-        'message': 'E2E Messenger API is running'
-    })
+    return jsonify(health_status(active_sessions))
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Timers and counters in the Prometheus text format"""
+    text = metrics_text()
+    if text is None:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return Response(text, content_type=METRICS_CONTENT_TYPE)
+
+@app.errorhandler(ExecutorOverloaded)
+def overloaded(e):
+    """Fast reject when too many password checks are already queued"""
+    response = jsonify({'error': 'Server busy, please retry shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
 
 @app.route('/api/signup', methods=['POST'])
 def signup():
@@ -55,13 +135,12 @@ def signup():
             return jsonify({'error': 'Password must be at least 8 characters'}), 400
         
         # Check if user exists
-        all_users = load_all_users()
-        if username in all_users:
+        if user_exists(username):
             return jsonify({'error': 'Username already taken'}), 400
         
         # Create user
-        password_hash, salt = hash_password(password)
-        private_key, public_key = gen_keypair()
+        password_hash, salt = auth_executor.run(hash_password, password)
+        private_key, public_key = take_keypair()
         public_key_pem = serialize_public_key(public_key)
         
         # Save user data
@@ -71,8 +150,9 @@ def signup():
             "salt": salt,
             "public_key": public_key_pem
         }
+        # Key first, so the account never becomes visible without one
+        auth_executor.run(save_private_key, username, private_key, password)
         save_user(username, user_data)
-        save_private_key(username, private_key, password)
         
         return jsonify({
             'success': True,
@@ -80,6 +160,8 @@ def signup():
             'username': username
         })
         
+    except ExecutorOverloaded:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -95,8 +177,7 @@ def login():
             return jsonify({'error': 'Username and password required'}), 400
         
         # Load user
-        all_users = load_all_users()
-        if username not in all_users:
+        if not user_exists(username):
             return jsonify({'error': 'Invalid username or password'}), 401
         
         user_data = load_user(username)
@@ -104,22 +185,20 @@ def login():
             return jsonify({'error': 'Invalid username or password'}), 401
         
         # Verify password
-        if not Verify_password(password, user_data['password_hash'], user_data['salt']):
+        if not auth_executor.run(Verify_password, password, user_data['password_hash'], user_data['salt']):
             return jsonify({'error': 'Invalid username or password'}), 401
         
         # Load private key
         try:
-            private_key = Load_private_key(username, password)
+            private_key = auth_executor.run(Load_private_key, username, password)
+        except ExecutorOverloaded:
+            raise
         except Exception:
             return jsonify({'error': 'Failed to load encryption keys'}), 500
         
-        # Create session token (in production, use proper JWT or session tokens)
-        session_token = os.urandom(32).hex()
-        active_sessions[session_token] = {
-            'username': username,
-            'private_key': private_key,
-            'public_key': user_data['public_key']
-        }
+        # Create session
+        session_token = new_session_token()
+        active_sessions.add(session_token, new_session(username, private_key, user_data['public_key']))
         
         return jsonify({
             'success': True,
@@ -128,6 +207,8 @@ def login():
             'session_token': session_token
         })
         
+    except ExecutorOverloaded:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -138,8 +219,7 @@ def logout():
         data = request.json
         session_token = data.get('session_token')
         
-        if session_token in active_sessions:
-            del active_sessions[session_token]
+        active_sessions.remove(session_token)
         
         return jsonify({
             'success': True,
@@ -159,11 +239,10 @@ def send_message():
         message_text = data.get('message', '').strip()
         
         # Verify session
-        if session_token not in active_sessions:
+        session = active_sessions.get(session_token)
+        if session is None:
             return jsonify({'error': 'Not authenticated'}), 401
         
-        session = active_sessions[session_token]
-        
         if not recipient or not message_text:
             return jsonify({'error': 'Recipient and message required'}), 400
         
@@ -174,21 +253,12 @@ def send_message():
         
         # Encrypt message
         try:
-            encrypted_data = encrypt_message(message_text, recipient_public_key)
+            encrypted_data = encrypt_message(message_text, recipient_public_key, recipient, session['username'])
         except EncryptionError as e:
             return jsonify({'error': 'Encryption failed'}), 500
         
         # Save message
-        message_package = {
-            'from_user': session['username'],
-            'to_user': recipient,
-            'encrypted_message': encrypted_data['encrypted_message'],
-            'encrypted_key': encrypted_data['encrypted_key'],
-            'nonce': encrypted_data['nonce'],
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        save_message(message_package)
+        save_message(message_package(session['username'], recipient, encrypted_data))
         
         return jsonify({
             'success': True,
@@ -198,64 +268,230 @@ def send_message():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/send_bulk', methods=['POST'])
+def send_bulk():
+    """
+    Send one message to many recipients.
+
+    The message is encrypted once and only the AES key is wrapped per
+    recipient. Unknown recipients are skipped and listed in 'not_found'.
+    """
+    try:
+        data = request.json
+        session_token = data.get('session_token')
+        recipients = data.get('recipients')
+        message_text = data.get('message', '').strip()
+        
+        # Verify session
+        session = active_sessions.get(session_token)
+        if session is None:
+            return jsonify({'error': 'Not authenticated'}), 401
+        
+        # Drop blanks and duplicates, keep order
+        try:
+            recipients = clean_recipients(recipients)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not message_text:
+            return jsonify({'error': 'Recipients (a list) and message required'}), 400
+        
+        # Get recipients' public keys
+        found, public_keys, not_found = [], [], []
+        for recipient in recipients:
+            public_key = get_user_public_key(recipient)
+            if public_key:
+                found.append(recipient)
+                public_keys.append(public_key)
+            else:
+                not_found.append(recipient)
+        
+        if not found:
+            return jsonify({'error': 'None of the recipients were found', 'not_found': not_found}), 404
+        
+        # Encrypt once for everyone
+        try:
+            encrypted_data = encrypt_message_multi(message_text, public_keys, found)
+        except EncryptionError:
+            return jsonify({'error': 'Encryption failed'}), 500
+        
+        # Save messages (one write per recipient inbox)
+        timestamp = datetime.now().isoformat()
+        save_messages([
+            message_package(session['username'], recipient, encrypted, timestamp)
+            for recipient, encrypted in zip(found, encrypted_data)
+        ])
+        
+        return jsonify({
+            'success': True,
+            'message': f'Message sent to {len(found)} recipient(s)',
+            'sent': found,
+            'not_found': not_found
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/inbox', methods=['POST'])
 def get_inbox():
-    """Get user's inbox with decrypted messages"""
+    """
+    Get user's inbox with decrypted messages.
+
+    Optional body fields:
+        cursor: next_cursor from a previous response - only newer messages are returned
+        limit: maximum number of messages to return
+
+    Without a limit the response is streamed (chunked): each message is
+    written as soon as it is decrypted, so big inboxes start arriving
+    straight away. The JSON is the same either way.
+    """
     try:
         data = request.json
         session_token = data.get('session_token')
         
         # Verify session
-        if session_token not in active_sessions:
+        session = active_sessions.get(session_token)
+        if session is None:
             return jsonify({'error': 'Not authenticated'}), 401
         
-        session = active_sessions[session_token]
-        
-        # Get messages
-        messages = get_messages_for_user(session['username'])
-        
-        # Decrypt messages
-        decrypted_messages = []
-        for msg in messages:
-            try:
-                encrypted_content = {
-                    'encrypted_message': msg['encrypted_message'],
-                    'encrypted_key': msg['encrypted_key'],
-                    'nonce': msg['nonce']
-                }
-                
-                decrypted_text = decrypt_message(encrypted_content, session['private_key'])
-                
-                decrypted_messages.append({
-                    'id': len(decrypted_messages) + 1,
-                    'from': msg.get('from_user', 'Unknown'),
-                    'message': decrypted_text,
-                    'timestamp': msg.get('timestamp', ''),
-                    'decrypted': True
-                })
-            except DecryptionError:
-                # Skip messages that can't be decrypted
-                decrypted_messages.append({
-                    'id': len(decrypted_messages) + 1,
-                    'from': msg.get('from_user', 'Unknown'),
-                    'message': '[Unable to decrypt message]',
-                    'timestamp': msg.get('timestamp', ''),
-                    'decrypted': False
-                })
+        # Get and decrypt messages
+        try:
+            cursor = optional_int(data, 'cursor')
+            limit = optional_int(data, 'limit')
+            if limit is None:
+                return Response(stream_inbox(session, cursor), mimetype='application/json')
+            decrypted_messages, next_cursor = read_inbox(session, cursor, limit)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         return jsonify({
             'success': True,
-            'messages': decrypted_messages
+            'messages': decrypted_messages,
+            'next_cursor': next_cursor
         })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/stream_ticket', methods=['POST'])
+def stream_ticket():
+    """
+    A short-lived ticket that opens /api/stream (GET ?ticket=...) for
+    this session, so EventSource URLs don't carry the session token.
+    """
+    try:
+        data = request.json
+        session_token = data.get('session_token')
+        
+        # Verify session
+        if active_sessions.get(session_token) is None:
+            return jsonify({'error': 'Not authenticated'}), 401
+        
+        return jsonify({
+            'success': True,
+            'stream_ticket': stream_tickets.issue(session_token),
+            'expires_in': stream_tickets.ttl
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/stream', methods=['GET', 'POST'])
+def stream():
+    """
+    Push new messages to the client as they arrive, already decrypted.
+
+    Default: a Server-Sent Events stream (GET, works with EventSource).
+    Each 'messages' event carries {messages, next_cursor}; its event id
+    is the cursor, so a reconnecting EventSource resumes where it was.
+
+    mode=poll: long-poll fallback - answers like /api/inbox as soon as
+    there is something new, or with an empty list after `timeout` seconds.
+
+    Fields (query string or JSON body): cursor (default: only messages
+    arriving from now on), mode, timeout. Authentication: session_token
+    in a POST body, or for GET a ticket from /api/stream_ticket
+    (?ticket=...); the session token itself is refused in the URL.
+    """
+    try:
+        query = request.args.to_dict()
+        body = request.get_json(silent=True) if request.method == 'POST' else None
+        if not isinstance(body, dict):
+            body = {}
+        params = dict(query, **body)
+
+        # Verify session
+        try:
+            session_token = stream_session_token(query, body)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        session = active_sessions.get(session_token)
+        if session is None:
+            return jsonify({'error': 'Not authenticated'}), 401
+
+        try:
+            cursor = stream_start_cursor(session['username'], params, request.headers.get('Last-Event-ID'))
+            timeout = longpoll_timeout(params)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if params.get('mode') == 'poll':
+            return _long_poll(session, cursor, timeout)
+
+        return Response(_event_stream(session_token, session, cursor),
+                        mimetype='text/event-stream', headers=SSE_HEADERS)
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def _long_poll(session, cursor, timeout):
+    deadline = time.monotonic() + timeout
+    # Subscribe before reading, so a message saved in between still wakes us
+    with message_bus.subscribe(session['username']) as subscription:
+        while True:
+            entries, cursor = read_inbox(session, cursor, config.STREAM_BATCH_LIMIT)
+            remaining = deadline - time.monotonic()
+            if entries or remaining <= 0:
+                return jsonify({
+                    'success': True,
+                    'messages': entries,
+                    'next_cursor': cursor
+                })
+            # Also re-check now and then for messages saved by other processes
+            subscription.wait(min(remaining, config.STREAM_HEARTBEAT_SECONDS))
+
+def _event_stream(session_token, session, cursor):
+    with message_bus.subscribe(session['username']) as subscription:
+        yield SSE_KEEPALIVE  # Gets the response headers out straight away
+        while active_sessions.get(session_token) is session:
+            entries, cursor = read_inbox(session, cursor, config.STREAM_BATCH_LIMIT)
+            if entries:
+                yield sse_event('messages', {'messages': entries, 'next_cursor': cursor}, cursor)
+                continue  # A full batch may have more behind it
+            if not subscription.wait(config.STREAM_HEARTBEAT_SECONDS):
+                yield SSE_KEEPALIVE
+
+        # Session ended (logout) - tell the client not to reconnect
+        yield sse_event('logout', {'error': 'Not authenticated'})
+
 @app.route('/api/users', methods=['GET'])
 def list_users():
-    """Get list of all users"""
+    """
+    Get list of all users.
+
+    Optional query parameters:
+        prefix: only usernames starting with this
+        limit: maximum number of usernames to return
+    """
     try:
-        users = get_all_users()
+        prefix = request.args.get('prefix', '')
+        try:
+            limit = optional_int(request.args, 'limit')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if limit is not None and limit < 1:
+            return jsonify({'error': 'limit must be a positive integer'}), 400
+
+        users = get_all_users(prefix, limit)
         return jsonify({
             'success': True,
             'users': users
@@ -274,9 +510,14 @@ if __name__ == '__main__':
     print("  POST /api/login     - Login")
     print("  POST /api/logout    - Logout")
     print("  POST /api/send      - Send message")
+    print("  POST /api/send_bulk - Send one message to many users")
     print("  POST /api/inbox     - Get inbox")
+    print("  POST /api/stream_ticket - Ticket for opening /api/stream with EventSource")
+    print("  GET  /api/stream    - New messages as they arrive (SSE / long-poll)")
     print("  GET  /api/users     - List users")
     print("  GET  /api/health    - Health check")
+    print("  GET  /api/metrics   - Prometheus metrics")
+    print("\nOne process only; to use every core run: python serve.py")
     print("\nPress Ctrl+C to stop")
     print("="*60 + "\n")
     
@@ -0,0 +1,317 @@
+# api_common.py
+# E2E Encrypted Messenger - Pieces Shared by the HTTP APIs
+#
+# api.py (Flask) and asgi_api.py (asyncio) expose the same endpoints;
+# the request parsing and response shaping they have in common lives
+# here so the two can't drift apart.
+
+import json
+import os
+from datetime import datetime
+
+import config
+from auth import keypair_pool, auth_executor
+from encryption import DecryptionError, SessionKeyCache, public_key_cache, conversation_keys
+from message_bus import message_bus
+from message_storage import (
+    durability_status, get_inbox_cursor, get_messages_page, iter_inbox, mark_messages_read, group_committer
+)
+from decryption_pool import decrypt_messages, iter_decrypted_batches
+import metrics
+from retention import compaction_worker
+from sessions import DecryptedMessageCache, StreamTickets, create_session_store
+from storage import get_storage
+
+
+def optional_int(data, key):
+    """Read an optional integer field from a JSON body or query (ints or digit strings)"""
+    value = data.get(key)
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f'{key} must be an integer')
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{key} must be an integer')
+
+
+def health_status(sessions=None):
+    """Body of /api/health (`sessions`: the server's SessionStore)"""
+    status = {
+        'status': 'ok',
+        'message': 'E2E Messenger API is running',
+        'storage_backend': get_storage().name,
+        'public_key_cache': public_key_cache.stats(),
+        'conversation_keys': conversation_keys.stats(),
+        'keypair_pool': keypair_pool.stats(),
+        'auth_executor': auth_executor.stats(),
+        'message_bus': message_bus.stats(),
+        'durability': durability_status(),
+        'group_commit': group_committer.stats(),
+        'compaction': compaction_worker.stats()
+    }
+    if sessions is not None:
+        status['sessions'] = sessions.stats()
+    return status
+
+
+# /api/metrics is in the Prometheus text exposition format
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def metrics_text():
+    """Body of /api/metrics, or None when metrics are switched off (E2E_METRICS=0)"""
+    if not metrics.ENABLED:
+        return None
+    return metrics.render_prometheus()
+
+
+def new_session_token():
+    # Create session token (in production, use proper JWT or session tokens)
+    return os.urandom(32).hex()
+
+
+def new_session(username, private_key, public_key):
+    """Session state kept for a logged-in user"""
+    return {
+        'username': username,
+        'private_key': private_key,
+        'public_key': public_key,
+        'decrypted_cache': DecryptedMessageCache(),
+        'session_keys': SessionKeyCache()
+    }
+
+
+def new_session_store():
+    """The login session store for an API server (see sessions.py)"""
+    return create_session_store(new_session, end_session)
+
+
+def end_session(session):
+    """Wipe per-session secrets when a session is dropped"""
+    if session is not None:
+        # Don't leave decrypted plaintexts around after logout
+        session['decrypted_cache'].clear()
+        session['session_keys'].clear()
+        # Wake the session's open streams so they notice it has ended
+        message_bus.publish(session['username'])
+
+
+def clean_recipients(recipients):
+    """
+    Validate the recipients list of a bulk send.
+
+    Returns:
+        list: Recipients with blanks and duplicates dropped, order kept
+
+    Raises:
+        ValueError: With a message suitable for a 400 response
+    """
+    if not isinstance(recipients, list) or not recipients:
+        raise ValueError('Recipients (a list) and message required')
+
+    recipients = list(dict.fromkeys(
+        r.strip() for r in recipients if isinstance(r, str) and r.strip()
+    ))
+    if not recipients:
+        raise ValueError('Recipients (a list) and message required')
+    if len(recipients) > config.MAX_BULK_RECIPIENTS:
+        raise ValueError(f'At most {config.MAX_BULK_RECIPIENTS} recipients per request')
+    return recipients
+
+
+def message_package(from_user, to_user, encrypted_data, timestamp=None):
+    """Build the stored form of an encrypted message"""
+    package = {
+        'from_user': from_user,
+        'to_user': to_user,
+        'encrypted_message': encrypted_data['encrypted_message'],
+        'encrypted_key': encrypted_data['encrypted_key'],
+        'nonce': encrypted_data['nonce'],
+        'timestamp': timestamp or datetime.now().isoformat()
+    }
+    if 'key_id' in encrypted_data:
+        package['key_id'] = encrypted_data['key_id']
+    return package
+
+
+def inbox_entry(msg, decrypted_text, message_number):
+    """Shape one decrypted (or undecryptable) message for an inbox response"""
+    if isinstance(decrypted_text, DecryptionError):
+        # Keep messages that can't be decrypted, flagged
+        return {
+            'id': message_number,
+            'from': msg.get('from_user', 'Unknown'),
+            'message': '[Unable to decrypt message]',
+            'timestamp': msg.get('timestamp', ''),
+            'decrypted': False
+        }
+    return {
+        'id': message_number,
+        'from': msg.get('from_user', 'Unknown'),
+        'message': decrypted_text,
+        'timestamp': msg.get('timestamp', ''),
+        'decrypted': True
+    }
+
+
+def inbox_entries(messages, results, next_cursor):
+    """
+    Pair stored messages with their decryption results.
+    Message ids are inbox sequence numbers + 1, so they stay stable across pages.
+    """
+    first_id = next_cursor - len(messages) + 1
+    return [
+        inbox_entry(msg, decrypted_text, first_id + i)
+        for i, (msg, decrypted_text) in enumerate(zip(messages, results))
+    ]
+
+
+def read_inbox(session, cursor=None, limit=None):
+    """
+    Read and decrypt a page of the session user's inbox.
+
+    Returns:
+        tuple: (inbox entries, next cursor)
+
+    Raises:
+        ValueError: For an invalid cursor / limit
+    """
+    messages, next_cursor = get_messages_page(session['username'], cursor, limit)
+    # Decrypt messages (cached per session, in parallel for large inboxes)
+    results = decrypt_messages(messages, session['private_key'], session['decrypted_cache'], session['session_keys'])
+    if messages:
+        mark_messages_read(session['username'], next_cursor)
+    return inbox_entries(messages, results, next_cursor), next_cursor
+
+
+def stream_inbox(session, cursor=None):
+    """
+    The whole /api/inbox response body (from `cursor` on) as a generator
+    of JSON text chunks: messages are sent as soon as they are decrypted
+    instead of after the last one. The body is the same JSON object a
+    buffered response has, with next_cursor at the end.
+
+    An error after the first chunk can only cut the response short, so
+    the client sees invalid JSON rather than a partial inbox.
+
+    Raises:
+        ValueError: For an invalid cursor (before anything is sent)
+    """
+    records = iter_inbox(session['username'], cursor)
+    return _inbox_json_chunks(session, records, cursor)
+
+
+# Where a streamed inbox response spends its time: reading and
+# decrypting each batch of messages vs. encoding it as JSON
+_inbox_phase = metrics.timer("e2e_inbox_response_phase_seconds", "Time spent in each step of a streamed /api/inbox", label="phase")
+_READ_DECRYPT = _inbox_phase.labels("read_decrypt")
+_ENCODE = _inbox_phase.labels("json_encode")
+
+
+def _inbox_json_chunks(session, records, cursor):
+    yield '{"success": true, "messages": ['
+    separator = ''
+    next_cursor = None
+    batches = iter_decrypted_batches(records, session['private_key'],
+                                     session['decrypted_cache'], session['session_keys'])
+    while True:
+        with _READ_DECRYPT.time():
+            batch = next(batches, None)
+        if batch is None:
+            break
+        with _ENCODE.time():
+            parts = []
+            for seq, msg, decrypted_text in batch:
+                parts.append(separator + json.dumps(inbox_entry(msg, decrypted_text, seq + 1)))
+                separator = ', '
+                next_cursor = seq + 1
+            chunk = ''.join(parts)
+        yield chunk
+    if next_cursor is None:
+        # Nothing new: same answer as a buffered read (a cursor past the end is clamped)
+        _, next_cursor = get_messages_page(session['username'], cursor, 1)
+    else:
+        mark_messages_read(session['username'], next_cursor)
+    yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+
+
+# ============================================
+# STREAMING (/api/stream)
+# ============================================
+
+# Keep proxies from buffering or caching the event stream
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+
+
+# Tickets that open a stream without the session token in the URL
+stream_tickets = StreamTickets()
+
+
+def stream_session_token(query, body):
+    """
+    The session token of a /api/stream request: from the JSON body, or
+    from a stream ticket (?ticket=...) for GET requests.
+
+    Args:
+        query (dict): Query string parameters
+        body (dict): JSON body (empty for GET)
+
+    Returns:
+        str: The session token, or None if none (or an expired ticket) was given
+
+    Raises:
+        ValueError: If the session token itself is in the query string
+    """
+    if 'session_token' in query:
+        # It would be written to access logs, proxy logs and browser history
+        raise ValueError('Send session_token in a POST body, or use a stream ticket (POST /api/stream_ticket)')
+    if body.get('session_token'):
+        return body['session_token']
+    return stream_tickets.redeem(query.get('ticket'))
+
+
+def stream_start_cursor(username, params, last_event_id=None):
+    """
+    Where a stream starts: the Last-Event-ID of a reconnecting
+    EventSource, else the client's cursor, else the end of the inbox
+    (only messages arriving from now on).
+
+    Raises:
+        ValueError: With a message suitable for a 400 response
+    """
+    if last_event_id:
+        cursor = optional_int({'last_event_id': last_event_id}, 'last_event_id')
+    else:
+        cursor = optional_int(params, 'cursor')
+    if cursor is None:
+        return get_inbox_cursor(username)
+    if cursor < 0:
+        raise ValueError('cursor must be a non-negative integer')
+    return cursor
+
+
+def longpoll_timeout(params):
+    """Seconds a long-poll request may wait (client may ask for less)"""
+    timeout = optional_int(params, 'timeout')
+    if timeout is None:
+        return config.STREAM_LONGPOLL_SECONDS
+    return max(0, min(timeout, config.STREAM_LONGPOLL_SECONDS))
+
+
+def sse_event(event, data, event_id=None):
+    """Format one Server-Sent Event"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data))
+    return '\n'.join(lines) + '\n\n'
+
+
+# Comment line: keeps idle connections open through proxies
+SSE_KEEPALIVE = ': keep-alive\n\n'
@@ -0,0 +1,803 @@
+#!/usr/bin/env python3
+# asgi_api.py
+# Asyncio (ASGI) API Backend for E2E Encrypted Messenger
+#
+# Same endpoints and JSON as api.py, but asyncio-native, so one process
+# can hold thousands of idle polling clients. Nothing blocking runs on
+# the event loop:
+#   - storage calls go through async_storage (I/O thread pool)
+#   - password hashing / key unlocking go through auth_executor
+#   - RSA encryption and inbox decryption run on a crypto thread pool
+#
+# Run it with any ASGI server, e.g.:   uvicorn asgi_api:app --port 5000
+# or directly:                         python asgi_api.py
+# (uses uvicorn when installed, otherwise a small built-in HTTP/1.1 server)
+
+import asyncio
+import contextvars
+import functools
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qsl
+
+import config
+import async_storage
+from auth import (
+    hash_password, Verify_password, take_keypair, keypair_pool,
+    serialize_public_key, save_private_key, Load_private_key, auth_executor
+)
+from cpu_executor import ExecutorOverloaded
+from encryption import encrypt_message, encrypt_message_multi, EncryptionError
+from decryption_pool import decrypt_messages
+from message_bus import message_bus
+from message_storage import mark_messages_read
+from retention import compaction_worker
+from user_directory import get_user_directory
+from api_common import (
+    optional_int, health_status, metrics_text, new_session_token, new_session, new_session_store,
+    clean_recipients, message_package, inbox_entries, stream_inbox, METRICS_CONTENT_TYPE,
+    SSE_HEADERS, SSE_KEEPALIVE, sse_event, stream_start_cursor, longpoll_timeout,
+    stream_session_token, stream_tickets
+)
+
+_crypto_executor = ThreadPoolExecutor(max_workers=config.ASYNC_CRYPTO_THREADS, thread_name_prefix="crypto")
+
+# Logged-in sessions by token, with expiry (see sessions.py)
+active_sessions = new_session_store()
+
+MAX_BODY_BYTES = 1024 * 1024
+
+# Headers of the request being handled, as {lowercase name: value} bytes
+_request_headers = contextvars.ContextVar('request_headers', default={})
+# The request's ASGI receive(), for handlers that wait and must notice the client leaving
+_request_receive = contextvars.ContextVar('request_receive', default=None)
+
+
+class HTTPError(Exception):
+    """Ends a request early with a JSON error response"""
+
+    def __init__(self, status, error, headers=None):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+        self.headers = headers or []
+
+
+async def run_crypto(fn, *args, **kwargs):
+    """Run RSA/AES work on the crypto thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_crypto_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def run_auth(fn, *args):
+    """Run a KDF-heavy auth step on the shared bounded auth executor"""
+    # submit() raises ExecutorOverloaded immediately when the queue is full
+    return await asyncio.wrap_future(auth_executor.submit(fn, *args))
+
+
+async def _sessions(method, *args):
+    """Call a method of active_sessions; the shared (SQLite) store blocks, so it goes to the I/O threads"""
+    if active_sessions.backend is None:
+        return method(*args)
+    return await async_storage.run_io(method, *args)
+
+
+async def _require_session(data):
+    session = await _sessions(active_sessions.get, data.get('session_token'))
+    if session is None:
+        raise HTTPError(401, 'Not authenticated')
+    return session
+
+
+async def _read_inbox(session, cursor=None, limit=None):
+    """Read and decrypt a page of the session user's inbox -> (entries, next cursor)"""
+    messages, next_cursor = await async_storage.get_messages_page(session['username'], cursor, limit)
+    # Decrypt messages (cached per session, in parallel for large inboxes)
+    results = await run_crypto(
+        decrypt_messages, messages, session['private_key'], session['decrypted_cache'], session['session_keys']
+    )
+    if messages:
+        await async_storage.run_io(mark_messages_read, session['username'], next_cursor)
+    return inbox_entries(messages, results, next_cursor), next_cursor
+
+
+def _text_field(data, key):
+    value = data.get(key, '')
+    return value.strip() if isinstance(value, str) else ''
+
+
+# ============================================
+# ENDPOINTS
+# ============================================
+
+async def health_check(data, query):
+    """Health check endpoint"""
+    # Off the loop: the stats read storage and, with a shared session store, SQLite
+    return 200, await async_storage.run_io(health_status, active_sessions)
+
+
+async def metrics(data, query):
+    """Timers and counters in the Prometheus text format"""
+    text = metrics_text()
+    if text is None:
+        raise HTTPError(404, 'Metrics are disabled')
+    return 200, TextResponse(text, METRICS_CONTENT_TYPE)
+
+
+async def signup(data, query):
+    """Create a new user account"""
+    username = _text_field(data, 'username')
+    password = _text_field(data, 'password')
+
+    # Validation
+    if not username or len(username) < 3:
+        raise HTTPError(400, 'Username must be at least 3 characters')
+    if not password or len(password) < 8:
+        raise HTTPError(400, 'Password must be at least 8 characters')
+
+    # Check if user exists
+    if await async_storage.user_exists(username):
+        raise HTTPError(400, 'Username already taken')
+
+    # Create user
+    password_hash, salt = await run_auth(hash_password, password)
+    private_key, public_key = await run_crypto(take_keypair)
+    user_data = {
+        "username": username,
+        "password_hash": password_hash,
+        "salt": salt,
+        "public_key": serialize_public_key(public_key)
+    }
+
+    # Key first, so the account never becomes visible without one
+    await run_auth(save_private_key, username, private_key, password)
+    await async_storage.save_user(username, user_data)
+
+    return 200, {
+        'success': True,
+        'message': 'Account created successfully',
+        'username': username
+    }
+
+
+async def login(data, query):
+    """Login user"""
+    username = _text_field(data, 'username')
+    password = _text_field(data, 'password')
+
+    if not username or not password:
+        raise HTTPError(400, 'Username and password required')
+
+    # Load user
+    if not await async_storage.user_exists(username):
+        raise HTTPError(401, 'Invalid username or password')
+    user_data = await async_storage.load_user(username)
+    if not user_data:
+        raise HTTPError(401, 'Invalid username or password')
+
+    # Verify password
+    if not await run_auth(Verify_password, password, user_data['password_hash'], user_data['salt']):
+        raise HTTPError(401, 'Invalid username or password')
+
+    # Load private key
+    try:
+        private_key = await run_auth(Load_private_key, username, password)
+    except ExecutorOverloaded:
+        raise
+    except Exception:
+        raise HTTPError(500, 'Failed to load encryption keys')
+
+    # Create session
+    session_token = new_session_token()
+    await _sessions(active_sessions.add, session_token, new_session(username, private_key, user_data['public_key']))
+
+    return 200, {
+        'success': True,
+        'message': 'Login successful',
+        'username': username,
+        'session_token': session_token
+    }
+
+
+async def logout(data, query):
+    """Logout user"""
+    await _sessions(active_sessions.remove, data.get('session_token'))
+    return 200, {
+        'success': True,
+        'message': 'Logged out successfully'
+    }
+
+
+async def send_message(data, query):
+    """Send an encrypted message"""
+    session = await _require_session(data)
+    recipient = _text_field(data, 'recipient')
+    message_text = _text_field(data, 'message')
+
+    if not recipient or not message_text:
+        raise HTTPError(400, 'Recipient and message required')
+
+    # Get recipient's public key
+    recipient_public_key = await async_storage.get_user_public_key(recipient)
+    if not recipient_public_key:
+        raise HTTPError(404, f'User {recipient} not found')
+
+    # Encrypt message
+    try:
+        encrypted_data = await run_crypto(encrypt_message, message_text, recipient_public_key, recipient, session['username'])
+    except EncryptionError:
+        raise HTTPError(500, 'Encryption failed')
+
+    # Save message
+    await async_storage.save_message(message_package(session['username'], recipient, encrypted_data))
+
+    return 200, {
+        'success': True,
+        'message': 'Message sent successfully'
+    }
+
+
+async def send_bulk(data, query):
+    """Send one message to many recipients (encrypted once)"""
+    session = await _require_session(data)
+    message_text = _text_field(data, 'message')
+
+    # Drop blanks and duplicates, keep order
+    try:
+        recipients = clean_recipients(data.get('recipients'))
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+    if not message_text:
+        raise HTTPError(400, 'Recipients (a list) and message required')
+
+    # Get recipients' public keys
+    public_keys = await asyncio.gather(*(async_storage.get_user_public_key(r) for r in recipients))
+    found = [r for r, key in zip(recipients, public_keys) if key]
+    not_found = [r for r, key in zip(recipients, public_keys) if not key]
+    if not found:
+        return 404, {'error': 'None of the recipients were found', 'not_found': not_found}
+
+    # Encrypt once for everyone
+    try:
+        encrypted_data = await run_crypto(encrypt_message_multi, message_text, [k for k in public_keys if k], found)
+    except EncryptionError:
+        raise HTTPError(500, 'Encryption failed')
+
+    # Save messages (one write per recipient inbox)
+    timestamp = datetime.now().isoformat()
+    await async_storage.save_messages([
+        message_package(session['username'], recipient, encrypted, timestamp)
+        for recipient, encrypted in zip(found, encrypted_data)
+    ])
+
+    return 200, {
+        'success': True,
+        'message': f'Message sent to {len(found)} recipient(s)',
+        'sent': found,
+        'not_found': not_found
+    }
+
+
+async def get_inbox(data, query):
+    """Get user's inbox with decrypted messages (optional cursor / limit)"""
+    session = await _require_session(data)
+
+    # Get and decrypt messages
+    try:
+        cursor = optional_int(data, 'cursor')
+        limit = optional_int(data, 'limit')
+        if limit is None:
+            # Whole inbox: streamed, as in api.py
+            return 200, JsonStream(await async_storage.run_io(stream_inbox, session, cursor))
+        entries, next_cursor = await _read_inbox(session, cursor, limit)
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+
+    return 200, {
+        'success': True,
+        'messages': entries,
+        'next_cursor': next_cursor
+    }
+
+
+class JsonStream:
+    """A chunked JSON response written from a (blocking) generator of text chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def respond(self, receive, send):
+        headers = [(b'content-type', b'application/json'), *CORS_HEADERS]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        try:
+            while True:
+                # Each step reads and decrypts a batch: keep it off the loop
+                chunk = await run_crypto(next, self.chunks, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            pass  # Client went away mid-write
+        finally:
+            await run_crypto(self.chunks.close)
+
+
+async def stream_ticket(data, query):
+    """Short-lived ticket that opens /api/stream (see api.py)"""
+    session_token = data.get('session_token')
+    await _require_session(data)
+    return 200, {
+        'success': True,
+        'stream_ticket': stream_tickets.issue(session_token),
+        'expires_in': stream_tickets.ttl
+    }
+
+
+async def stream(data, query):
+    """
+    Push new messages as they arrive, already decrypted (see api.py for
+    the protocol): Server-Sent Events, or a long-poll with mode=poll.
+    """
+    params = dict(query)
+    params.update(data)
+    try:
+        session_token = stream_session_token(query, data)
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+    session = await _require_session({'session_token': session_token})
+
+    last_event_id = _request_headers.get().get(b'last-event-id', b'').decode('latin-1')
+    try:
+        cursor = await async_storage.run_io(stream_start_cursor, session['username'], params, last_event_id)
+        timeout = longpoll_timeout(params)
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+
+    if params.get('mode') == 'poll':
+        return await _long_poll(session, cursor, timeout)
+    return 200, EventStream(session_token, session, cursor)
+
+
+async def _watch_disconnect(receive, subscription):
+    """Wake `subscription` once the client has gone away"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    subscription.notify()
+
+
+async def _long_poll(session, cursor, timeout):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    # Subscribe before reading, so a message saved in between still wakes us
+    with message_bus.subscribe(session['username'], loop=loop) as subscription:
+        watcher = asyncio.ensure_future(_watch_disconnect(_request_receive.get(), subscription))
+        try:
+            while True:
+                entries, cursor = await _read_inbox(session, cursor, config.STREAM_BATCH_LIMIT)
+                remaining = deadline - loop.time()
+                if entries or remaining <= 0 or watcher.done():
+                    return 200, {
+                        'success': True,
+                        'messages': entries,
+                        'next_cursor': cursor
+                    }
+                # Also re-check now and then for messages saved by other processes
+                await subscription.wait(min(remaining, config.STREAM_HEARTBEAT_SECONDS))
+        finally:
+            watcher.cancel()
+
+
+class TextResponse:
+    """A plain (non-JSON) response body"""
+
+    def __init__(self, text, content_type):
+        self.body = text.encode('utf-8')
+        self.content_type = content_type
+
+    async def respond(self, receive, send):
+        headers = [
+            (b'content-type', self.content_type.encode()),
+            (b'content-length', str(len(self.body)).encode()),
+            *CORS_HEADERS,
+        ]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+class EventStream:
+    """A Server-Sent Events response, written until the client goes away or logs out"""
+
+    def __init__(self, session_token, session, cursor):
+        self.session_token = session_token
+        self.session = session
+        self.cursor = cursor
+
+    async def respond(self, receive, send):
+        headers = [(b'content-type', b'text/event-stream'), *CORS_HEADERS]
+        headers += [(k.lower().encode(), v.encode()) for k, v in SSE_HEADERS.items()]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+
+        loop = asyncio.get_running_loop()
+        with message_bus.subscribe(self.session['username'], loop=loop) as subscription:
+            watcher = asyncio.ensure_future(_watch_disconnect(receive, subscription))
+            try:
+                await self._send_events(send, subscription, watcher)
+            except OSError:
+                pass  # Client went away mid-write
+            finally:
+                watcher.cancel()
+
+    async def _send_events(self, send, subscription, watcher):
+        async def write(text):
+            await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+        await write(SSE_KEEPALIVE)
+        while not watcher.done() and await _sessions(active_sessions.get, self.session_token) is self.session:
+            entries, self.cursor = await _read_inbox(self.session, self.cursor, config.STREAM_BATCH_LIMIT)
+            if entries:
+                await write(sse_event('messages', {'messages': entries, 'next_cursor': self.cursor}, self.cursor))
+                continue  # A full batch may have more behind it
+            if not await subscription.wait(config.STREAM_HEARTBEAT_SECONDS):
+                await write(SSE_KEEPALIVE)
+
+        if not watcher.done():
+            # Session ended (logout) - tell the client not to reconnect
+            await write(sse_event('logout', {'error': 'Not authenticated'}))
+            await send({'type': 'http.response.body', 'body': b''})
+
+
+async def list_users(data, query):
+    """Get list of users (optional prefix / limit query parameters)"""
+    try:
+        limit = optional_int(query, 'limit')
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+    if limit is not None and limit < 1:
+        raise HTTPError(400, 'limit must be a positive integer')
+
+    users = await async_storage.get_all_users(query.get('prefix', ''), limit)
+    return 200, {
+        'success': True,
+        'users': users
+    }
+
+
+ROUTES = {
+    '/api/health': (('GET',), health_check),
+    '/api/metrics': (('GET',), metrics),
+    '/api/signup': (('POST',), signup),
+    '/api/login': (('POST',), login),
+    '/api/logout': (('POST',), logout),
+    '/api/send': (('POST',), send_message),
+    '/api/send_bulk': (('POST',), send_bulk),
+    '/api/inbox': (('POST',), get_inbox),
+    '/api/stream_ticket': (('POST',), stream_ticket),
+    '/api/stream': (('GET', 'POST'), stream),
+    '/api/users': (('GET',), list_users),
+}
+
+
+# ============================================
+# ASGI APPLICATION
+# ============================================
+
+# Enable CORS for the React frontend (same as flask_cors defaults)
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+]
+CORS_PREFLIGHT_HEADERS = CORS_HEADERS + [
+    (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+    (b'access-control-allow-headers', b'Content-Type'),
+]
+
+
+async def _read_body(receive):
+    body = bytearray()
+    while True:
+        event = await receive()
+        if event['type'] == 'http.disconnect':
+            raise HTTPError(400, 'Client disconnected')
+        body += event.get('body', b'')
+        if len(body) > MAX_BODY_BYTES:
+            raise HTTPError(413, 'Request body too large')
+        if not event.get('more_body', False):
+            return bytes(body)
+
+
+async def _send_json(send, status, payload, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            *CORS_HEADERS,
+            *headers,
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _startup():
+    await async_storage.setup()
+    await async_storage.run_io(get_user_directory)  # Build the user index once at startup
+    keypair_pool.start()
+    compaction_worker.start()
+    active_sessions.start()
+
+
+async def _lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            try:
+                await _startup()
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            keypair_pool.stop(timeout=1)
+            compaction_worker.stop(timeout=1)
+            active_sessions.stop(timeout=1)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI 3 entry point"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    method = scope['method']
+    path = scope['path']
+
+    if method == 'OPTIONS':
+        await send({'type': 'http.response.start', 'status': 204, 'headers': CORS_PREFLIGHT_HEADERS})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    route = ROUTES.get(path)
+    if route is None:
+        await _send_json(send, 404, {'error': 'Not found'})
+        return
+    if method not in route[0]:
+        await _send_json(send, 405, {'error': 'Method not allowed'})
+        return
+
+    try:
+        query = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        body = await _read_body(receive)
+        data = {}
+        if method == 'POST':
+            try:
+                data = json.loads(body or b'null')
+            except ValueError:
+                raise HTTPError(400, 'Request body must be JSON')
+            if not isinstance(data, dict):
+                raise HTTPError(400, 'Request body must be a JSON object')
+
+        _request_headers.set(dict(scope.get('headers', [])))
+        _request_receive.set(receive)
+        status, payload = await route[1](data, query)
+        if not isinstance(payload, (EventStream, JsonStream, TextResponse)):
+            await _send_json(send, status, payload)
+            return
+
+    except HTTPError as e:
+        await _send_json(send, e.status, {'error': e.error}, e.headers)
+        return
+    except ExecutorOverloaded:
+        # Fast reject when too many password checks are already queued
+        await _send_json(send, 503, {'error': 'Server busy, please retry shortly'}, [(b'retry-after', b'1')])
+        return
+    except Exception as e:
+        await _send_json(send, 500, {'error': str(e)})
+        return
+
+    # Streaming responses run outside the JSON error handling: once the
+    # headers are out, errors can only end the stream
+    await payload.respond(receive, send)
+
+
+# ============================================
+# BUILT-IN SERVER (when uvicorn isn't installed)
+# ============================================
+
+_REASONS = {
+    200: 'OK', 204: 'No Content', 400: 'Bad Request', 401: 'Unauthorized',
+    404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+    500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+
+class _ConnectionReader:
+    """
+    A connection's StreamReader that can also tell when the client hangs
+    up in the middle of a response. Bytes that arrive meanwhile (a
+    pipelined next request) are kept and read first.
+    """
+
+    def __init__(self, reader):
+        self._reader = reader
+        self._early = bytearray()
+        self._eof = False
+
+    async def readline(self):
+        index = self._early.find(b'\n')
+        if index >= 0:
+            line = bytes(self._early[:index + 1])
+            del self._early[:index + 1]
+            return line
+        line = bytes(self._early) + (b'' if self._eof else await self._reader.readline())
+        self._early.clear()
+        return line
+
+    async def readexactly(self, n):
+        data = bytes(self._early[:n])
+        del self._early[:n]
+        if len(data) < n:
+            if self._eof:
+                raise asyncio.IncompleteReadError(data, n)
+            data += await self._reader.readexactly(n - len(data))
+        return data
+
+    async def wait_disconnect(self):
+        """Return once the client has closed its end of the connection"""
+        while not self._eof:
+            if len(self._early) > MAX_BODY_BYTES:
+                # A client pipelining this much can wait; stop reading
+                await asyncio.Event().wait()
+            try:
+                data = await self._reader.read(65536)
+            except ConnectionError:
+                data = b''  # Reset instead of closed: gone all the same
+            if data:
+                self._early += data
+            else:
+                self._eof = True
+
+
+async def _handle_connection(asgi_app, reader, writer):
+    """Minimal HTTP/1.1 with keep-alive, enough to host the ASGI app"""
+    peer = writer.get_extra_info('peername') or ('', 0)
+    sock = writer.get_extra_info('sockname') or ('', 0)
+    reader = _ConnectionReader(reader)
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            try:
+                method, target, version = request_line.decode('latin-1').split()
+            except ValueError:
+                return
+
+            headers = []
+            content_length = 0
+            bad_length = False
+            keep_alive = version == 'HTTP/1.1'
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                name, value = name.strip().lower(), value.strip()
+                headers.append((name.encode('latin-1'), value.encode('latin-1')))
+                if name == 'content-length':
+                    if value.isascii() and value.isdigit():
+                        content_length = int(value)
+                    else:
+                        bad_length = True
+                elif name == 'connection':
+                    keep_alive = value.lower() != 'close' if version == 'HTTP/1.1' else value.lower() == 'keep-alive'
+
+            if bad_length:
+                writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                await writer.drain()
+                return
+            if content_length > MAX_BODY_BYTES:
+                writer.write(b'HTTP/1.1 413 Payload Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                await writer.drain()
+                return
+            body = await reader.readexactly(content_length) if content_length else b''
+
+            path, _, query_string = target.partition('?')
+            scope = {
+                'type': 'http',
+                'asgi': {'version': '3.0'},
+                'http_version': version.split('/')[-1],
+                'method': method.upper(),
+                'scheme': 'http',
+                'path': path,
+                'raw_path': path.encode('latin-1'),
+                'query_string': query_string.encode('latin-1'),
+                'root_path': '',
+                'headers': headers,
+                'client': peer[:2],
+                'server': sock[:2],
+            }
+
+            body_sent = False
+
+            async def receive():
+                nonlocal body_sent
+                if not body_sent:
+                    body_sent = True
+                    return {'type': 'http.request', 'body': body, 'more_body': False}
+                # Nothing more will arrive on this request; the next event
+                # is the client going away
+                await reader.wait_disconnect()
+                return {'type': 'http.disconnect'}
+
+            chunked = False
+
+            async def send(event):
+                nonlocal chunked
+                if event['type'] == 'http.response.start':
+                    status = event['status']
+                    response_headers = list(event.get('headers', []))
+                    if not any(name.lower() == b'content-length' for name, _ in response_headers):
+                        chunked = True
+                        response_headers.append((b'transfer-encoding', b'chunked'))
+                    response_headers.append((b'connection', b'keep-alive' if keep_alive else b'close'))
+                    head = f'HTTP/1.1 {status} {_REASONS.get(status, "")}\r\n'.encode('latin-1')
+                    head += b''.join(name + b': ' + value + b'\r\n' for name, value in response_headers)
+                    writer.write(head + b'\r\n')
+                elif event['type'] == 'http.response.body':
+                    data = event.get('body', b'')
+                    if chunked:
+                        if data:
+                            writer.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+                        if not event.get('more_body', False):
+                            writer.write(b'0\r\n\r\n')
+                    else:
+                        writer.write(data)
+                    await writer.drain()
+
+            await asgi_app(scope, receive, send)
+            if not keep_alive:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError):
+        return
+    finally:
+        writer.close()
+
+
+async def serve(asgi_app=app, host='127.0.0.1', port=5000):
+    """Run the ASGI app on the built-in asyncio HTTP server"""
+    await _startup()
+    server = await asyncio.start_server(functools.partial(_handle_connection, asgi_app), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    print("="*60)
+    print("E2E Encrypted Messenger - Async API Server")
+    print("="*60)
+    print("\nAPI will be available at: http://localhost:5000")
+    print("Endpoints are the same as api.py")
+    print("\nPress Ctrl+C to stop")
+    print("="*60 + "\n")
+
+    try:
+        import uvicorn
+    except ImportError:
+        uvicorn = None
+
+    try:
+        if uvicorn is not None:
+            uvicorn.run(app, host='127.0.0.1', port=5000)
+        else:
+            print("(uvicorn not installed - using the built-in server)")
+            asyncio.run(serve())
+    except KeyboardInterrupt:
+        sys.exit(0)
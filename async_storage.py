@@ -0,0 +1,66 @@
+# async_storage.py
+# E2E Encrypted Messenger - Async Wrappers for Storage Calls
+#
+# Storage calls block on file I/O, fsync or SQLite. The asyncio server
+# (asgi_api.py) awaits these wrappers instead, which run the normal
+# synchronous functions on a dedicated thread pool so the event loop
+# stays free to serve other connections.
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import auth
+import message_storage
+
+_io_executor = ThreadPoolExecutor(max_workers=config.ASYNC_IO_THREADS, thread_name_prefix="storage-io")
+
+
+async def run_io(fn, *args, **kwargs):
+    """Run a blocking storage call on the I/O thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, functools.partial(fn, *args, **kwargs))
+
+
+# --- Setup ---
+
+async def setup():
+    await run_io(auth.setup)
+    await run_io(message_storage.setup_messages)
+
+
+# --- Users ---
+
+async def user_exists(username):
+    return await run_io(auth.user_exists, username)
+
+
+async def load_user(username):
+    return await run_io(auth.load_user, username)
+
+
+async def save_user(username, user_data):
+    await run_io(auth.save_user, username, user_data)
+
+
+async def get_user_public_key(username):
+    return await run_io(message_storage.get_user_public_key, username)
+
+
+async def get_all_users(prefix='', limit=None):
+    return await run_io(message_storage.get_all_users, prefix, limit)
+
+
+# --- Messages ---
+
+async def save_message(message_package):
+    await run_io(message_storage.save_message, message_package)
+
+
+async def save_messages(message_packages):
+    await run_io(message_storage.save_messages, message_packages)
+
+
+async def get_messages_page(username, since=None, limit=None):
+    return await run_io(message_storage.get_messages_page, username, since, limit)
@@ -9,20 +9,22 @@ from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 
-User_DIR = "Users"  # Now it's a directory!
-Keys_DIR = "Keys"
+import config
+from cpu_executor import BoundedExecutor
+from encryption import invalidate_public_key
+from keypool import KeyPairPool
+from metrics import timed, timer
+from storage import get_storage
+from user_directory import get_user_directory
 
 # clear terminal
 def clear_terminal():
     os.system('cls' if os.name == 'nt' else 'clear')
 
-# Create directories if none exist
+# Create directories (or database tables) if none exist
 def setup():
     try:
-        if not os.path.exists(Keys_DIR):
-            os.makedirs(Keys_DIR)
-        if not os.path.exists(User_DIR):  # Create Users directory
-            os.makedirs(User_DIR)
+        get_storage().setup()
     except (OSError, IOError) as e:
         print(f"Error during setup: {e}")
         raise
@@ -30,39 +32,39 @@ def setup():
 # Load single user from their file
 def load_user(username):
     """Load a specific user's data"""
-    user_file = os.path.join(User_DIR, f"{username}.json")
     try:
-        with open(user_file, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return None
+        return get_storage().load_user(username)
     except json.JSONDecodeError as e:
         print(f"Error: User file corrupted: {e}")
         raise
 
-# Load all users (for checking if username exists)
+# Load all users
 def load_all_users():
     """Load all usernames"""
     try:
-        users = []
-        if os.path.exists(User_DIR):
-            for filename in os.listdir(User_DIR):
-                if filename.endswith('.json'):
-                    username = filename[:-5]  # Remove .json extension
-                    users.append(username)
-        return users
+        return get_user_directory().usernames()
     except Exception as e:
         print(f"Error loading users: {e}")
         return []
 
+# Check if a username is taken (O(1), uses the in-memory user directory)
+def user_exists(username):
+    """Return True if the username is registered"""
+    return get_user_directory().exists(username)
+
 # Save single user to their file    
 def save_user(username, user_data):
     """Save a user's data to their file"""
-    user_file = os.path.join(User_DIR, f"{username}.json")
-    with open(user_file, 'w') as f:
-        json.dump(user_data, f, indent=2)
+    get_storage().save_user(username, user_data)
+    get_user_directory().add(username, user_data)
+    invalidate_public_key(username)
+
+# Reported on /api/metrics
+_hash_time = timer("e2e_hash_password_seconds", "hash_password() calls (PBKDF2, also behind Verify_password)")
+_unlock_time = timer("e2e_load_private_key_seconds", "Load_private_key() calls (read and decrypt a private key)")
 
 # Hash password with PBKDF2
+@timed(_hash_time)
 def hash_password(password, salt=None):
     if salt is None:
         salt = secrets.token_bytes(32)
@@ -89,6 +91,10 @@ def Verify_password(password, stored_hash, stored_salt):
     calculated_hash, _ = hash_password(password, stored_salt)
     return calculated_hash == stored_hash
 
+# KDF-heavy work (hash_password, Verify_password, save/Load_private_key)
+# runs on this bounded pool, shared by the CLI and the API
+auth_executor = BoundedExecutor("auth", config.AUTH_WORKERS, config.AUTH_MAX_QUEUE)
+
 # Gens RSA keypair
 def gen_keypair():
     private_key = rsa.generate_private_key(
@@ -99,6 +105,14 @@ def gen_keypair():
     public_key = private_key.public_key()
     return private_key, public_key
 
+# Keypairs generated ahead of time by a background thread.
+# Call keypair_pool.start() to begin filling it.
+keypair_pool = KeyPairPool(gen_keypair)
+
+# Gets an RSA keypair for a new account (from the pool if one is ready)
+def take_keypair():
+    return keypair_pool.take()
+
 # Converts public key to string
 def serialize_public_key(public_key):
     pem = public_key.public_bytes(
@@ -115,16 +129,14 @@ def save_private_key(username, private_key, password):
         encryption_algorithm=serialization.BestAvailableEncryption(password.encode())
     )
 
-    key_file = os.path.join(Keys_DIR, f"{username}.key")
-    with open(key_file, 'wb') as f:
-        f.write(pem)
+    get_storage().save_private_key(username, pem)
 
 # Load encrypted private Key
+@timed(_unlock_time)
 def Load_private_key(username, password):
-    key_file = os.path.join(Keys_DIR, f"{username}.key")
-
-    with open(key_file, 'rb') as f:
-        pem = f.read()
+    pem = get_storage().load_private_key(username)
+    if pem is None:
+        raise FileNotFoundError(f"No private key stored for {username!r}")
 
     private_key = serialization.load_pem_private_key(
         pem, 
@@ -140,8 +152,6 @@ def sign_up():
     print("=== E2E Encrypted Messaging App ===")
     print("\n=== SIGN UP ===")
 
-    all_users = load_all_users()  # Get list of all usernames
-    
     # Get username
     while True:
         clear_terminal()
@@ -152,7 +162,7 @@ def sign_up():
         if not username:
             print("Username cannot be empty")
             time.sleep(1.5)
-        elif username in all_users:  # Check against list
+        elif user_exists(username):
             print("Username already taken!")
             time.sleep(1.5)
         else:
@@ -200,17 +210,17 @@ def sign_up():
     print("\nCreating account...")
 
     # Hash password
-    password_hash, salt = hash_password(password)
+    password_hash, salt = auth_executor.run(hash_password, password)
 
     # Gen Keys
     print("Generating Encryption Keys")
-    private_key, public_key = gen_keypair()
+    private_key, public_key = take_keypair()
 
     # convert pub key to string
     public_key_pem = serialize_public_key(public_key)
 
     # Saves Encrypted Private key
-    save_private_key(username, private_key, password)
+    auth_executor.run(save_private_key, username, private_key, password)
 
     # Save user data to their own file
     user_data = {
@@ -233,15 +243,13 @@ def log_in():
     print("=== E2E Encrypted Messaging App ===")
     print("\n=== LOG IN ===")
 
-    all_users = load_all_users()  # Get list of all usernames
-
     while True:
         clear_terminal()
         print("=== E2E Encrypted Messaging App ===")
         print("\n=== LOG IN ===")
 
         username = input("Enter Username: ").strip()
-        if username not in all_users:  # Check against list
+        if not user_exists(username):
             print("Username not found!")
             time.sleep(1.5)
         else:
@@ -263,7 +271,7 @@ def log_in():
 
         password = input("Enter Password: ").strip()
 
-        if not Verify_password(password, user_data['password_hash'], user_data['salt']):
+        if not auth_executor.run(Verify_password, password, user_data['password_hash'], user_data['salt']):
             print("Incorrect password!")
             time.sleep(1.5)
         else:
@@ -274,7 +282,7 @@ def log_in():
     # Load Private key
     print("\nAttempting to load private key...")
     try:
-        private_key = Load_private_key(username, password)
+        private_key = auth_executor.run(Load_private_key, username, password)
         print("✓ Private key loaded")
 
         return {
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+# benchmark.py
+# E2E Encrypted Messenger - Local Benchmark Suite
+#
+# Measures throughput (ops/sec) and latency percentiles of the hot paths
+# at several concurrency levels and inbox sizes, and prints the results
+# as JSON so runs from different versions can be compared:
+#
+#   python benchmark.py --output before.json
+#   ... change something ...
+#   python benchmark.py --output after.json --compare before.json
+#
+# Everything runs in-process against a throwaway data directory; the
+# messenger's own Users/, Keys/ and messages/ are never touched. The
+# settings in config.py (storage backend, durability, group commit, ...)
+# apply as usual, so E2E_* environment variables select what is measured.
+#
+# Cases:
+#   save_message      append one message to an inbox that already holds N
+#   get_messages      read a whole N-message inbox (get_messages_for_user)
+#   encrypt_message   encrypt one message for a recipient (cached public key)
+#   decrypt_message   decrypt one message (one RSA unwrap + AES-GCM)
+#   hash_password     PBKDF2 password hash
+#   gen_keypair       RSA-2048 key generation
+#   api_send          POST /api/send through the Flask test client
+#   api_inbox         POST /api/inbox for an N-message inbox; all threads
+#                     share one session whose decrypted-message cache is
+#                     warmed first, as for a client polling its inbox
+#
+# Each case runs until --ops operations have completed or --max-seconds
+# have passed, whichever comes first (at least one operation always
+# completes), spread over the given number of threads.
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import config
+from api_common import message_package
+from auth import gen_keypair, hash_password, serialize_public_key, setup
+from encryption import decrypt_message, encrypt_message
+from message_storage import (
+    get_messages_for_user, get_user_public_key, save_message, save_messages, setup_messages
+)
+from storage import get_storage
+
+CASES = (
+    "save_message", "get_messages", "encrypt_message", "decrypt_message",
+    "hash_password", "gen_keypair", "api_send", "api_inbox",
+)
+
+# Cases whose cost depends on how many messages the inbox holds
+INBOX_CASES = ("save_message", "get_messages", "api_inbox")
+
+DEFAULT_CONCURRENCY = "1,4,16"
+DEFAULT_INBOX_SIZES = "10,1000,10000,100000"
+
+# Messages written per save_messages() call while filling inboxes
+FILL_CHUNK = 5000
+
+PERCENTILES = (50, 95, 99)
+
+
+# ============================================
+# MEASUREMENT
+# ============================================
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(latencies, seconds, errors):
+    """
+    Returns:
+        dict: ops, errors, seconds, ops_per_sec and latency_ms
+            (mean, p50, p95, p99, max)
+    """
+    latencies = sorted(latencies)
+    count = len(latencies)
+    latency_ms = {'mean': round(sum(latencies) / count * 1000.0, 4) if count else None}
+    for p in PERCENTILES:
+        value = percentile(latencies, p)
+        latency_ms[f'p{p}'] = None if value is None else round(value * 1000.0, 4)
+    latency_ms['max'] = round(latencies[-1] * 1000.0, 4) if count else None
+    return {
+        'ops': count,
+        'errors': errors,
+        'seconds': round(seconds, 4),
+        'ops_per_sec': round(count / seconds, 2) if seconds > 0 else None,
+        'latency_ms': latency_ms,
+    }
+
+
+def measure(operation, concurrency, ops, max_seconds):
+    """
+    Call operation(i) from `concurrency` threads until `ops` calls have
+    been made or `max_seconds` have passed.
+
+    Returns:
+        dict: see summarize()
+    """
+    counter = itertools.count()
+    start_line = threading.Barrier(concurrency + 1)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = [None]
+
+    def worker():
+        mine = []
+        failed = 0
+        start_line.wait()
+        while True:
+            i = next(counter)
+            if i >= ops or (i > 0 and time.perf_counter() > deadline[0]):
+                break
+            started = time.perf_counter()
+            try:
+                operation(i)
+            except Exception:
+                failed += 1
+                continue
+            mine.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    started = time.perf_counter()
+    deadline[0] = started + max_seconds
+    start_line.wait()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, time.perf_counter() - started, sum(errors))
+
+
+# ============================================
+# FIXTURES
+# ============================================
+
+class Fixtures:
+    """Users, keys and pre-filled inboxes shared by the cases"""
+
+    PASSWORD = "benchmark-password"
+
+    def __init__(self, message_bytes):
+        self.text = ("x" * message_bytes)
+        self.private_key, public_key = gen_keypair()
+        self.public_key_pem = serialize_public_key(public_key)
+        self.encrypted = encrypt_message(self.text, self.public_key_pem, "bench_reader")
+        self.filled = {}
+        self._client = None
+
+    def package(self, to_user, i, encrypted=None):
+        timestamp = f"2024-01-01T00:00:00.{i % 1000000:06d}"
+        return message_package("bench_sender", to_user, encrypted or self.encrypted, timestamp)
+
+    def fill_inbox(self, username, size):
+        """Grow `username`'s inbox to `size` messages (all the same ciphertext)"""
+        have = self.filled.get(username, 0)
+        while have < size:
+            count = min(FILL_CHUNK, size - have)
+            save_messages([self.package(username, i) for i in range(have, have + count)])
+            have += count
+            self.filled[username] = have
+
+    # --- API ---
+
+    def client(self):
+        """Flask test client with 'bench_sender' and 'bench_reader' signed up"""
+        if self._client is None:
+            # Imported here: importing api sets up storage in the working directory
+            from api import app
+            self._client = app.test_client()
+            for username in ("bench_sender", "bench_reader"):
+                response = self._client.post('/api/signup', json={'username': username, 'password': self.PASSWORD})
+                if response.status_code != 200:
+                    raise RuntimeError(f"Sign-up of {username} failed: {response.get_json()}")
+        return self._client
+
+    def login(self, username):
+        response = self.client().post('/api/login', json={'username': username, 'password': self.PASSWORD})
+        body = response.get_json()
+        if response.status_code != 200:
+            raise RuntimeError(f"Login of {username} failed: {body}")
+        return body['session_token']
+
+    def fill_api_inbox(self, size):
+        """
+        Grow bench_reader's inbox to `size` messages it can decrypt, each
+        encrypted separately so no two share a decrypted-message cache entry
+        """
+        self.client()
+        pem = get_user_public_key("bench_reader")
+        have = self.filled.get("bench_reader", 0)
+        while have < size:
+            count = min(FILL_CHUNK, size - have)
+            save_messages([
+                self.package("bench_reader", i, encrypt_message(self.text, pem, "bench_reader"))
+                for i in range(have, have + count)
+            ])
+            have += count
+            self.filled["bench_reader"] = have
+
+
+# ============================================
+# CASES
+# ============================================
+#
+# Each returns operation(i) for measure(); inbox cases take the size.
+
+def case_save_message(fx, size):
+    username = f"bench_save_{size}"
+    fx.fill_inbox(username, size)
+    return lambda i: save_message(fx.package(username, i))
+
+
+def case_get_messages(fx, size):
+    username = f"bench_get_{size}"
+    fx.fill_inbox(username, size)
+
+    def operation(i):
+        if len(get_messages_for_user(username)) < size:
+            raise AssertionError("short read")
+    return operation
+
+
+def case_encrypt_message(fx):
+    return lambda i: encrypt_message(fx.text, fx.public_key_pem, "bench_reader")
+
+
+def case_decrypt_message(fx):
+    return lambda i: decrypt_message(fx.encrypted, fx.private_key)
+
+
+def case_hash_password(fx):
+    return lambda i: hash_password(fx.PASSWORD)
+
+
+def case_gen_keypair(fx):
+    return lambda i: gen_keypair()
+
+
+def case_api_send(fx):
+    client = fx.client()
+    token = fx.login("bench_sender")
+    body = {'session_token': token, 'recipient': 'bench_sink', 'message': fx.text}
+    client.post('/api/signup', json={'username': 'bench_sink', 'password': fx.PASSWORD})
+
+    def operation(i):
+        response = client.post('/api/send', json=body)
+        if response.status_code != 200:
+            raise RuntimeError(response.get_json())
+    return operation
+
+
+def case_api_inbox(fx, size):
+    client = fx.client()
+    fx.fill_api_inbox(size)
+    token = fx.login("bench_reader")
+    body = {'session_token': token}
+
+    def operation(i):
+        response = client.post('/api/inbox', json=body)
+        data = response.get_json()
+        if response.status_code != 200 or len(data['messages']) < size:
+            raise RuntimeError(data.get('error', 'short inbox'))
+    # Decrypt everything once; the measured polls hit the session cache
+    operation(-1)
+    return operation
+
+
+CASE_FUNCTIONS = {name: globals()[f"case_{name}"] for name in CASES}
+
+
+# ============================================
+# RUNNER
+# ============================================
+
+def parse_int_list(text):
+    try:
+        values = [int(part) for part in text.split(",") if part.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected comma-separated integers, got {text!r}")
+    if not values or any(v < 1 for v in values):
+        raise argparse.ArgumentTypeError(f"expected positive integers, got {text!r}")
+    return values
+
+
+def parse_cases(text):
+    names = [part.strip() for part in text.split(",") if part.strip()]
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown case(s) {', '.join(unknown)}; choose from: {', '.join(CASES)}")
+    return names
+
+
+def environment():
+    """What the numbers were measured on"""
+    storage = get_storage()
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'storage_backend': storage.name,
+        'durability': storage.durability,
+        'group_commit': config.GROUP_COMMIT_ENABLED,
+        'session_keys': config.SESSION_KEYS_ENABLED,
+        'decrypt_workers': config.DECRYPT_WORKERS,
+    }
+
+
+def run_suite(args, log):
+    """
+    Run the selected cases.
+
+    Returns:
+        dict: {'environment': ..., 'settings': ..., 'results': [...]}
+    """
+    setup()
+    setup_messages()
+    fx = Fixtures(args.message_bytes)
+
+    results = []
+    for name in args.cases:
+        sizes = sorted(args.inbox_sizes) if name in INBOX_CASES else [None]
+        for size in sizes:
+            label = name if size is None else f"{name} (inbox {size})"
+            try:
+                operation = CASE_FUNCTIONS[name](fx) if size is None else CASE_FUNCTIONS[name](fx, size)
+            except Exception as e:
+                log(f"✗ {label}: setup failed: {e}")
+                results.append({'case': name, 'inbox_size': size, 'error': str(e)})
+                continue
+            for concurrency in args.concurrency:
+                result = measure(operation, concurrency, args.ops, args.max_seconds)
+                result = dict({'case': name, 'inbox_size': size, 'concurrency': concurrency}, **result)
+                results.append(result)
+                mark = "✗" if result['errors'] else "✓"
+                log(
+                    f"{mark} {label}, {concurrency} thread(s): {result['ops_per_sec']} ops/s, "
+                    f"p50 {result['latency_ms']['p50']} ms, p99 {result['latency_ms']['p99']} ms"
+                    + (f", {result['errors']} error(s)" if result['errors'] else "")
+                )
+
+    return {
+        'environment': environment(),
+        'settings': {
+            'cases': args.cases,
+            'concurrency': args.concurrency,
+            'inbox_sizes': args.inbox_sizes,
+            'ops': args.ops,
+            'max_seconds': args.max_seconds,
+            'message_bytes': args.message_bytes,
+        },
+        'results': results,
+    }
+
+
+def _result_key(result):
+    return (result['case'], result.get('inbox_size'), result.get('concurrency'))
+
+
+def compare(baseline, report, threshold):
+    """
+    Match results against a previous report.
+
+    Returns:
+        list: (result key, baseline ops/sec, new ops/sec, ratio, regressed)
+    """
+    previous = {_result_key(r): r for r in baseline.get('results', []) if r.get('ops_per_sec')}
+    rows = []
+    for result in report['results']:
+        old = previous.get(_result_key(result))
+        if old is None or not result.get('ops_per_sec'):
+            continue
+        ratio = result['ops_per_sec'] / old['ops_per_sec']
+        rows.append((_result_key(result), old['ops_per_sec'], result['ops_per_sec'], ratio, ratio < 1 - threshold))
+    return rows
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="E2E Messenger benchmark suite (prints JSON)")
+    parser.add_argument("--cases", type=parse_cases, default=list(CASES),
+                        help=f"Comma-separated cases to run (default: all of {','.join(CASES)})")
+    parser.add_argument("--concurrency", type=parse_int_list, default=parse_int_list(DEFAULT_CONCURRENCY),
+                        help=f"Comma-separated thread counts (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--inbox-sizes", type=parse_int_list, default=parse_int_list(DEFAULT_INBOX_SIZES),
+                        help=f"Comma-separated inbox sizes for {', '.join(INBOX_CASES)} (default: {DEFAULT_INBOX_SIZES})")
+    parser.add_argument("--ops", type=int, default=500, help="Operations per measurement at most (default: 500)")
+    parser.add_argument("--max-seconds", type=float, default=5.0,
+                        help="Time limit per measurement (default: 5)")
+    parser.add_argument("--message-bytes", type=int, default=256, help="Plaintext size of test messages (default: 256)")
+    parser.add_argument("--quick", action="store_true",
+                        help="Smoke-test settings: concurrency 1,4, inbox sizes 10,1000, at most 50 ops / 1s each")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare ops/sec against an earlier JSON report")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="With --compare, flag cases this much slower (default: 0.1 = 10%%)")
+    parser.add_argument("--data-dir", help="Where to keep test data (default: a temporary directory, removed afterwards)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.quick:
+        args.concurrency = [1, 4]
+        args.inbox_sizes = [10, 1000]
+        args.ops = min(args.ops, 50)
+        args.max_seconds = min(args.max_seconds, 1.0)
+
+    def log(line):
+        print(line, file=sys.stderr, flush=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    output = os.path.abspath(args.output) if args.output else None
+
+    # Relative data paths in config.py resolve against the working directory
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="e2e-benchmark-")
+    os.makedirs(data_dir, exist_ok=True)
+    original_dir = os.getcwd()
+    os.chdir(data_dir)
+    try:
+        report = run_suite(args, log)
+    finally:
+        os.chdir(original_dir)
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    regressed = 0
+    if baseline is not None:
+        rows = compare(baseline, report, args.threshold)
+        report['comparison'] = [
+            {'case': key[0], 'inbox_size': key[1], 'concurrency': key[2],
+             'baseline_ops_per_sec': old, 'ops_per_sec': new, 'ratio': round(ratio, 3), 'regressed': bad}
+            for key, old, new, ratio, bad in rows
+        ]
+        regressed = sum(1 for row in rows if row[4])
+        log(f"{'✗' if regressed else '✓'} {regressed} of {len(rows)} measurement(s) more than "
+            f"{args.threshold:.0%} slower than {args.compare}")
+
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + "\n")
+        log(f"✓ Report written to {output}")
+    else:
+        print(text)
+
+    failed = any(r.get('errors') or 'error' in r for r in report['results'])
+    return 1 if failed or regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
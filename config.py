@@ -0,0 +1,165 @@
+# config.py
+# E2E Encrypted Messenger - Settings
+#
+# Every setting can be overridden with an environment variable so the
+# CLI, the API server and the maintenance tools all agree without
+# editing code.
+
+import os
+
+# ============================================
+# STORAGE
+# ============================================
+
+# "file" (Users/, Keys/, messages/ directories) or "sqlite"
+STORAGE_BACKEND = os.environ.get("E2E_STORAGE_BACKEND", "file")
+
+# Directories used by the file backend
+USER_DIR = os.environ.get("E2E_USER_DIR", "Users")
+KEYS_DIR = os.environ.get("E2E_KEYS_DIR", "Keys")
+MESSAGE_DIR = os.environ.get("E2E_MESSAGE_DIR", "messages")
+# "sharded" (Users/3b/a9/alice.json, ...) or "flat" (Users/alice.json);
+# files in the other layout are still found (see storage.py)
+FILE_LAYOUT = os.environ.get("E2E_FILE_LAYOUT", "sharded")
+# Archive segments written by inbox compaction (see retention.py)
+ARCHIVE_DIR = os.environ.get("E2E_ARCHIVE_DIR", os.path.join(MESSAGE_DIR, "archive"))
+
+# Database used by the SQLite backend
+SQLITE_PATH = os.environ.get("E2E_SQLITE_PATH", "messenger.db")
+
+# How often (seconds) the in-memory user directory checks storage for
+# users created by other processes
+USER_INDEX_POLL_SECONDS = float(os.environ.get("E2E_USER_INDEX_POLL_SECONDS", "2"))
+
+# Group commit (see group_commit.py): messages saved to the same inbox
+# within this many milliseconds share one append and one fsync (0 = only
+# combine messages that queue up behind a write in progress). Set
+# E2E_GROUP_COMMIT=0 to write every message on its own.
+GROUP_COMMIT_ENABLED = os.environ.get("E2E_GROUP_COMMIT", "1") == "1"
+GROUP_COMMIT_WINDOW_MS = float(os.environ.get("E2E_GROUP_COMMIT_WINDOW_MS", "2"))
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get("E2E_GROUP_COMMIT_MAX_BATCH", "256"))
+
+# How hard message writes wait for the disk (see durability.py):
+# "strict" (fsync every write), "batched" (fsync in the background every
+# DURABILITY_FSYNC_INTERVAL_MS) or "none" (leave it to the OS)
+DURABILITY = os.environ.get("E2E_DURABILITY", "strict")
+DURABILITY_FSYNC_INTERVAL_MS = float(os.environ.get("E2E_DURABILITY_FSYNC_INTERVAL_MS", "50"))
+
+# ============================================
+# RETENTION
+# ============================================
+
+# Default inbox retention policy (see retention.py): messages past these
+# limits are moved out of the inbox into archive segments. 0 = no limit.
+RETENTION_MAX_MESSAGES = int(os.environ.get("E2E_RETENTION_MAX_MESSAGES", "0"))
+RETENTION_MAX_AGE_DAYS = float(os.environ.get("E2E_RETENTION_MAX_AGE_DAYS", "0"))
+# Set to 1 to apply the limits to unread messages too (default: only
+# messages the user has already fetched are archived)
+RETENTION_INCLUDE_UNREAD = os.environ.get("E2E_RETENTION_INCLUDE_UNREAD", "0") == "1"
+# Per-user policies (written by `manage.py retention`)
+RETENTION_POLICY_FILE = os.environ.get("E2E_RETENTION_POLICY_FILE", "retention.json")
+# Seconds between compaction runs in the API servers (0 = never; run
+# `manage.py compact` from cron instead)
+COMPACTION_INTERVAL_SECONDS = float(os.environ.get("E2E_COMPACTION_INTERVAL_SECONDS", "0"))
+
+# ============================================
+# ENCRYPTION
+# ============================================
+
+# Number of parsed recipient public keys kept in memory (0 disables the cache)
+PUBLIC_KEY_CACHE_SIZE = int(os.environ.get("E2E_PUBLIC_KEY_CACHE_SIZE", "1024"))
+
+# Parallel inbox decryption (see decryption_pool.py)
+# "process" sidesteps the GIL; "thread" avoids the worker start-up cost
+DECRYPT_POOL_KIND = os.environ.get("E2E_DECRYPT_POOL_KIND", "process")
+# Pool size; 0 or 1 decrypts every inbox inline
+DECRYPT_WORKERS = int(os.environ.get("E2E_DECRYPT_WORKERS", str(os.cpu_count() or 1)))
+# Inboxes with fewer messages than this are decrypted inline
+DECRYPT_PARALLEL_THRESHOLD = int(os.environ.get("E2E_DECRYPT_PARALLEL_THRESHOLD", "64"))
+# Messages handed to a worker per task
+DECRYPT_CHUNK_SIZE = int(os.environ.get("E2E_DECRYPT_CHUNK_SIZE", "32"))
+
+# Per-conversation session keys (set E2E_SESSION_KEYS=1): a sender's AES
+# key for a recipient is RSA-wrapped once and reused, and stored messages
+# refer to it by key_id. Off by default; old messages always decrypt.
+SESSION_KEYS_ENABLED = os.environ.get("E2E_SESSION_KEYS", "0") == "1"
+# Rotate a conversation key after this many messages or seconds
+SESSION_KEY_MAX_MESSAGES = int(os.environ.get("E2E_SESSION_KEY_MAX_MESSAGES", "500"))
+SESSION_KEY_MAX_AGE_SECONDS = float(os.environ.get("E2E_SESSION_KEY_MAX_AGE_SECONDS", "3600"))
+# Conversation keys (sending side) and unwrapped keys (reading side) kept in memory
+SESSION_KEY_CACHE_SIZE = int(os.environ.get("E2E_SESSION_KEY_CACHE_SIZE", "1024"))
+
+# ============================================
+# SIGN UP
+# ============================================
+
+# RSA keypairs kept pre-generated for sign-up (0 disables the pool)
+KEYPOOL_SIZE = int(os.environ.get("E2E_KEYPOOL_SIZE", "8"))
+# Maximum keypairs the background thread generates per second
+KEYPOOL_REFILL_PER_SECOND = float(os.environ.get("E2E_KEYPOOL_REFILL_PER_SECOND", "2"))
+
+# Threads for password hashing / private key unlocking (see cpu_executor.py)
+AUTH_WORKERS = int(os.environ.get("E2E_AUTH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Auth tasks allowed to wait for a thread before logins get a fast 503
+AUTH_MAX_QUEUE = int(os.environ.get("E2E_AUTH_MAX_QUEUE", "16"))
+
+# ============================================
+# SESSIONS
+# ============================================
+
+# Login sessions (see sessions.py) expire after this many seconds without
+# a request, and this many seconds after login whatever happens (0 = never)
+SESSION_IDLE_TTL_SECONDS = float(os.environ.get("E2E_SESSION_IDLE_TTL_SECONDS", "1800"))
+SESSION_ABSOLUTE_TTL_SECONDS = float(os.environ.get("E2E_SESSION_ABSOLUTE_TTL_SECONDS", "43200"))
+# Most sessions kept; the least recently used is logged out first (0 = no limit)
+SESSION_MAX = int(os.environ.get("E2E_SESSION_MAX", "10000"))
+# Seconds between sweeps for expired sessions (0 = only on lookup)
+SESSION_SWEEP_INTERVAL_SECONDS = float(os.environ.get("E2E_SESSION_SWEEP_INTERVAL_SECONDS", "60"))
+# "memory" (this server process only) or "sqlite" (shared by every API
+# worker process on the machine through SESSION_DB_PATH)
+SESSION_STORE = os.environ.get("E2E_SESSION_STORE", "memory")
+SESSION_DB_PATH = os.environ.get("E2E_SESSION_DB_PATH", "sessions.db")
+# Encrypts the private keys held in the shared store; required for
+# "sqlite" and must be the same in every worker
+SESSION_SECRET = os.environ.get("E2E_SESSION_SECRET", "")
+
+# ============================================
+# API
+# ============================================
+
+# Worker processes started by serve.py (the multi-process api.py server)
+API_WORKERS = int(os.environ.get("E2E_API_WORKERS", str(os.cpu_count() or 1)))
+
+# Memory budget (bytes) for each login session's cache of decrypted messages
+SESSION_CACHE_MAX_BYTES = int(os.environ.get("E2E_SESSION_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))
+
+# Maximum number of recipients accepted by /api/send_bulk
+MAX_BULK_RECIPIENTS = int(os.environ.get("E2E_MAX_BULK_RECIPIENTS", "1000"))
+
+# /api/stream: seconds between keep-alive comments on an idle event
+# stream (each one also re-checks the inbox for writes made by other
+# processes), longest wait of a long-poll request, and most messages
+# sent in one event
+STREAM_HEARTBEAT_SECONDS = float(os.environ.get("E2E_STREAM_HEARTBEAT_SECONDS", "15"))
+STREAM_LONGPOLL_SECONDS = float(os.environ.get("E2E_STREAM_LONGPOLL_SECONDS", "25"))
+STREAM_BATCH_LIMIT = int(os.environ.get("E2E_STREAM_BATCH_LIMIT", "100"))
+# Seconds a stream ticket (/api/stream_ticket) can be used to open a stream
+STREAM_TICKET_SECONDS = float(os.environ.get("E2E_STREAM_TICKET_SECONDS", "60"))
+
+# Async server (asgi_api.py): threads for blocking storage calls and for
+# RSA/AES work, so neither runs on the event loop
+ASYNC_IO_THREADS = int(os.environ.get("E2E_ASYNC_IO_THREADS", "8"))
+ASYNC_CRYPTO_THREADS = int(os.environ.get("E2E_ASYNC_CRYPTO_THREADS", str(os.cpu_count() or 1)))
+
+# Timers and counters around the hot paths, served as Prometheus text on
+# /api/metrics (see metrics.py); E2E_METRICS=0 switches them off
+METRICS_ENABLED = os.environ.get("E2E_METRICS", "1") == "1"
+
+# Per-request profiling (see profiling.py): with E2E_PROFILING=1, api.py
+# requests sent with an X-Profile header or ?profile=1 are run under
+# cProfile. If PROFILING_TOKEN is set the header/parameter must equal it.
+PROFILING_ENABLED = os.environ.get("E2E_PROFILING", "0") == "1"
+PROFILING_TOKEN = os.environ.get("E2E_PROFILING_TOKEN", "")
+# Where profiles are written, and how many of the newest are kept
+PROFILE_DIR = os.environ.get("E2E_PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.environ.get("E2E_PROFILE_MAX_FILES", "50"))
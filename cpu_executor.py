@@ -0,0 +1,121 @@
+# cpu_executor.py
+# E2E Encrypted Messenger - Bounded Executor for CPU-Heavy Work
+#
+# Password hashing (600k PBKDF2 iterations) and unlocking a private key
+# (another KDF) take a long time each. Running them directly on the
+# request thread lets a handful of logins stall the whole API. The
+# BoundedExecutor runs them on a small thread pool (the KDFs release
+# the GIL) and rejects new work straight away once too much is queued,
+# instead of letting requests pile up.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutorOverloaded(Exception):
+    """Raised when the executor's queue is full; callers should retry later."""
+    pass
+
+
+class BoundedExecutor:
+    """
+    Thread pool with a cap on queued work and timing metrics.
+
+    Args:
+        name (str): Used for thread names and in stats
+        max_workers (int): Tasks running at once
+        max_queue (int): Tasks allowed to wait for a worker before
+            submit() raises ExecutorOverloaded
+    """
+
+    def __init__(self, name, max_workers, max_queue):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+        self._run_max = 0.0
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs).
+
+        Returns:
+            Future: Resolves to fn's return value
+
+        Raises:
+            ExecutorOverloaded: If max_workers + max_queue tasks are already in flight
+        """
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise ExecutorOverloaded(f"{self.name} executor is overloaded ({self._in_flight} tasks in flight)")
+            self._in_flight += 1
+
+        submitted_at = time.perf_counter()
+        try:
+            return self._executor.submit(self._run, submitted_at, fn, args, kwargs)
+        except BaseException:
+            with self._lock:
+                self._in_flight -= 1
+            raise
+
+    def run(self, fn, *args, **kwargs):
+        """Submit and wait for the result (raises ExecutorOverloaded or fn's exception)"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def _run(self, submitted_at, fn, args, kwargs):
+        started_at = time.perf_counter()
+        with self._lock:
+            self._running += 1
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            finished_at = time.perf_counter()
+            waited = started_at - submitted_at
+            ran = finished_at - started_at
+            with self._lock:
+                self._running -= 1
+                self._in_flight -= 1
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+                self._run_total += ran
+                self._run_max = max(self._run_max, ran)
+
+    def stats(self):
+        """Queue depth, counters and timing (milliseconds) for monitoring"""
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                'name': self.name,
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'running': self._running,
+                'queued': self._in_flight - self._running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'avg_wait_ms': round(1000 * self._wait_total / finished, 2) if finished else 0.0,
+                'max_wait_ms': round(1000 * self._wait_max, 2),
+                'avg_run_ms': round(1000 * self._run_total / finished, 2) if finished else 0.0,
+                'max_run_ms': round(1000 * self._run_max, 2),
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,267 @@
+# decryption_pool.py
+# E2E Encrypted Messenger - Parallel Inbox Decryption
+#
+# Decrypting a message costs one RSA-2048 OAEP private-key operation
+# (plus a cheap AES-GCM decrypt), so big inboxes are CPU bound. The
+# InboxDecryptor spreads that work over a concurrent.futures pool and
+# hands results back in inbox order. Small inboxes are still decrypted
+# inline - starting work in a pool costs more than it saves.
+#
+# Process pools use the "spawn" start method, so scripts that decrypt
+# large inboxes need the usual `if __name__ == "__main__":` guard
+# (api.py and main.py already have one).
+
+import hashlib
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.backends import default_backend
+
+import config
+from encryption import decrypt_message, DecryptionError, SessionKeyCache
+from message_storage import message_id
+from sessions import DecryptedMessageCache
+
+
+def encrypted_content(msg):
+    """Pick the fields decrypt_message needs out of a stored message"""
+    content = {
+        'encrypted_message': msg['encrypted_message'],
+        'encrypted_key': msg['encrypted_key'],
+        'nonce': msg['nonce']
+    }
+    if msg.get('key_id'):
+        content['key_id'] = msg['key_id']
+    return content
+
+
+def _decrypt_one(msg, private_key, session_keys=None):
+    """Decrypt one stored message; failures come back as DecryptionError instances"""
+    try:
+        return decrypt_message(encrypted_content(msg), private_key, session_keys)
+    except DecryptionError as e:
+        return e
+    except Exception as e:
+        # e.g. a stored record with missing fields
+        error = DecryptionError("Failed to decrypt message")
+        error.__cause__ = e
+        return error
+
+
+# ============================================
+# PROCESS WORKERS
+# ============================================
+#
+# Key objects can't be pickled, so process workers receive the private
+# key as unencrypted PKCS8 DER bytes (over a local pipe, never to disk)
+# and keep a few parsed keys around so each chunk doesn't re-parse it.
+# Each parsed key comes with its own cache of unwrapped conversation keys.
+
+_worker_keys = {}
+_WORKER_KEY_CACHE_SIZE = 8
+
+
+def _worker_private_key(key_der):
+    digest = hashlib.sha256(key_der).digest()
+    entry = _worker_keys.get(digest)
+    if entry is None:
+        private_key = serialization.load_der_private_key(key_der, password=None, backend=default_backend())
+        if len(_worker_keys) >= _WORKER_KEY_CACHE_SIZE:
+            _worker_keys.clear()
+        entry = _worker_keys[digest] = (private_key, SessionKeyCache())
+    return entry
+
+
+def _decrypt_chunk_in_worker(key_der, messages):
+    """Runs in a worker process. Returns (ok, text or error message) pairs."""
+    private_key, session_keys = _worker_private_key(key_der)
+    results = []
+    for msg in messages:
+        result = _decrypt_one(msg, private_key, session_keys)
+        if isinstance(result, DecryptionError):
+            results.append((False, str(result)))
+        else:
+            results.append((True, result))
+    return results
+
+
+def _decrypt_chunk_in_thread(private_key, messages, session_keys):
+    return [_decrypt_one(msg, private_key, session_keys) for msg in messages]
+
+
+# ============================================
+# DECRYPTOR
+# ============================================
+
+class InboxDecryptor:
+    """
+    Decrypts lists of stored messages, in parallel when it's worth it.
+
+    Args:
+        kind (str): "process" or "thread" pool
+        workers (int): Pool size; 0 or 1 means always decrypt inline
+        threshold (int): Inboxes smaller than this are decrypted inline
+        chunk_size (int): Messages per pool task
+    """
+
+    def __init__(self, kind=None, workers=None, threshold=None, chunk_size=None):
+        self.kind = kind or config.DECRYPT_POOL_KIND
+        if self.kind not in ("process", "thread"):
+            raise ValueError(f"Unknown decryption pool kind {self.kind!r}; choose 'process' or 'thread'")
+        self.workers = config.DECRYPT_WORKERS if workers is None else workers
+        self.threshold = config.DECRYPT_PARALLEL_THRESHOLD if threshold is None else threshold
+        self.chunk_size = max(1, config.DECRYPT_CHUNK_SIZE if chunk_size is None else chunk_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.kind == "process":
+                    # spawn, not fork: the API server has threads running
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn")
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers,
+                        thread_name_prefix="decrypt"
+                    )
+            return self._executor
+
+    def _parallel(self, count):
+        return self.workers > 1 and count >= self.threshold
+
+    def decrypt_all(self, messages, private_key, session_keys=None):
+        """
+        Decrypt stored messages with a private key.
+
+        Args:
+            messages (list): Stored message dicts (from message_storage)
+            private_key: The recipient's private key object
+            session_keys (SessionKeyCache): Unwrapped conversation keys for
+                this private key (a fresh one per call if None; process
+                workers keep their own)
+
+        Returns:
+            list: One entry per message, in the same order - the plaintext
+                str, or a DecryptionError instance if that message failed
+        """
+        messages = list(messages)
+        if session_keys is None:
+            session_keys = SessionKeyCache()
+        if not self._parallel(len(messages)):
+            return [_decrypt_one(msg, private_key, session_keys) for msg in messages]
+
+        chunks = [messages[i:i + self.chunk_size] for i in range(0, len(messages), self.chunk_size)]
+        executor = self._get_executor()
+
+        if self.kind == "thread":
+            futures = [executor.submit(_decrypt_chunk_in_thread, private_key, chunk, session_keys) for chunk in chunks]
+            results = []
+            for future in futures:
+                results.extend(future.result())
+            return results
+
+        key_der = private_key.private_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        futures = [executor.submit(_decrypt_chunk_in_worker, key_der, chunk) for chunk in chunks]
+        results = []
+        for future in futures:
+            for ok, value in future.result():
+                results.append(value if ok else DecryptionError(value))
+        return results
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+_decryptor = None
+_decryptor_lock = threading.Lock()
+
+
+def get_decryptor():
+    """Return the process-wide InboxDecryptor configured from config.py"""
+    global _decryptor
+    if _decryptor is None:
+        with _decryptor_lock:
+            if _decryptor is None:
+                _decryptor = InboxDecryptor()
+    return _decryptor
+
+
+def decrypt_messages(messages, private_key, cache=None, session_keys=None):
+    """
+    Decrypt stored messages in order (see InboxDecryptor.decrypt_all).
+
+    Args:
+        cache (DecryptedMessageCache): Optional per-session cache; only
+            messages missing from it are decrypted, and results are added
+        session_keys (SessionKeyCache): Optional per-session cache of
+            unwrapped conversation keys
+    """
+    if cache is None:
+        return get_decryptor().decrypt_all(messages, private_key, session_keys)
+
+    messages = list(messages)
+    ids = [message_id(msg) for msg in messages]
+    results = [cache.get(mid) for mid in ids]
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        decrypted = get_decryptor().decrypt_all([messages[i] for i in missing], private_key, session_keys)
+        for i, result in zip(missing, decrypted):
+            results[i] = result
+            cache.put(ids[i], DecryptedMessageCache.FAILED if isinstance(result, DecryptionError) else result)
+
+    for i, result in enumerate(results):
+        if result is DecryptedMessageCache.FAILED:
+            results[i] = DecryptionError("Failed to decrypt message")
+    return results
+
+
+def iter_decrypted_batches(records, private_key, cache=None, session_keys=None):
+    """
+    Decrypt a stream of stored messages as it is consumed, in order.
+
+    The first batch is a single message, so a caller that forwards
+    results (a streamed HTTP response) can send something straight away;
+    batches then double until they are big enough to keep the pool busy.
+
+    Args:
+        records: Iterable of (tag, message dict) pairs - the tag (e.g. the
+            inbox sequence number) is passed through untouched
+        cache, session_keys: As for decrypt_messages
+
+    Yields:
+        list: (tag, message, plaintext str or DecryptionError) triples
+    """
+    if session_keys is None:
+        session_keys = SessionKeyCache()
+    decryptor = get_decryptor()
+    max_batch = max(decryptor.threshold, decryptor.chunk_size * max(1, decryptor.workers))
+
+    batch_size = 1
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield _decrypt_batch(batch, private_key, cache, session_keys)
+            batch = []
+            batch_size = min(batch_size * 2, max_batch)
+    if batch:
+        yield _decrypt_batch(batch, private_key, cache, session_keys)
+
+
+def _decrypt_batch(batch, private_key, cache, session_keys):
+    results = decrypt_messages([msg for _, msg in batch], private_key, cache, session_keys)
+    return [(tag, msg, result) for (tag, msg), result in zip(batch, results)]
@@ -0,0 +1,148 @@
+# durability.py
+# E2E Encrypted Messenger - Write Durability Levels
+#
+# How long a stored message waits for the disk is a trade-off between
+# throughput and what a crash (of the machine, not just the process) can
+# lose. config.DURABILITY picks one of:
+#   strict  - every write is fsynced before save_message returns, so a
+#             message the API accepted survives power loss (the default)
+#   batched - writes return once the OS has them; the fsync scheduler
+#             below syncs everything written in the last
+#             DURABILITY_FSYNC_INTERVAL_MS milliseconds in one go, so a
+#             crash loses at most about that much
+#   none    - nothing is fsynced; the OS writes data back when it likes
+#             (usually within ~30s on Linux)
+# A process that merely crashes loses nothing at any level: the data is
+# already in the OS page cache.
+#
+# Files rewritten as a whole (compaction, migrations, inbox upgrades)
+# are always fsynced before they replace the original, whatever the
+# level, since a crash there could otherwise lose the whole inbox.
+
+import atexit
+import os
+import threading
+import time
+
+import config
+from metrics import Histogram, LATENCY_BUCKETS_MS
+
+DURABILITY_LEVELS = ("strict", "batched", "none")
+
+
+def check_level(level):
+    """Return `level` if it is a known durability level, else raise ValueError"""
+    if level not in DURABILITY_LEVELS:
+        raise ValueError(f"Unknown durability level {level!r}; choose one of: {', '.join(DURABILITY_LEVELS)}")
+    return level
+
+
+def _fsync_path(path):
+    # Windows can only fsync a handle opened for writing
+    fd = os.open(path, os.O_RDWR if os.name == 'nt' else os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FsyncScheduler:
+    """
+    Deferred fsyncs for the "batched" level: writers mark what they have
+    written as dirty, and a daemon thread syncs it all every `interval_ms`.
+
+    Args:
+        interval_ms (float): Milliseconds between syncs
+    """
+
+    def __init__(self, interval_ms=None):
+        self.interval = (config.DURABILITY_FSYNC_INTERVAL_MS if interval_ms is None else interval_ms) / 1000.0
+        self._lock = threading.Lock()
+        self._dirty = {}
+        self._thread = None
+        self.flushes = 0
+        self.synced = 0
+        self.errors = 0
+        # How long written data waited for its fsync
+        self.lag_ms = Histogram(LATENCY_BUCKETS_MS)
+
+    def mark_dirty(self, key, sync=None):
+        """
+        Schedule a sync.
+
+        Args:
+            key (str): What was written (a file path by default); marking
+                it again before the next flush costs nothing
+            sync (callable): Called with no arguments to sync it; defaults
+                to fsyncing the file at `key`
+        """
+        with self._lock:
+            if key not in self._dirty:
+                self._dirty[key] = (time.monotonic(), sync)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run_loop, name="fsync-scheduler", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Sync everything marked dirty so far. Returns how many items were synced."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+
+        now = time.monotonic()
+        # Conversation keys before the messages that need them
+        ordered = sorted(dirty.items(), key=lambda item: not item[0].endswith(".keys"))
+        synced = errors = 0
+        for key, (since, sync) in ordered:
+            try:
+                if sync is None:
+                    _fsync_path(key)
+                else:
+                    sync()
+                synced += 1
+            except FileNotFoundError:
+                # Replaced (and fsynced) or removed since it was written
+                pass
+            except Exception:
+                errors += 1
+            self.lag_ms.observe((now - since) * 1000.0)
+
+        with self._lock:
+            self.flushes += 1
+            self.synced += synced
+            self.errors += errors
+        return synced
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'interval_ms': self.interval * 1000.0,
+                'pending': len(self._dirty),
+                'flushes': self.flushes,
+                'synced': self.synced,
+                'errors': self.errors,
+            }
+        stats['lag_ms'] = self.lag_ms.snapshot()
+        return stats
+
+
+# Shared by every storage backend in this process
+fsync_scheduler = FsyncScheduler()
+
+
+def sync_written(f, level):
+    """
+    Make what was just written to the open file `f` as durable as
+    `level` asks for. Call after f.flush().
+    """
+    if level == "strict":
+        os.fsync(f.fileno())
+    elif level == "batched":
+        fsync_scheduler.mark_dirty(f.name)
@@ -4,10 +4,18 @@
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
 from cryptography.hazmat.backends import default_backend
+from collections import OrderedDict
 import os
 import base64
+import hashlib
 import logging
+import threading
+import time
+
+import config
+from metrics import timed, timer
 
 # Module logger and specific exceptions for callers to catch
 logger = logging.getLogger(__name__)
@@ -22,22 +30,259 @@ class DecryptionError(Exception):
     """Raised when decryption fails."""
     pass
 
+
+# ============================================
+# PUBLIC KEY CACHE
+# ============================================
+
+class PublicKeyCache:
+    """
+    Bounded LRU cache of parsed RSA public keys.
+
+    Entries are keyed by (username, SHA-256 of the PEM), so a user whose
+    key changes simply misses and gets the new key parsed.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = config.PUBLIC_KEY_CACHE_SIZE if max_size is None else max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(pem):
+        return hashlib.sha256(pem.encode('utf-8')).hexdigest()
+
+    def get(self, pem, username=None):
+        """Return the RSAPublicKey for a PEM string, parsing it only on a miss"""
+        cache_key = (username, self.fingerprint(pem))
+
+        with self._lock:
+            public_key = self._keys.get(cache_key)
+            if public_key is not None:
+                self._keys.move_to_end(cache_key)
+                self.hits += 1
+                return public_key
+            self.misses += 1
+
+        public_key = serialization.load_pem_public_key(
+            pem.encode('utf-8'),
+            backend=default_backend()
+        )
+
+        if self.max_size > 0:
+            with self._lock:
+                self._keys[cache_key] = public_key
+                self._keys.move_to_end(cache_key)
+                while len(self._keys) > self.max_size:
+                    self._keys.popitem(last=False)
+        return public_key
+
+    def invalidate(self, username=None):
+        """Forget one user's cached keys (or every key if username is None)"""
+        with self._lock:
+            if username is None:
+                self._keys.clear()
+                return
+            for cache_key in [k for k in self._keys if k[0] == username]:
+                del self._keys[cache_key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._keys),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+public_key_cache = PublicKeyCache()
+
+
+def load_public_key(public_key_pem, username=None):
+    """Parse a PEM public key through the shared LRU cache"""
+    return public_key_cache.get(public_key_pem, username)
+
+
+def invalidate_public_key(username):
+    """Drop cached keys for a user whose stored public key changed"""
+    public_key_cache.invalidate(username)
+
+
+def _oaep():
+    return padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+        algorithm=hashes.SHA256(),
+        label=None
+    )
+
+# ============================================
+# CONVERSATION (SESSION) KEYS
+# ============================================
+#
+# In session-key mode a sender reuses one AES-256 key per recipient
+# instead of a fresh one per message, so the RSA-OAEP wrap happens once
+# per conversation key rather than once per message. Messages name the
+# key with a random key_id; storage keeps the wrapped key once per
+# key_id (see message_storage.save_message) and hands it back with each
+# message on read. Readers unwrap each key once and cache it
+# (SessionKeyCache). Every message still has its own random nonce.
+
+
+class ConversationKey:
+    """One AES key shared by a sender's messages to one recipient"""
+
+    def __init__(self, aes_key, encrypted_key):
+        self.key_id = os.urandom(16).hex()
+        self.aesgcm = AESGCM(aes_key)
+        self.encrypted_key = encrypted_key  # base64, RSA-wrapped for the recipient
+        self.created = time.monotonic()
+        self.messages = 0
+
+
+class ConversationKeyCache:
+    """
+    Sending side: bounded LRU of conversation keys keyed by (sender,
+    recipient, recipient key fingerprint). A key is rotated once it has
+    been used for max_messages messages or is older than max_age seconds.
+    """
+
+    def __init__(self, max_size=None, max_messages=None, max_age=None):
+        self.max_size = config.SESSION_KEY_CACHE_SIZE if max_size is None else max_size
+        self.max_messages = config.SESSION_KEY_MAX_MESSAGES if max_messages is None else max_messages
+        self.max_age = config.SESSION_KEY_MAX_AGE_SECONDS if max_age is None else max_age
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.reused = 0
+        self.created = 0
+        self.rotated = 0
+
+    def _usable(self, key):
+        return key.messages < self.max_messages and time.monotonic() - key.created < self.max_age
+
+    def next_key(self, sender, recipient, public_key):
+        """Return the ConversationKey to encrypt the next message with"""
+        fingerprint = hashlib.sha256(public_key.public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )).digest()
+        cache_key = (sender, recipient, fingerprint)
+
+        with self._lock:
+            key = self._keys.get(cache_key)
+            if key is not None and self._usable(key):
+                key.messages += 1
+                self._keys.move_to_end(cache_key)
+                self.reused += 1
+                return key
+            if key is not None:
+                self.rotated += 1
+
+        # New or rotated key: the only RSA operation for this conversation
+        aes_key = AESGCM.generate_key(bit_length=256)
+        encrypted_key = base64.b64encode(public_key.encrypt(aes_key, _oaep())).decode('utf-8')
+        key = ConversationKey(aes_key, encrypted_key)
+        key.messages = 1
+
+        with self._lock:
+            self.created += 1
+            if self.max_size > 0:
+                self._keys[cache_key] = key
+                self._keys.move_to_end(cache_key)
+                while len(self._keys) > self.max_size:
+                    self._keys.popitem(last=False)
+        return key
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._keys),
+                'max_size': self.max_size,
+                'reused': self.reused,
+                'created': self.created,
+                'rotated': self.rotated,
+            }
+
+
+conversation_keys = ConversationKeyCache()
+
+
+class SessionKeyCache:
+    """
+    Reading side: bounded LRU of unwrapped conversation keys, keyed by
+    the wrapped key itself. Use one cache per private key (e.g. per
+    login session) - a wrapped key only unwraps with its own private key.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = config.SESSION_KEY_CACHE_SIZE if max_size is None else max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def unwrap(self, encrypted_key, private_key):
+        """Return an AESGCM for a base64 wrapped key, doing the RSA decrypt only on a miss"""
+        with self._lock:
+            aesgcm = self._keys.get(encrypted_key)
+            if aesgcm is not None:
+                self._keys.move_to_end(encrypted_key)
+                self.hits += 1
+                return aesgcm
+            self.misses += 1
+
+        aesgcm = AESGCM(private_key.decrypt(base64.b64decode(encrypted_key), _oaep()))
+
+        if self.max_size > 0:
+            with self._lock:
+                self._keys[encrypted_key] = aesgcm
+                while len(self._keys) > self.max_size:
+                    self._keys.popitem(last=False)
+        return aesgcm
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._keys),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
 # ============================================
 # MESSAGE ENCRYPTION (SENDING)
 # ============================================
 
-def encrypt_message(message, recipient_public_key):
+_encrypt_time = timer("e2e_encrypt_message_seconds", "encrypt_message() calls")
+
+
+@timed(_encrypt_time)
+def encrypt_message(message, recipient_public_key, recipient=None, sender=None):
     """
     Encrypt a message for the recipient.
     Uses hybrid encryption (AES-GCM + RSA).
     
     Args:
         message (str): The plaintext message to encrypt
-        recipient_public_key (str): Recipient's public key in PEM format (from Users.json)
+        recipient_public_key (str or RSAPublicKey): Recipient's public key in PEM
+            format (from their user data), or an already loaded key object
+        recipient (str): Recipient's username, used as the key cache key
+        sender (str): Sender's username; with config.SESSION_KEYS_ENABLED the
+            sender's conversation key for this recipient is reused
     
     Returns:
-        dict: Contains encrypted_message, encrypted_key, and nonce (all base64 encoded)
+        dict: Contains encrypted_message, encrypted_key, and nonce (all base64
+            encoded), plus key_id when a conversation key was used
     """
+    if sender is not None and recipient is not None and config.SESSION_KEYS_ENABLED:
+        return _encrypt_with_conversation_key(message, recipient_public_key, sender, recipient)
+
     try:
         # Step 1: Generate a random AES key (32 bytes = 256 bits)
         aes_key = AESGCM.generate_key(bit_length=256)
@@ -50,11 +295,11 @@ def encrypt_message(message, recipient_public_key):
         message_bytes = message.encode('utf-8')
         encrypted_message = aesgcm.encrypt(nonce, message_bytes, None)
         
-        # Step 4: Load recipient's public key (it's already in PEM format from auth.py)
-        public_key = serialization.load_pem_public_key(
-            recipient_public_key.encode('utf-8'),
-            backend=default_backend()
-        )
+        # Step 4: Load recipient's public key (parsed PEMs are cached)
+        if isinstance(recipient_public_key, RSAPublicKey):
+            public_key = recipient_public_key
+        else:
+            public_key = load_public_key(recipient_public_key, recipient)
         
         # Step 5: Encrypt the AES key with recipient's RSA public key
         encrypted_aes_key = public_key.encrypt(
@@ -80,41 +325,128 @@ def encrypt_message(message, recipient_public_key):
         raise EncryptionError("Failed to encrypt message") from e
 
 
+def _encrypt_with_conversation_key(message, recipient_public_key, sender, recipient):
+    try:
+        if isinstance(recipient_public_key, RSAPublicKey):
+            public_key = recipient_public_key
+        else:
+            public_key = load_public_key(recipient_public_key, recipient)
+
+        key = conversation_keys.next_key(sender, recipient, public_key)
+        nonce = os.urandom(12)
+        encrypted_message = key.aesgcm.encrypt(nonce, message.encode('utf-8'), None)
+
+        # The wrapped key rides along so storage can record it the first
+        # time it sees this key_id; stored messages only keep the key_id
+        return {
+            'encrypted_message': base64.b64encode(encrypted_message).decode('utf-8'),
+            'encrypted_key': key.encrypted_key,
+            'nonce': base64.b64encode(nonce).decode('utf-8'),
+            'key_id': key.key_id
+        }
+
+    except Exception as e:
+        logger.exception("Failed to encrypt message with conversation key")
+        raise EncryptionError("Failed to encrypt message") from e
+
+
+def encrypt_message_multi(message, recipient_public_keys, recipients=None):
+    """
+    Encrypt one message for many recipients.
+
+    The message is AES-GCM encrypted once; only the AES key is wrapped
+    separately with each recipient's RSA key. Every returned dict has
+    the same shape as encrypt_message's result, so recipients decrypt
+    it with decrypt_message as usual.
+    
+    Args:
+        message (str): The plaintext message to encrypt
+        recipient_public_keys (list): PEM strings or RSAPublicKey objects
+        recipients (list): Matching usernames, used as key cache keys (optional)
+    
+    Returns:
+        list: One dict per public key, in the same order
+    """
+    if recipients is not None and len(recipients) != len(recipient_public_keys):
+        raise EncryptionError("recipients and recipient_public_keys must have the same length")
+
+    try:
+        aes_key = AESGCM.generate_key(bit_length=256)
+        nonce = os.urandom(12)
+        encrypted_message = AESGCM(aes_key).encrypt(nonce, message.encode('utf-8'), None)
+
+        encrypted_message_b64 = base64.b64encode(encrypted_message).decode('utf-8')
+        nonce_b64 = base64.b64encode(nonce).decode('utf-8')
+        oaep = padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        )
+
+        results = []
+        for i, recipient_public_key in enumerate(recipient_public_keys):
+            if isinstance(recipient_public_key, RSAPublicKey):
+                public_key = recipient_public_key
+            else:
+                username = recipients[i] if recipients is not None else None
+                public_key = load_public_key(recipient_public_key, username)
+
+            results.append({
+                'encrypted_message': encrypted_message_b64,
+                'encrypted_key': base64.b64encode(public_key.encrypt(aes_key, oaep)).decode('utf-8'),
+                'nonce': nonce_b64
+            })
+        return results
+
+    except Exception as e:
+        logger.exception("Failed to encrypt message for multiple recipients")
+        raise EncryptionError("Failed to encrypt message for multiple recipients") from e
+
+
 # ============================================
 # MESSAGE DECRYPTION (RECEIVING)
 # ============================================
 
-def decrypt_message(encrypted_content, my_private_key):
+_decrypt_time = timer("e2e_decrypt_message_seconds", "decrypt_message() calls")
+# RSA unwrap of the AES key (or a session key cache lookup) vs. AES-GCM
+_decrypt_phase = timer("e2e_decrypt_phase_seconds", "Time spent in each step of decrypt_message()", label="phase")
+_UNWRAP = _decrypt_phase.labels("rsa_unwrap")
+_AES_GCM = _decrypt_phase.labels("aes_gcm")
+
+
+@timed(_decrypt_time)
+def decrypt_message(encrypted_content, my_private_key, session_keys=None):
     """
     Decrypt a message with your private key.
     
     Args:
         encrypted_content (dict): Contains encrypted_message, encrypted_key, and nonce
+            (and key_id for messages sent with a conversation key)
         my_private_key: Your private key object (from auth.py Load_private_key)
+        session_keys (SessionKeyCache): Optional cache of unwrapped conversation
+            keys, so messages sharing a key_id cost one RSA decrypt in total
     
     Returns:
         str: The decrypted plaintext message
     """
     try:
         # Step 1: Decode from base64
-        encrypted_aes_key = base64.b64decode(encrypted_content['encrypted_key'])
         encrypted_message = base64.b64decode(encrypted_content['encrypted_message'])
         nonce = base64.b64decode(encrypted_content['nonce'])
         
         # Step 2: Decrypt the AES key with your RSA private key
         # my_private_key is already a key object from auth.py
-        aes_key = my_private_key.decrypt(
-            encrypted_aes_key,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+        with _UNWRAP.time():
+            if session_keys is not None and encrypted_content.get('key_id'):
+                aesgcm = session_keys.unwrap(encrypted_content['encrypted_key'], my_private_key)
+            else:
+                encrypted_aes_key = base64.b64decode(encrypted_content['encrypted_key'])
+                aes_key = my_private_key.decrypt(encrypted_aes_key, _oaep())
+                aesgcm = AESGCM(aes_key)
         
         # Step 3: Decrypt the message with the AES key
-        aesgcm = AESGCM(aes_key)
-        decrypted_message = aesgcm.decrypt(nonce, encrypted_message, None)
+        with _AES_GCM.time():
+            decrypted_message = aesgcm.decrypt(nonce, encrypted_message, None)
         
         # Step 4: Convert bytes back to string
         return decrypted_message.decode('utf-8')
@@ -0,0 +1,222 @@
+# envelope.py
+# E2E Encrypted Messenger - Binary Message Envelope
+#
+# Stored messages used to be JSON with three base64 strings in them.
+# The envelope keeps the same fields as raw bytes behind a small fixed
+# header, which saves about a third of the space and most of the parsing:
+#
+#   offset  size  field
+#        0     4  magic b"E2EM"
+#        4     1  envelope version (1)
+#        5     1  flags (FLAG_KEY_ID)
+#        6     1  nonce length
+#        7     1  reserved (0)
+#        8     8  timestamp, microseconds since 1970-01-01 (signed)
+#       16     2  wrapped key length (0 for conversation-key messages)
+#       18     4  ciphertext length
+#       22     1  from_user length
+#       23     1  to_user length
+#       24     4  extra JSON length
+#   then: from_user, to_user, nonce, key_id (16 bytes, if FLAG_KEY_ID),
+#         wrapped key, ciphertext, extra JSON (any other package fields)
+#
+# Records that don't start with the magic are legacy JSON objects, so
+# readers accept both (see decode_record). MessageEnvelope reads fields
+# as memoryview slices of the buffer it was given, without copying.
+
+import base64
+import binascii
+import json
+import struct
+from datetime import datetime, timedelta, timezone
+
+MAGIC = b"E2EM"
+ENVELOPE_VERSION = 1
+
+FLAG_KEY_ID = 0x01
+
+KEY_ID_SIZE = 16
+
+_HEADER = struct.Struct('<4sBBBBqHIBBI')
+
+# Package fields that have a place in the header/body; anything else
+# goes into the extra JSON
+_CORE_FIELDS = ('from_user', 'to_user', 'encrypted_message', 'encrypted_key', 'nonce', 'timestamp', 'key_id')
+
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_UTC = _EPOCH.replace(tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _raw_base64(value, field):
+    raw = base64.b64decode(value, validate=True)
+    # Only store what re-encodes to exactly the same string
+    if base64.b64encode(raw).decode('ascii') != value:
+        raise ValueError(f"{field} is not canonical base64")
+    return raw
+
+
+def _timestamp_micros(timestamp):
+    """
+    Returns:
+        tuple: (microseconds, True if isoformat() of it gives back the same string)
+    """
+    dt = datetime.fromisoformat(timestamp)
+    if dt.tzinfo is not None:
+        # The instant is kept; the original string (with its offset) goes in the extras
+        return (dt - _EPOCH_UTC) // _MICROSECOND, False
+    micros = (dt - _EPOCH) // _MICROSECOND
+    return micros, _iso_from_micros(micros) == timestamp
+
+
+def _iso_from_micros(micros):
+    return (_EPOCH + micros * _MICROSECOND).isoformat()
+
+
+def encode_envelope(message_package):
+    """
+    Pack a message package into a binary envelope.
+
+    Raises:
+        ValueError: If the package can't be stored losslessly as an envelope
+            (non-canonical base64, very long usernames, ...)
+    """
+    try:
+        from_user = message_package['from_user'].encode('utf-8')
+        to_user = message_package['to_user'].encode('utf-8')
+        nonce = _raw_base64(message_package['nonce'], 'nonce')
+        ciphertext = _raw_base64(message_package['encrypted_message'], 'encrypted_message')
+        wrapped_key = b""
+        if 'encrypted_key' in message_package:
+            wrapped_key = _raw_base64(message_package['encrypted_key'], 'encrypted_key')
+            if not wrapped_key:
+                raise ValueError("encrypted_key is empty")
+        micros, exact = _timestamp_micros(message_package['timestamp'])
+    except (KeyError, TypeError, AttributeError, binascii.Error) as e:
+        raise ValueError(f"message can't be packed: {e}") from e
+
+    flags = 0
+    key_id = b""
+    if message_package.get('key_id') is not None:
+        key_id = bytes.fromhex(message_package['key_id'])
+        if len(key_id) != KEY_ID_SIZE:
+            raise ValueError("key_id must be 16 bytes")
+        flags |= FLAG_KEY_ID
+    elif not wrapped_key:
+        raise ValueError("message has neither encrypted_key nor key_id")
+
+    extra = {k: v for k, v in message_package.items() if k not in _CORE_FIELDS}
+    if not exact:
+        extra['timestamp'] = message_package['timestamp']
+    extra_json = json.dumps(extra, separators=(',', ':')).encode('utf-8') if extra else b""
+
+    if len(from_user) > 0xFF or len(to_user) > 0xFF or len(nonce) > 0xFF or len(wrapped_key) > 0xFFFF:
+        raise ValueError("message field too long for an envelope")
+
+    header = _HEADER.pack(
+        MAGIC, ENVELOPE_VERSION, flags, len(nonce), 0, micros,
+        len(wrapped_key), len(ciphertext), len(from_user), len(to_user), len(extra_json)
+    )
+    return b"".join((header, from_user, to_user, nonce, key_id, wrapped_key, ciphertext, extra_json))
+
+
+def is_envelope(buffer):
+    return bytes(buffer[:len(MAGIC)]) == MAGIC
+
+
+class MessageEnvelope:
+    """
+    Read-only view of one envelope inside a buffer (bytes, bytearray,
+    mmap, ...). nonce, key_id, encrypted_key and ciphertext are
+    memoryview slices of that buffer - nothing is copied until
+    to_package() base64-encodes them.
+    """
+
+    __slots__ = ('from_user', 'to_user', 'timestamp_micros', 'nonce', 'key_id',
+                 'encrypted_key', 'ciphertext', '_extra', 'size')
+
+    def __init__(self, buffer, offset=0):
+        view = memoryview(buffer)
+        try:
+            (magic, version, flags, nonce_len, _, micros, key_len, ciphertext_len,
+             from_len, to_len, extra_len) = _HEADER.unpack_from(view, offset)
+        except struct.error:
+            raise ValueError("truncated message envelope")
+        if magic != MAGIC:
+            raise ValueError("not a message envelope")
+        if version != ENVELOPE_VERSION:
+            raise ValueError(f"unsupported message envelope version {version}")
+
+        key_id_len = KEY_ID_SIZE if flags & FLAG_KEY_ID else 0
+        pos = offset + _HEADER.size
+        end = pos + from_len + to_len + nonce_len + key_id_len + key_len + ciphertext_len + extra_len
+        if end > len(view):
+            raise ValueError("truncated message envelope")
+
+        def take(n):
+            nonlocal pos
+            part = view[pos:pos + n]
+            pos += n
+            return part
+
+        self.from_user = str(take(from_len), 'utf-8')
+        self.to_user = str(take(to_len), 'utf-8')
+        self.nonce = take(nonce_len)
+        self.key_id = take(key_id_len) if key_id_len else None
+        self.encrypted_key = take(key_len) if key_len else None
+        self.ciphertext = take(ciphertext_len)
+        self._extra = take(extra_len)
+        self.timestamp_micros = micros
+        self.size = end - offset
+
+    @property
+    def timestamp(self):
+        """ISO-8601 timestamp string, exactly as it was sent"""
+        return self.extra().get('timestamp') or _iso_from_micros(self.timestamp_micros)
+
+    def extra(self):
+        return json.loads(bytes(self._extra)) if len(self._extra) else {}
+
+    def to_package(self):
+        """The message as the dict of base64 strings the rest of the app uses"""
+        package = {
+            'from_user': self.from_user,
+            'to_user': self.to_user,
+            'encrypted_message': base64.b64encode(self.ciphertext).decode('ascii'),
+            'nonce': base64.b64encode(self.nonce).decode('ascii'),
+        }
+        if self.encrypted_key is not None:
+            package['encrypted_key'] = base64.b64encode(self.encrypted_key).decode('ascii')
+        if self.key_id is not None:
+            package['key_id'] = self.key_id.hex()
+        extra = self.extra()
+        package['timestamp'] = extra.pop('timestamp', None) or _iso_from_micros(self.timestamp_micros)
+        package.update(extra)
+        return package
+
+
+# ============================================
+# RECORDS (ENVELOPE OR LEGACY JSON)
+# ============================================
+
+def encode_record(message_package):
+    """Envelope bytes, or compact JSON for a package that doesn't fit one"""
+    try:
+        return encode_envelope(message_package)
+    except ValueError:
+        return json.dumps(message_package, separators=(',', ':')).encode('utf-8')
+
+
+def decode_record(data):
+    """
+    Turn a stored record back into a message package, detecting the
+    format: binary envelope or (legacy) JSON text/bytes.
+
+    Raises:
+        ValueError: If the record is neither
+    """
+    if isinstance(data, str):
+        return json.loads(data)
+    if is_envelope(data):
+        return MessageEnvelope(data).to_package()
+    return json.loads(bytes(data) if isinstance(data, memoryview) else data)
@@ -0,0 +1,162 @@
+# group_commit.py
+# E2E Encrypted Messenger - Group Commit for Message Writes
+#
+# Every stored message costs an fsync, and writes to one inbox are
+# serialized by its lock, so many people messaging one popular user at
+# once queue up behind each other's fsyncs. The GroupCommitter combines
+# them: the first save_message for an inbox becomes the batch "leader"
+# and appends the whole batch with one write and one fsync. Messages
+# that arrive while a batch is being written join the next one, whose
+# leader waits a few milliseconds for more (and for the previous batch
+# to finish writing). Everyone in the batch returns only once that
+# write is durable - or raises the error it failed with.
+#
+# A writer with nothing else in flight for its inbox never waits, so
+# group commit adds no latency to uncontended sends. At durability
+# levels without a per-write fsync (see durability.py) the window only
+# applies while writes to the inbox keep arriving together.
+#
+# Batches are per process; writes from other processes are still
+# serialized by the inbox lock as before.
+
+import copy
+import threading
+import time
+import zlib
+
+import config
+from metrics import Histogram, LATENCY_BUCKETS_MS, SIZE_BUCKETS
+
+
+class _Batch:
+    """Messages for one inbox that will be written together"""
+
+    __slots__ = ('packages', 'full', 'done', 'error')
+
+    def __init__(self):
+        self.packages = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.error = None
+
+
+def _error_for_caller(error):
+    """
+    A copy of a batch's error for one caller to raise: everyone in the
+    batch raising the same instance would keep rewriting its traceback.
+    """
+    try:
+        return copy.copy(error)
+    except Exception:
+        return error  # Can't be rebuilt from its args; share it after all
+
+
+class GroupCommitter:
+    """
+    Write-combining queue per recipient.
+
+    Args:
+        write (callable): write(recipient, packages) appends a list of
+            packages durably (one fsync)
+        window_ms (float): How long a batch leader waits for more
+            messages (0 = only combine messages that queue up while the
+            previous batch is being written)
+        max_batch (int): A batch this big is written straight away
+    """
+
+    # Writes to one inbox go one batch at a time; inboxes share these
+    # locks by hash instead of each getting its own
+    _STRIPES = 64
+
+    def __init__(self, write, window_ms=None, max_batch=None):
+        self._write = write
+        self.window = (config.GROUP_COMMIT_WINDOW_MS if window_ms is None else window_ms) / 1000.0
+        self.max_batch = max(1, config.GROUP_COMMIT_MAX_BATCH if max_batch is None else max_batch)
+        self._lock = threading.Lock()
+        self._open = {}
+        self._stripes = [threading.Lock() for _ in range(self._STRIPES)]
+        # Batches waiting for or holding each stripe
+        self._in_flight = [0] * self._STRIPES
+        # Whether the last batch written under each stripe held more than
+        # one message, i.e. whether waiting is likely to pay off
+        self._contended = [False] * self._STRIPES
+        self.batches = 0
+        self.messages = 0
+        self.batch_size = Histogram(SIZE_BUCKETS)
+        self.latency_ms = Histogram(LATENCY_BUCKETS_MS)
+
+    def submit(self, recipient, packages, linger=True):
+        """
+        Store `packages` (a list) in `recipient`'s inbox, batched with
+        whatever else arrives for that inbox meanwhile. Returns once they
+        are durable.
+
+        Args:
+            linger (bool): Whether a new batch that queues behind another
+                waits out the window. Otherwise (for writes that aren't
+                fsynced) it waits only while batches to its inbox's
+                stripe keep combining messages. A batch with nothing
+                ahead of it is written at once either way.
+        """
+        started = time.monotonic()
+        index = zlib.crc32(recipient.encode('utf-8')) % self._STRIPES
+        with self._lock:
+            batch = self._open.get(recipient)
+            leader = batch is None
+            if leader:
+                batch = self._open[recipient] = _Batch()
+                queued = self._in_flight[index] > 0
+                self._in_flight[index] += 1
+            batch.packages.extend(packages)
+            if len(batch.packages) >= self.max_batch:
+                # Nobody else joins; the leader stops waiting
+                del self._open[recipient]
+                batch.full.set()
+
+        if leader:
+            self._lead(recipient, batch, index, queued and (linger or self._contended[index]))
+        else:
+            batch.done.wait()
+
+        self.latency_ms.observe((time.monotonic() - started) * 1000.0)
+        if batch.error is not None:
+            error = _error_for_caller(batch.error)
+            if error is batch.error:
+                raise error
+            # The original keeps the traceback of the failed write
+            raise error from batch.error
+
+    def _lead(self, recipient, batch, index, wait):
+        if self.window > 0 and wait:
+            batch.full.wait(self.window)
+
+        with self._stripes[index]:
+            # The batch stays open while an earlier one is still writing
+            with self._lock:
+                if self._open.get(recipient) is batch:
+                    del self._open[recipient]
+                packages = batch.packages
+                self._contended[index] = len(packages) > 1
+                self.batches += 1
+                self.messages += len(packages)
+            self.batch_size.observe(len(packages))
+            try:
+                self._write(recipient, packages)
+            except BaseException as e:
+                batch.error = e
+            finally:
+                with self._lock:
+                    self._in_flight[index] -= 1
+                batch.done.set()
+
+    def stats(self):
+        with self._lock:
+            batches, messages = self.batches, self.messages
+        return {
+            'window_ms': self.window * 1000.0,
+            'max_batch': self.max_batch,
+            'batches': batches,
+            'messages': messages,
+            'batch_size': self.batch_size.snapshot(),
+            'latency_ms': self.latency_ms.snapshot(),
+        }
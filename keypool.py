@@ -0,0 +1,115 @@
+# keypool.py
+# E2E Encrypted Messenger - Pre-generated RSA Keypair Pool
+#
+# Generating an RSA-2048 keypair is the slowest part of signing up. The
+# pool keeps a few keypairs ready, generated by a background thread, so
+# sign-up only has to take one. When the pool runs dry (a burst of
+# sign-ups) keys are generated inline exactly as before.
+
+import threading
+import time
+from collections import deque
+
+import config
+
+
+class KeyPairPool:
+    """
+    Background-filled pool of (private_key, public_key) pairs.
+
+    Args:
+        generate (callable): Returns a fresh (private_key, public_key) pair
+        size (int): Number of keypairs to keep ready (0 disables the pool)
+        refill_per_second (float): Maximum keypairs generated per second in
+            the background, so refilling never hogs the CPU
+    """
+
+    def __init__(self, generate, size=None, refill_per_second=None):
+        self.generate = generate
+        self.size = config.KEYPOOL_SIZE if size is None else size
+        self.refill_per_second = (
+            config.KEYPOOL_REFILL_PER_SECOND if refill_per_second is None else refill_per_second
+        )
+        self._keys = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._recent = deque(maxlen=32)  # monotonic times of recent background generations
+        self.generated = 0
+        self.served = 0
+        self.fallbacks = 0
+
+    # --- Lifecycle ---
+
+    def start(self):
+        """Start the refill thread (no-op if already running or disabled)"""
+        with self._cond:
+            if self._running or self.size <= 0:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._refill_loop, name="keypair-pool", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _refill_loop(self):
+        min_interval = 1.0 / self.refill_per_second if self.refill_per_second > 0 else 0
+        last = 0.0
+        while True:
+            with self._cond:
+                while self._running and len(self._keys) >= self.size:
+                    self._cond.wait()
+                if not self._running:
+                    return
+
+            # Respect the refill rate limit
+            wait = last + min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            keypair = self.generate()
+            last = time.monotonic()
+
+            with self._cond:
+                self._keys.append(keypair)
+                self.generated += 1
+                self._recent.append(last)
+
+    # --- Use ---
+
+    def take(self):
+        """Return a fresh keypair: from the pool if one is ready, else generated inline"""
+        with self._cond:
+            if self._keys:
+                keypair = self._keys.popleft()
+                self.served += 1
+                self._cond.notify_all()
+                return keypair
+            self.fallbacks += 1
+            self._cond.notify_all()
+
+        return self.generate()
+
+    def stats(self):
+        """Pool depth and refill numbers for monitoring"""
+        with self._cond:
+            recent = list(self._recent)
+            rate = 0.0
+            if len(recent) >= 2 and recent[-1] > recent[0]:
+                rate = (len(recent) - 1) / (recent[-1] - recent[0])
+            return {
+                'running': self._running,
+                'depth': len(self._keys),
+                'size': self.size,
+                'generated': self.generated,
+                'served_from_pool': self.served,
+                'inline_fallbacks': self.fallbacks,
+                'refill_limit_per_second': self.refill_per_second,
+                'recent_refill_per_second': round(rate, 3),
+            }
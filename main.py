@@ -4,7 +4,7 @@
 
 import os
 import time
-from auth import log_in, sign_up, clear_terminal
+from auth import log_in, sign_up, clear_terminal, keypair_pool
 from messaging import send_message_ui, check_inbox_ui
 from message_storage import setup_messages
 
@@ -51,6 +51,9 @@ def main():
         print("Please check permissions and try again.")
         return
     
+    # Start pre-generating keys while the user types
+    keypair_pool.start()
+    
     while True:
         clear_terminal()
         print("=== E2E Encrypted Messaging App ===")
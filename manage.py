@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# manage.py
+# E2E Encrypted Messenger - Maintenance Commands
+
+import argparse
+import json
+import os
+import pstats
+import sys
+
+import config
+
+from message_storage import migrate_legacy_inboxes, get_messages_for_user, iter_archived_messages_for_user
+from profiling import ProfileRing
+from retention import compact_all, compact_user, policy_for, set_user_policy
+from storage import FileBackend, get_storage, import_data_dir
+
+
+def cmd_migrate_inboxes(args):
+    """Convert old messages/<user>.json inboxes to the append-only log"""
+    migrated = migrate_legacy_inboxes()
+    converted = {user: count for user, count in migrated.items() if count}
+
+    if not converted:
+        print("No legacy inboxes found")
+        return 0
+
+    for user, count in converted.items():
+        print(f"✓ {user}: {count} message(s) migrated")
+    return 0
+
+
+def cmd_migrate_layout(args):
+    """Move per-user files into the configured (sharded or flat) layout"""
+    backend = get_storage()
+    if not isinstance(backend, FileBackend):
+        print("✗ Only the file backend has a directory layout")
+        return 1
+
+    backend.setup()
+    counts = backend.migrate_layout()
+    print(f"✓ Moved into the {backend.layout} layout:")
+    print(f"  {counts['users']} user(s), {counts['keys']} private key(s), {counts['inboxes']} inbox(es)")
+    if counts['conflicts']:
+        print(f"✗ {counts['conflicts']} file(s) left in place: a file with the same name is already in the target layout")
+        return 1
+    return 0
+
+
+def cmd_import_sqlite(args):
+    """Copy a file-backend data directory into an SQLite database"""
+    counts = import_data_dir(args.source, args.db)
+    print(f"✓ Imported into {args.db}:")
+    print(f"  {counts['users']} user(s), {counts['keys']} private key(s)")
+    print(f"  {counts['messages']} message(s) in {counts['inboxes']} inbox(es)")
+    print(f"\nRun with E2E_STORAGE_BACKEND=sqlite E2E_SQLITE_PATH={args.db} to use it")
+    return 0
+
+
+def cmd_show_inbox(args):
+    """Print a user's stored (still encrypted) messages as JSON"""
+    if args.archived:
+        messages = (message for _, message in iter_archived_messages_for_user(args.username))
+    else:
+        messages = get_messages_for_user(args.username)
+    for message in messages:
+        print(json.dumps(message, indent=2))
+    return 0
+
+
+def cmd_compact(args):
+    """Apply retention policies: archive old messages and rewrite inboxes compactly"""
+    if args.usernames:
+        results = {}
+        for username in args.usernames:
+            try:
+                results[username] = compact_user(username, dry_run=args.dry_run)
+            except Exception as e:
+                results[username] = {'error': str(e)}
+    else:
+        results = compact_all(dry_run=args.dry_run)
+
+    if not results:
+        print("No inboxes found")
+        return 0
+
+    failed = 0
+    verb = "would archive" if args.dry_run else "archived"
+    for username, result in results.items():
+        if 'error' in result:
+            print(f"✗ {username}: {result['error']}")
+            failed += 1
+            continue
+        note = "" if args.dry_run or result['rewritten'] else " (unchanged)"
+        print(f"✓ {username}: {verb} {result['archived']}, kept {result['kept']}{note}")
+    return 1 if failed else 0
+
+
+def cmd_retention(args):
+    """Show or change a user's retention policy"""
+    if args.reset:
+        policy = set_user_policy(args.username, None)
+    else:
+        overrides = {
+            field: value for field, value in (
+                ('max_messages', args.max_messages),
+                ('max_age_days', args.max_age_days),
+                ('include_unread', args.include_unread),
+            ) if value is not None
+        }
+        try:
+            policy = set_user_policy(args.username, overrides) if overrides else policy_for(args.username)
+        except ValueError as e:
+            print(f"✗ {e}")
+            return 1
+
+    print(f"{args.username}: {json.dumps(policy.to_dict())}")
+    return 0
+
+
+def cmd_profiles(args):
+    """List saved request profiles, or print the top functions of one"""
+    ring = ProfileRing()
+    names = ring.list()
+    if args.show is None:
+        if not names:
+            print(f"No profiles in {ring.directory}/ (see E2E_PROFILING in config.py)")
+            return 0
+        for name in names:
+            size = os.path.getsize(os.path.join(ring.directory, name))
+            print(f"{name}  ({size} bytes)")
+        return 0
+
+    name = names[-1] if args.show == "latest" and names else args.show
+    path = os.path.join(ring.directory, os.path.basename(name))
+    if not os.path.exists(path):
+        print(f"✗ No profile named {args.show!r} in {ring.directory}/")
+        return 1
+    print(f"{os.path.basename(path)}:")
+    pstats.Stats(path, stream=sys.stdout).sort_stats(args.sort).print_stats(args.limit)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="E2E Messenger maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate = subparsers.add_parser("migrate-inboxes", help="Convert JSON-array inboxes to append-only logs")
+    migrate.set_defaults(func=cmd_migrate_inboxes)
+
+    migrate_layout = subparsers.add_parser(
+        "migrate-layout", help=f"Move Users/, Keys/ and messages/ files into the {config.FILE_LAYOUT} layout (safe while running)"
+    )
+    migrate_layout.set_defaults(func=cmd_migrate_layout)
+
+    import_sqlite = subparsers.add_parser("import-sqlite", help="Copy Users/, Keys/ and messages/ into an SQLite database")
+    import_sqlite.add_argument("--source", default=".", help="Directory containing Users/, Keys/ and messages/ (default: .)")
+    import_sqlite.add_argument("--db", default=config.SQLITE_PATH, help=f"SQLite database path (default: {config.SQLITE_PATH})")
+    import_sqlite.set_defaults(func=cmd_import_sqlite)
+
+    show_inbox = subparsers.add_parser("show-inbox", help="Print a user's encrypted messages as JSON")
+    show_inbox.add_argument("username")
+    show_inbox.add_argument("--archived", action="store_true", help="Print archived messages instead")
+    show_inbox.set_defaults(func=cmd_show_inbox)
+
+    compact = subparsers.add_parser("compact", help="Archive messages past their retention policy and compact inboxes")
+    compact.add_argument("usernames", nargs="*", help="Inboxes to compact (default: all)")
+    compact.add_argument("--dry-run", action="store_true", help="Only report what would be archived")
+    compact.set_defaults(func=cmd_compact)
+
+    retention = subparsers.add_parser("retention", help="Show or set a user's retention policy")
+    retention.add_argument("username")
+    retention.add_argument("--max-messages", type=int, help="Keep at most this many messages in the inbox (0 = no limit)")
+    retention.add_argument("--max-age-days", type=float, help="Archive messages older than this (0 = no limit)")
+    unread = retention.add_mutually_exclusive_group()
+    unread.add_argument("--include-unread", dest="include_unread", action="store_const", const=True,
+                        help="Also archive messages the user hasn't read")
+    unread.add_argument("--read-only", dest="include_unread", action="store_const", const=False,
+                        help="Only archive messages the user has read")
+    retention.add_argument("--reset", action="store_true", help="Go back to the default policy")
+    retention.set_defaults(func=cmd_retention)
+
+    profiles = subparsers.add_parser("profiles", help="List request profiles written by the API server, or show one")
+    profiles.add_argument("--show", metavar="NAME", help="Profile to print (a file name, or 'latest')")
+    profiles.add_argument("--sort", default="cumulative", help="pstats sort key (default: cumulative)")
+    profiles.add_argument("--limit", type=int, default=30, help="Functions to print (default: 30)")
+    profiles.set_defaults(func=cmd_profiles)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+# message_bus.py
+# E2E Encrypted Messenger - In-Process Pub/Sub for New Messages
+#
+# save_message() publishes the recipient's name here after every write.
+# Streaming clients (/api/stream) subscribe to their own username and
+# sleep until something arrives, instead of polling /api/inbox. The bus
+# only says "this inbox changed": subscribers read the new records from
+# their cursor, so nothing is lost if several notifications collapse
+# into one wake-up.
+#
+# Writes made by another process (the CLI, another API worker) are not
+# seen here; streams also re-check their inbox on every heartbeat.
+
+import asyncio
+import threading
+
+
+class Subscription:
+    """A blocking subscription (for threaded servers such as Flask)"""
+
+    def __init__(self, bus, recipient):
+        self.bus = bus
+        self.recipient = recipient
+        self._event = threading.Event()
+
+    def notify(self):
+        self._event.set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the inbox changes or `timeout` seconds pass.
+
+        Returns:
+            bool: True if a notification arrived
+        """
+        notified = self._event.wait(timeout)
+        self._event.clear()
+        return notified
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncSubscription(Subscription):
+    """A subscription awaited from an asyncio event loop (asgi_api.py)"""
+
+    def __init__(self, bus, recipient, loop):
+        super().__init__(bus, recipient)
+        self._loop = loop
+        self._async_event = asyncio.Event()
+
+    def notify(self):
+        # publish() runs on whichever thread saved the message
+        try:
+            self._loop.call_soon_threadsafe(self._async_event.set)
+        except RuntimeError:
+            pass  # Loop already closed
+
+    async def wait(self, timeout=None):
+        try:
+            await asyncio.wait_for(self._async_event.wait(), timeout)
+            notified = True
+        except asyncio.TimeoutError:
+            notified = False
+        self._async_event.clear()
+        return notified
+
+
+class MessageBus:
+    """Subscribers keyed by (lowercased) recipient username"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, recipient, loop=None):
+        """
+        Subscribe to new messages for `recipient`.
+
+        Args:
+            recipient (str): Username to watch
+            loop: Pass the running asyncio loop to get an AsyncSubscription
+
+        Returns:
+            Subscription: Close it (or use it as a context manager) when done
+        """
+        recipient = recipient.lower()
+        if loop is None:
+            subscription = Subscription(self, recipient)
+        else:
+            subscription = AsyncSubscription(self, recipient, loop)
+        with self._lock:
+            self._subscribers.setdefault(recipient, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.recipient)
+            if subscribers is None:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.recipient]
+
+    def publish(self, recipient):
+        """Wake every subscriber of `recipient`'s inbox"""
+        recipient = recipient.lower()
+        with self._lock:
+            self.published += 1
+            subscribers = list(self._subscribers.get(recipient, ()))
+            self.delivered += len(subscribers)
+        for subscription in subscribers:
+            subscription.notify()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'recipients': len(self._subscribers),
+                'subscriptions': sum(len(s) for s in self._subscribers.values()),
+                'published': self.published,
+                'delivered': self.delivered,
+            }
+
+
+# Shared by every server and storage call in this process
+message_bus = MessageBus()
@@ -1,26 +1,34 @@
 # message_storage.py
 # Message Storage Module - FIXED VERSION
 
-import json
-import os
-import tempfile
+import hashlib
 import re
+import sys
 from datetime import datetime
 
-# Optional dependency for file locking
-try:
-    from filelock import FileLock, Timeout as FileLockTimeout
-except Exception:
-    FileLock = None
-    FileLockTimeout = None
+import config
+from group_commit import GroupCommitter
+from message_bus import message_bus
+from metrics import counter, timed, timer
+from storage import get_storage
+from user_directory import get_user_directory
+
+def _append_to_inbox(recipient, message_packages):
+    get_storage().append_messages(recipient, message_packages)
+
+
+# Combines concurrent save_message calls to one inbox into one write
+group_committer = GroupCommitter(_append_to_inbox)
+
+# Reported on /api/metrics
+_saved = counter("e2e_messages_saved_total", "Messages stored by save_message() and save_messages()")
+_save_time = timer("e2e_save_message_seconds", "save_message() calls, from validation to the stored write")
+_read_time = timer("e2e_get_messages_for_user_seconds", "get_messages_for_user() calls")
 
-MESSAGE_DIR = "messages"
-USER_DIR = "Users"  # Changed from Users.json to Users directory
 
 def setup_messages():
-    """Create messages directory if it doesn't exist"""
-    os.makedirs(MESSAGE_DIR, exist_ok=True)
-    os.makedirs(USER_DIR, exist_ok=True)
+    """Create message storage (directories or database tables) if it doesn't exist"""
+    get_storage().setup()
 
 
 def sanitize_username(username):
@@ -40,6 +48,7 @@ def sanitize_username(username):
     return username.lower()
 
 
+@timed(_save_time)
 def save_message(message_package):
     """
     Save an encrypted message to storage.
@@ -53,6 +62,80 @@ def save_message(message_package):
             - nonce: base64 encoded nonce
             - timestamp: ISO format timestamp
     """
+    _validate_message_package(message_package)
+
+    setup_messages()
+
+    recipient = sanitize_username(message_package['to_user'])
+    message_package = _store_conversation_key(recipient, message_package)
+    storage = get_storage()
+    if config.GROUP_COMMIT_ENABLED:
+        # Returns once the message is as durable as the durability level
+        # asks, possibly written together with other senders' messages to
+        # the same inbox (waiting for more only if that saves fsyncs)
+        group_committer.submit(recipient, [message_package], linger=storage.durability == "strict")
+    else:
+        storage.append_message(recipient, message_package)
+    _saved.inc()
+    message_bus.publish(recipient)
+
+
+def get_durability():
+    """The durability level message writes use (see durability.py)"""
+    return get_storage().durability
+
+
+def set_durability(level):
+    """
+    Change how hard message writes wait for the disk, for this process.
+
+    Args:
+        level (str): "strict", "batched" or "none"
+
+    Raises:
+        ValueError: Unknown level
+    """
+    get_storage().set_durability(level)
+
+
+def durability_status():
+    """Durability level and fsync statistics, as reported by /api/health"""
+    return get_storage().durability_status()
+
+
+def save_messages(message_packages):
+    """
+    Save a batch of encrypted messages (e.g. one broadcast to many users).
+
+    Messages are grouped per recipient inbox, so each inbox is locked,
+    appended to and fsynced once no matter how many of the messages it
+    receives. Every package is validated before anything is written.
+    
+    Args:
+        message_packages (list): Message packages, same shape as save_message
+    """
+    if not isinstance(message_packages, (list, tuple)):
+        raise TypeError(f"message_packages must be a list, got {type(message_packages).__name__}")
+
+    groups = {}
+    for message_package in message_packages:
+        _validate_message_package(message_package)
+        recipient = sanitize_username(message_package['to_user'])
+        groups.setdefault(recipient, []).append(message_package)
+
+    if not groups:
+        return
+
+    setup_messages()
+    for recipient, packages in groups.items():
+        groups[recipient] = [_store_conversation_key(recipient, p) for p in packages]
+    get_storage().append_message_groups(groups)
+    _saved.inc(len(message_packages))
+    for recipient in groups:
+        message_bus.publish(recipient)
+
+
+def _validate_message_package(message_package):
     if not isinstance(message_package, dict):
         raise TypeError(f"message_package must be a dict, got {type(message_package).__name__}")
 
@@ -65,91 +148,251 @@ def save_message(message_package):
     if bad_values:
         raise ValueError(f"The following keys must be non-empty strings: {', '.join(bad_values)}")
 
+    key_id = message_package.get('key_id')
+    if key_id is not None and not (isinstance(key_id, str) and re.fullmatch(r"[0-9a-f]{32}", key_id)):
+        raise ValueError(f"key_id must be 32 lowercase hex characters, got {key_id!r}")
+
     try:
         datetime.fromisoformat(message_package['timestamp'])
     except Exception:
         raise ValueError(f"timestamp is not a valid ISO-8601 string: {message_package.get('timestamp')!r}")
 
+
+# --- Conversation keys (see encryption.py) ---
+
+def _store_conversation_key(recipient, message_package):
+    """
+    Record the wrapped key of a conversation-key message, and return the
+    package as it is stored: key_id instead of encrypted_key.
+
+    The key is saved with every message rather than once per process:
+    saving is first-wins and cheap, and clearing an inbox (here or in
+    another process) deletes its keys, so "already stored" can't be
+    remembered safely.
+    """
+    key_id = message_package.get('key_id')
+    if not key_id:
+        return message_package
+
+    # Key first, so no stored message ever refers to a missing key
+    get_storage().save_conversation_key(
+        recipient, key_id, message_package['from_user'], message_package['encrypted_key']
+    )
+
+    stored = dict(message_package)
+    del stored['encrypted_key']
+    return stored
+
+
+def _attach_conversation_keys(recipient, messages):
+    """
+    Put the wrapped key back into conversation-key messages, so readers
+    get self-contained packages. A key_id only resolves for the sender
+    who registered it; anything else is left to fail decryption.
+    """
+    if not any('key_id' in msg and 'encrypted_key' not in msg for msg in messages):
+        return messages
+
+    keys = get_storage().load_conversation_keys(recipient)
+    resolved = []
+    for msg in messages:
+        key = keys.get(msg.get('key_id')) if 'encrypted_key' not in msg else None
+        if key is not None and key['from_user'] == msg.get('from_user'):
+            msg = dict(msg, encrypted_key=key['encrypted_key'])
+        resolved.append(msg)
+    return resolved
+
+
+def migrate_legacy_inboxes():
+    """
+    One-shot migration of every messages/<user>.json inbox to the
+    append-only log format (file backend only). Safe to run more than once.
+
+    Returns:
+        dict: username -> number of messages migrated
+    """
     setup_messages()
+    return get_storage().migrate_legacy_inboxes()
 
-    recipient = sanitize_username(message_package['to_user'])
-    message_file = os.path.join(MESSAGE_DIR, f"{recipient}.json")
-
-    # Simple file locking if available
-    if FileLock is not None:
-        lock_path = message_file + ".lock"
-        lock_timeout_seconds = 5
-
-        try:
-            with FileLock(lock_path, timeout=lock_timeout_seconds):
-                _write_message(message_file, message_package)
-        except FileLockTimeout:
-            raise TimeoutError(f"Could not acquire file lock for {message_file!r} within {lock_timeout_seconds} seconds")
-    else:
-        # No locking available, write directly
-        _write_message(message_file, message_package)
-
-
-def _write_message(message_file, message_package):
-    """Helper function to write message to file"""
-    if os.path.exists(message_file):
-        try:
-            with open(message_file, 'r') as f:
-                messages = json.load(f)
-        except json.JSONDecodeError:
-            messages = []
-    else:
-        messages = []
 
-    messages.append(message_package)
+def _validate_cursor(since, limit):
+    if since is None:
+        since = 0
+    if isinstance(since, bool) or not isinstance(since, int) or since < 0:
+        raise ValueError(f"cursor must be a non-negative integer, got {since!r}")
 
-    # Atomic write using temp file
-    target_dir = os.path.dirname(message_file) or "."
-    fd, tmp_path = tempfile.mkstemp(prefix="msg_", dir=target_dir, text=True)
-    try:
-        with os.fdopen(fd, 'w') as tmpf:
-            json.dump(messages, tmpf, indent=2)
-            tmpf.flush()
-            os.fsync(tmpf.fileno())
+    if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int) or limit < 1):
+        raise ValueError(f"limit must be a positive integer, got {limit!r}")
+
+    return since, limit
+
+
+def get_messages_page(username, since=None, limit=None):
+    """
+    Get one page of a user's messages, oldest first.
+    
+    Args:
+        username (str): The username to get messages for
+        since (int): Cursor returned by a previous call (None = from the start)
+        limit (int): Maximum number of messages to return (None = no limit)
+    
+    Returns:
+        tuple: (list of message dictionaries, next cursor). Message i of the
+            page has sequence number next_cursor - len(messages) + i.
+    """
+    since, limit = _validate_cursor(since, limit)
+
+    setup_messages()
 
-        os.replace(tmp_path, message_file)
-    finally:
-        if os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
+    safe_username = sanitize_username(username)
+    messages, next_cursor = get_storage().read_messages(safe_username, since, limit)
+    return _attach_conversation_keys(safe_username, messages), next_cursor
 
 
-def get_messages_for_user(username):
+@timed(_read_time)
+def get_messages_for_user(username, since=None, limit=None):
     """
-    Get all messages for a specific user.
+    Get messages for a specific user.
     
     Args:
         username (str): The username to get messages for
+        since (int): Only return messages at or after this cursor (see get_messages_page)
+        limit (int): Maximum number of messages to return
     
     Returns:
         list: List of message dictionaries, or empty list if no messages
     """
+    messages, _ = get_messages_page(username, since, limit)
+    return messages
+
+
+def iter_inbox(username, since=None):
+    """
+    Generator over a user's inbox, oldest first, without loading it all
+    into memory (see StorageBackend.iter_messages). The username and
+    cursor are checked straight away, not on the first next().
+    
+    Args:
+        username (str): The username to get messages for
+        since (int): Cursor to start from (None = from the start)
+    
+    Returns:
+        iterator: (sequence number, message dictionary) pairs
+    """
+    since, _ = _validate_cursor(since, None)
+
     setup_messages()
 
     safe_username = sanitize_username(username)
-    message_file = os.path.join(MESSAGE_DIR, f"{safe_username}.json")
+    return _iter_with_conversation_keys(safe_username, get_storage().iter_messages(safe_username, since))
+
+
+def _iter_with_conversation_keys(recipient, records):
+    """Streaming _attach_conversation_keys: keys are loaded when first needed"""
+    keys = None
+    reloaded_for = set()
+    for seq, msg in records:
+        if 'key_id' in msg and 'encrypted_key' not in msg:
+            key_id = msg['key_id']
+            if keys is None or (key_id not in keys and key_id not in reloaded_for):
+                # Reload (once per key_id) for a key saved after we started
+                keys = get_storage().load_conversation_keys(recipient)
+                reloaded_for.add(key_id)
+            key = keys.get(key_id)
+            if key is not None and key['from_user'] == msg.get('from_user'):
+                msg = dict(msg, encrypted_key=key['encrypted_key'])
+        yield seq, msg
+
+
+def iter_messages_for_user(username, since=None):
+    """
+    Generator version of get_messages_for_user: messages are read from
+    storage one at a time as the caller consumes them.
     
-    if not os.path.exists(message_file):
-        return []
+    Args:
+        username (str): The username to get messages for
+        since (int): Only yield messages at or after this cursor
     
-    try:
-        with open(message_file, 'r') as f:
-            messages = json.load(f)
-        return messages
-    except json.JSONDecodeError:
-        return []
+    Returns:
+        iterator: Message dictionaries, oldest first
+    """
+    return (msg for _, msg in iter_inbox(username, since))
+
+
+def get_inbox_cursor(username):
+    """
+    Cursor just past a user's newest message, i.e. where a live stream
+    of new arrivals starts.
+    
+    Returns:
+        int: Cursor to pass to get_messages_page
+    """
+    _, next_cursor = get_messages_page(username, sys.maxsize, 1)
+    return next_cursor
+
+
+# --- Read state and archive (see retention.py) ---
+
+# Last read cursor each inbox was marked with by this process, so a
+# client polling with nothing new doesn't cause a storage write each time
+_marked_read = {}
+_MARKED_READ_MAX = 100000
+
+
+def mark_messages_read(username, cursor):
+    """
+    Record that a user has been shown every message before `cursor`
+    (retention policies normally archive read messages only).
+    
+    Args:
+        username (str): Inbox owner
+        cursor (int): next_cursor of what was delivered
+    """
+    safe_username = sanitize_username(username)
+    if not cursor or _marked_read.get(safe_username, 0) >= cursor:
+        return
+    get_storage().set_read_cursor(safe_username, cursor)
+    if len(_marked_read) >= _MARKED_READ_MAX:
+        _marked_read.clear()
+    _marked_read[safe_username] = cursor
+
+
+def get_read_cursor(username):
+    """Cursor just past the last message the user has been shown"""
+    return get_storage().get_read_cursor(sanitize_username(username))
+
+
+def iter_archived_messages_for_user(username):
+    """
+    Generator over a user's archived messages (moved out of the inbox
+    by compaction), oldest first.
+    
+    Returns:
+        iterator: (sequence number, message dictionary) pairs
+    """
+    safe_username = sanitize_username(username)
+    return _iter_with_conversation_keys(safe_username, get_storage().iter_archived_messages(safe_username))
+
+
+def message_id(message_package):
+    """
+    Stable identifier for a stored message: a hash of its ciphertext
+    fields. Every message has a fresh wrapped key, so ids don't collide
+    even when a broadcast shares the same ciphertext and nonce.
+    
+    Returns:
+        str: 32 hex characters
+    """
+    digest = hashlib.sha256()
+    for field in ('nonce', 'encrypted_key', 'encrypted_message'):
+        digest.update(str(message_package.get(field, '')).encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()[:32]
 
 
 def get_user_public_key(username):
     """
-    Get a user's public key from their individual user file.
+    Get a user's public key from the in-memory user directory.
     
     Args:
         username (str): The username to look up
@@ -157,36 +400,25 @@ def get_user_public_key(username):
     Returns:
         str: Public key in PEM format, or None if user not found
     """
-    user_file = os.path.join(USER_DIR, f"{username}.json")
-    
-    if not os.path.exists(user_file):
-        return None
-    
     try:
-        with open(user_file, 'r') as f:
-            user_data = json.load(f)
-        return user_data.get('public_key')
-    except (json.JSONDecodeError, KeyError, IOError):
+        return get_user_directory().get_public_key(username)
+    except (ValueError, KeyError, IOError):
         return None
 
 
-def get_all_users():
+def get_all_users(prefix='', limit=None):
     """
-    Get a list of all registered usernames.
+    Get a list of registered usernames, sorted.
+    
+    Args:
+        prefix (str): Only return usernames starting with this
+        limit (int): Maximum number of usernames to return
     
     Returns:
         list: List of usernames
     """
-    if not os.path.exists(USER_DIR):
-        return []
-    
     try:
-        users = []
-        for filename in os.listdir(USER_DIR):
-            if filename.endswith('.json'):
-                username = filename[:-5]  # Remove .json extension
-                users.append(username)
-        return users
+        return get_user_directory().search(prefix, limit)
     except Exception:
         return []
 
@@ -199,10 +431,8 @@ def clear_messages_for_user(username):
         username (str): Username to clear messages for
     """
     safe_username = sanitize_username(username)
-    message_file = os.path.join(MESSAGE_DIR, f"{safe_username}.json")
-
-    if os.path.exists(message_file):
-        os.remove(message_file)
+    get_storage().clear_messages(safe_username)
+    _marked_read.pop(safe_username, None)
 
 
 # ============================================
@@ -1,8 +1,11 @@
 # messaging.py
 # E2E Encrypted Messenger - Messaging UI and Functions
 
-from encryption import encrypt_message, decrypt_message
-from message_storage import save_message, get_messages_for_user, get_user_public_key
+from encryption import encrypt_message, encrypt_message_multi
+from message_storage import (
+    save_message, save_messages, get_messages_page, get_user_public_key, iter_inbox, mark_messages_read
+)
+from decryption_pool import decrypt_messages, iter_decrypted_batches
 from datetime import datetime
 import os
 import time
@@ -52,7 +55,7 @@ def send_message_ui(session):
         
         # Encrypt the message
         print("\n🔒 Encrypting message...")
-        encrypted_data = encrypt_message(message_text, recipient_public_key)
+        encrypted_data = encrypt_message(message_text, recipient_public_key, recipient_username, session['username'])
         
         # Prepare message package
         message_package = {
@@ -63,6 +66,8 @@ def send_message_ui(session):
             'nonce': encrypted_data['nonce'],
             'timestamp': datetime.now().isoformat()
         }
+        if 'key_id' in encrypted_data:
+            message_package['key_id'] = encrypted_data['key_id']
         
         # Save to storage (your friend's function)
         save_message(message_package)
@@ -98,7 +103,7 @@ def check_inbox_ui(session):
         print("\n=== Your Inbox ===")
         
         # Get messages from storage (your friend's function)
-        messages = get_messages_for_user(session['username'])
+        messages, next_cursor = get_messages_page(session['username'])
         
         if not messages or len(messages) == 0:
             print("\n📭 No messages yet")
@@ -107,30 +112,25 @@ def check_inbox_ui(session):
         
         print(f"\n📬 You have {len(messages)} message(s)\n")
         
+        # Decrypt everything up front (in parallel for large inboxes)
+        results = decrypt_messages(messages, session['private_key'])
+        
         # Display each message
-        for idx, msg in enumerate(messages, 1):
+        for idx, (msg, decrypted_text) in enumerate(zip(messages, results), 1):
             print(f"{'='*50}")
             print(f"Message {idx}")
             print(f"{'='*50}")
             print(f"From: {msg.get('from_user', 'Unknown')}")
             print(f"Time: {msg.get('timestamp', 'Unknown')}")
             
-            try:
-                # Decrypt the message
-                encrypted_content = {
-                    'encrypted_message': msg['encrypted_message'],
-                    'encrypted_key': msg['encrypted_key'],
-                    'nonce': msg['nonce']
-                }
-                
-                decrypted_text = decrypt_message(encrypted_content, session['private_key'])
+            if isinstance(decrypted_text, Exception):
+                print(f"\n❌ Could not decrypt this message: {decrypted_text}")
+            else:
                 print(f"\nMessage:\n{decrypted_text}")
-                
-            except Exception as e:
-                print(f"\n❌ Could not decrypt this message: {e}")
             
             print()  # Blank line between messages
         
+        mark_messages_read(session['username'], next_cursor)
         input("Press Enter to continue...")
         
     except Exception as e:
@@ -166,7 +166,7 @@ def send_message_programmatic(from_user_id, from_username, to_username,
             return False
         
         # Encrypt
-        encrypted_data = encrypt_message(message_text, recipient_public_key)
+        encrypted_data = encrypt_message(message_text, recipient_public_key, to_username, from_username)
         
         # Prepare and save
         message_package = {
@@ -178,6 +178,8 @@ def send_message_programmatic(from_user_id, from_username, to_username,
             'nonce': encrypted_data['nonce'],
             'timestamp': datetime.now().isoformat()
         }
+        if 'key_id' in encrypted_data:
+            message_package['key_id'] = encrypted_data['key_id']
         
         save_message(message_package)
         return True
@@ -187,6 +189,71 @@ def send_message_programmatic(from_user_id, from_username, to_username,
         return False
 
 
+def send_message_bulk_programmatic(from_username, to_usernames, message_text):
+    """
+    Send one message to many users (for API/non-UI use).
+    The message is encrypted once; only the AES key is wrapped per recipient.
+    
+    Args:
+        from_username (str): Sender's username
+        to_usernames (list): Recipients' usernames
+        message_text (str): Plain text message to send
+    
+    Returns:
+        list: Usernames the message was delivered to (unknown users are skipped)
+    """
+    try:
+        recipients, public_keys = [], []
+        for to_username in dict.fromkeys(to_usernames):
+            recipient_public_key = get_user_public_key(to_username)
+            if recipient_public_key:
+                recipients.append(to_username)
+                public_keys.append(recipient_public_key)
+        
+        if not recipients:
+            return []
+        
+        # Encrypt once, then save grouped by recipient inbox
+        encrypted_data = encrypt_message_multi(message_text, public_keys, recipients)
+        timestamp = datetime.now().isoformat()
+        save_messages([
+            {
+                'from_user': from_username,
+                'to_user': to_username,
+                'encrypted_message': encrypted['encrypted_message'],
+                'encrypted_key': encrypted['encrypted_key'],
+                'nonce': encrypted['nonce'],
+                'timestamp': timestamp
+            }
+            for to_username, encrypted in zip(recipients, encrypted_data)
+        ])
+        return recipients
+        
+    except Exception as e:
+        print(f"Error: {e}")
+        return []
+
+
+def iter_decrypted(username, private_key, since=None):
+    """
+    Read and decrypt a user's inbox lazily, oldest first. Messages are
+    read and decrypted in growing batches as the caller consumes them,
+    so the first one is available long before a big inbox is done.
+    
+    Args:
+        username (str): User whose inbox to read
+        private_key: User's private key object for decryption
+        since (int): Inbox cursor to start from (None = from the start)
+    
+    Yields:
+        tuple: (message dict, decrypted text) - the text is a
+            DecryptionError instance for a message that can't be decrypted
+    """
+    for batch in iter_decrypted_batches(iter_inbox(username, since), private_key):
+        for _, msg, decrypted_text in batch:
+            yield msg, decrypted_text
+
+
 def read_messages_programmatic(user_id, private_key):
     """
     Read messages programmatically (for API/non-UI use).
@@ -199,27 +266,18 @@ def read_messages_programmatic(user_id, private_key):
         list: List of decrypted message dictionaries
     """
     try:
-        messages = get_messages_for_user(user_id)
         decrypted_messages = []
         
-        for msg in messages:
-            try:
-                encrypted_content = {
-                    'encrypted_message': msg['encrypted_message'],
-                    'encrypted_key': msg['encrypted_key'],
-                    'nonce': msg['nonce']
-                }
-                
-                decrypted_text = decrypt_message(encrypted_content, private_key)
-                
-                decrypted_messages.append({
-                    'from': msg.get('from_user', 'Unknown'),
-                    'message': decrypted_text,
-                    'timestamp': msg.get('timestamp', 'Unknown')
-                })
-            except Exception:
+        for msg, decrypted_text in iter_decrypted(user_id, private_key):
+            if isinstance(decrypted_text, Exception):
                 # Skip messages that can't be decrypted
                 continue
+            
+            decrypted_messages.append({
+                'from': msg.get('from_user', 'Unknown'),
+                'message': decrypted_text,
+                'timestamp': msg.get('timestamp', 'Unknown')
+            })
         
         return decrypted_messages
         
@@ -0,0 +1,253 @@
+# metrics.py
+# E2E Encrypted Messenger - Lightweight Metrics
+#
+# Small, thread-safe building blocks for the numbers the servers report
+# in /api/health, and the instrumentation behind /api/metrics: named
+# timers and counters around the hot paths (storage writes and reads,
+# encryption, password hashing), rendered in the Prometheus text format
+# by render_prometheus().
+#
+# E2E_METRICS=0 turns the instrumentation off: @timed then returns the
+# function unchanged and Timer.time() a shared no-op, so the hot paths
+# pay one attribute check at most.
+#
+# Work done in other processes (the "process" decryption pool) isn't
+# counted; the parent's timers around it are.
+
+import bisect
+import functools
+import threading
+import time
+
+import config
+
+ENABLED = config.METRICS_ENABLED
+
+# Upper bounds (milliseconds) for latency histograms
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 250, 500, 1000, 2500)
+
+# Upper bounds for size (count) histograms
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket, plus their count and sum.
+
+    Args:
+        buckets (tuple): Increasing upper bounds; larger values land in
+            an implicit +Inf bucket
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: count, sum, and cumulative counts per upper bound
+                ("le", as Prometheus does), ending with "+Inf"
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = {}
+        running = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            running += count
+            cumulative[str(bound)] = running
+        return {'count': running, 'sum': round(total, 3), 'buckets': cumulative}
+
+
+# ============================================
+# INSTRUMENTATION
+# ============================================
+
+class Counter:
+    """A number that only goes up"""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        if ENABLED:
+            with self._lock:
+                self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+
+class _Timing:
+    """Context manager that records its duration in a Timer"""
+
+    __slots__ = ('timer', 'started')
+
+    def __init__(self, timer):
+        self.timer = timer
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.observe_since(self.started)
+
+
+class _NoTiming:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_TIMING = _NoTiming()
+
+
+class Timer:
+    """Histogram of durations (kept in milliseconds, reported in seconds)"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.histogram = Histogram(buckets)
+
+    def observe_since(self, started):
+        """Record the time since `started` (a time.perf_counter() value)"""
+        self.histogram.observe((time.perf_counter() - started) * 1000.0)
+
+    def time(self):
+        """`with timer.time():` records how long the block takes"""
+        return _Timing(self) if ENABLED else _NO_TIMING
+
+
+class _Family:
+    """One metric name with a child metric per value of a label"""
+
+    def __init__(self, kind, name, help_text, label, factory):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, value):
+        """The child metric for one label value (created on first use)"""
+        child = self._children.get(value)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(value, self._factory())
+        return child
+
+    def children(self):
+        with self._lock:
+            return sorted(self._children.items())
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _register(kind, name, help_text, label, factory):
+    with _registry_lock:
+        family = _registry.get(name)
+        if family is None:
+            family = _registry[name] = _Family(kind, name, help_text, label, factory)
+        elif family.kind != kind or family.label != label:
+            raise ValueError(f"Metric {name!r} is already registered differently")
+    return family if label else family.labels("")
+
+
+def counter(name, help_text, label=None):
+    """
+    Register (or look up) a counter. Names end in "_total".
+
+    Args:
+        label (str): Label name; returns a family whose .labels(value)
+            gives one Counter per value
+
+    Returns:
+        Counter (or a family of them)
+    """
+    return _register("counter", name, help_text, label, Counter)
+
+
+def timer(name, help_text, label=None):
+    """
+    Register (or look up) a timer, reported as a Prometheus histogram.
+    Names end in "_seconds".
+
+    Args:
+        label (str): As for counter()
+
+    Returns:
+        Timer (or a family of them)
+    """
+    return _register("histogram", name, help_text, label, Timer)
+
+
+def timed(metric):
+    """Decorator recording how long each call takes (errors included) in a Timer"""
+    def decorate(function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metric.observe_since(started)
+        return wrapper
+    return decorate
+
+
+def _labels(family, value, extra=""):
+    pairs = []
+    if family.label:
+        pairs.append(f'{family.label}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render_prometheus():
+    """
+    Returns:
+        str: Every registered metric in the Prometheus text exposition
+            format (version 0.0.4)
+    """
+    with _registry_lock:
+        families = sorted(_registry.values(), key=lambda family: family.name)
+
+    lines = []
+    for family in families:
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {family.kind}")
+        for value, metric in family.children():
+            if family.kind == "counter":
+                lines.append(f"{family.name}{_labels(family, value)} {metric.value}")
+                continue
+            snapshot = metric.histogram.snapshot()
+            for bound, count in snapshot['buckets'].items():
+                le = bound if bound == "+Inf" else repr(float(bound) / 1000.0)
+                labels = _labels(family, value, 'le="%s"' % le)
+                lines.append(f"{family.name}_bucket{labels} {count}")
+            lines.append(f"{family.name}_sum{_labels(family, value)} {snapshot['sum'] / 1000.0}")
+            lines.append(f"{family.name}_count{_labels(family, value)} {snapshot['count']}")
+    return "\n".join(lines) + "\n"
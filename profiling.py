@@ -0,0 +1,185 @@
+# profiling.py
+# E2E Encrypted Messenger - Opt-in Per-Request Profiling
+#
+# Aggregate numbers (/api/metrics) say that requests are slow; a profile
+# says why. When config.PROFILING_ENABLED is set, a request to api.py
+# carrying an "X-Profile" header or a "profile" query parameter is run
+# under cProfile - the handler and everything it calls in that thread,
+# storage and crypto included, plus the rest of a streamed response -
+# and the profile is written to config.PROFILE_DIR. Only the newest
+# config.PROFILE_MAX_FILES profiles are kept.
+#
+# If config.PROFILING_TOKEN is set, the header/parameter value must
+# match it, so only whoever knows the token can make the server profile.
+#
+# One request is profiled at a time; a profile request arriving while
+# another is running is served normally (its response says "busy").
+# Up to Python 3.11 cProfile only sees the thread that enabled it, so
+# work handed to other threads or processes (the decryption pool, a
+# group commit led by another request) isn't in the profile. From 3.12
+# cProfile is built on sys.monitoring and records every thread in the
+# process: a profile is then only started while no other request is
+# being handled (otherwise the response says "busy"), but requests that
+# arrive while it runs, and pool threads, are recorded too.
+#
+# Read profiles with `python manage.py profiles`, or with pstats /
+# snakeviz: python -m pstats profiles/<name>.prof
+
+import cProfile
+import hmac
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+import config
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_PARAM = "profile"
+PROFILE_SUFFIX = ".prof"
+
+# Whether cProfile records every thread, not just the one that enabled it
+PROFILES_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+class ProfileRing:
+    """
+    Directory holding at most `max_files` profiles; saving one more
+    removes the oldest.
+
+    Args:
+        directory (str): Where profiles are written
+        max_files (int): How many to keep
+    """
+
+    def __init__(self, directory=None, max_files=None):
+        self.directory = directory or config.PROFILE_DIR
+        self.max_files = max(1, config.PROFILE_MAX_FILES if max_files is None else max_files)
+        self._lock = threading.Lock()
+        self._counter = 0
+
+    def new_name(self, label):
+        """A file name for the next profile, sortable by time"""
+        # The counter tells apart profiles started in the same second
+        with self._lock:
+            self._counter = (self._counter + 1) % 10000
+            counter = self._counter
+        slug = re.sub(r"[^A-Za-z0-9]+", "-", label).strip("-")[:60] or "request"
+        return f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{counter:04d}-{slug}{PROFILE_SUFFIX}"
+
+    def save(self, profiler, name):
+        """Write a finished profiler's stats as `name` (from new_name) and prune old profiles"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix="profile_", dir=self.directory)
+        os.close(fd)
+        try:
+            profiler.dump_stats(tmp_path)
+            os.replace(tmp_path, os.path.join(self.directory, name))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.prune()
+
+    def list(self):
+        """Profile file names, oldest first"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if name.endswith(PROFILE_SUFFIX))
+
+    def prune(self):
+        names = self.list()
+        for name in names[:max(0, len(names) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass  # Another process pruned it first
+
+
+def profile_requested(header_value, param_value):
+    """
+    Whether a request asked to be profiled and is allowed to be.
+
+    Args:
+        header_value (str): The X-Profile header, or None
+        param_value (str): The profile query parameter, or None
+    """
+    if not config.PROFILING_ENABLED:
+        return False
+    value = header_value if header_value is not None else param_value
+    if value is None:
+        return False
+    if config.PROFILING_TOKEN:
+        return hmac.compare_digest(value.encode(), config.PROFILING_TOKEN.encode())
+    return value.lower() not in ("", "0", "false", "no")
+
+
+class RequestProfiler:
+    """Profiles one request at a time and saves the results to a ProfileRing"""
+
+    def __init__(self, ring=None):
+        self.ring = ring or ProfileRing()
+        self._busy = threading.Lock()
+        self._count_lock = threading.Lock()
+        self._in_flight = 0
+        self.profiled = 0
+        self.skipped = 0
+
+    def request_started(self):
+        """Count a request being handled (see start)"""
+        with self._count_lock:
+            self._in_flight += 1
+
+    def request_finished(self):
+        with self._count_lock:
+            self._in_flight -= 1
+
+    def start(self):
+        """
+        Start profiling the calling thread (every thread, on Python 3.12+).
+
+        Returns:
+            cProfile.Profile, or None if another request is being profiled
+            or, on 3.12+, handled
+        """
+        if not self._busy.acquire(blocking=False):
+            self.skipped += 1
+            return None
+        if PROFILES_ALL_THREADS and self._in_flight > 1:
+            # The profile would mix in the other requests' work
+            self._busy.release()
+            self.skipped += 1
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except BaseException:
+            self._busy.release()
+            raise
+        return profiler
+
+    def finish(self, profiler, name):
+        """Stop a profiler from start() and save it as `name` (see ProfileRing.new_name)"""
+        try:
+            profiler.disable()
+            self.profiled += 1
+            self.ring.save(profiler, name)
+        finally:
+            self._busy.release()
+
+    def stats(self):
+        return {
+            'enabled': config.PROFILING_ENABLED,
+            'directory': self.ring.directory,
+            'max_files': self.ring.max_files,
+            'profiled': self.profiled,
+            'skipped_busy': self.skipped,
+            'all_threads': PROFILES_ALL_THREADS,
+        }
+
+
+# Shared by the API server in this process
+request_profiler = RequestProfiler()
@@ -0,0 +1,309 @@
+# retention.py
+# E2E Encrypted Messenger - Inbox Retention, Compaction and Archival
+#
+# Inboxes only grow. A retention policy says how much of an inbox stays
+# on the normal read path: at most max_messages messages, none older
+# than max_age_days. Compaction moves everything past those limits into
+# archive segments (StorageBackend.compact_inbox), which /api/inbox and
+# the CLI never read, and rewrites what is left compactly. Sequence
+# numbers - and so message ids and client cursors - don't change.
+#
+# Only messages the user has already been shown are archived (see
+# message_storage.mark_messages_read) unless the policy sets
+# include_unread.
+#
+# The default policy comes from config.py; per-user policies live in
+# config.RETENTION_POLICY_FILE, e.g.
+#   {"users": {"bob": {"max_messages": 1000, "max_age_days": 30}}}
+# and are set with `python manage.py retention <user> ...`.
+#
+# Run compaction with `python manage.py compact`, or set
+# E2E_COMPACTION_INTERVAL_SECONDS to run it from a background thread of
+# the API server.
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import config
+from message_storage import sanitize_username, setup_messages
+from storage import get_storage
+
+
+class RetentionPolicy:
+    """
+    How much of one inbox to keep.
+
+    Args:
+        max_messages (int): Keep at most this many messages (0 = no limit)
+        max_age_days (float): Archive messages older than this (0 = no limit)
+        include_unread (bool): Apply the limits to unread messages too
+    """
+
+    FIELDS = ('max_messages', 'max_age_days', 'include_unread')
+
+    def __init__(self, max_messages=0, max_age_days=0, include_unread=False):
+        if isinstance(max_messages, bool) or not isinstance(max_messages, int) or max_messages < 0:
+            raise ValueError(f"max_messages must be a non-negative integer, got {max_messages!r}")
+        if isinstance(max_age_days, bool) or not isinstance(max_age_days, (int, float)) or max_age_days < 0:
+            raise ValueError(f"max_age_days must be a non-negative number, got {max_age_days!r}")
+        if not isinstance(include_unread, bool):
+            raise ValueError(f"include_unread must be true or false, got {include_unread!r}")
+        self.max_messages = max_messages
+        self.max_age_days = max_age_days
+        self.include_unread = include_unread
+
+    @classmethod
+    def default(cls):
+        """The policy configured in config.py"""
+        return cls(config.RETENTION_MAX_MESSAGES, config.RETENTION_MAX_AGE_DAYS, config.RETENTION_INCLUDE_UNREAD)
+
+    def updated(self, overrides):
+        """A copy with the fields in `overrides` (a dict) replaced"""
+        unknown = set(overrides) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown retention policy field(s): {', '.join(sorted(unknown))}")
+        return RetentionPolicy(**dict(self.to_dict(), **overrides))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @property
+    def enabled(self):
+        return self.max_messages > 0 or self.max_age_days > 0
+
+    def __repr__(self):
+        return f"RetentionPolicy({', '.join(f'{k}={v!r}' for k, v in self.to_dict().items())})"
+
+
+# ============================================
+# PER-USER POLICIES
+# ============================================
+
+def load_user_policies():
+    """
+    Returns:
+        dict: username -> policy overrides (dict) from the policy file
+    """
+    try:
+        with open(config.RETENTION_POLICY_FILE, 'r') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    users = data.get('users', {}) if isinstance(data, dict) else {}
+    return users if isinstance(users, dict) else {}
+
+
+def _save_user_policies(users):
+    target_dir = os.path.dirname(config.RETENTION_POLICY_FILE) or "."
+    fd, tmp_path = tempfile.mkstemp(prefix="retention_", dir=target_dir)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'users': users}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, config.RETENTION_POLICY_FILE)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def set_user_policy(username, overrides):
+    """
+    Change a user's retention policy.
+
+    Args:
+        username (str): User to change
+        overrides (dict): Fields that differ from the default policy;
+            None removes the user's policy (back to the default)
+
+    Returns:
+        RetentionPolicy: The user's policy from now on
+    """
+    username = sanitize_username(username)
+    users = load_user_policies()
+    if overrides is None:
+        users.pop(username, None)
+    else:
+        merged = dict(users.get(username, {}), **overrides)
+        RetentionPolicy.default().updated(merged)  # Validate before saving
+        users[username] = merged
+    _save_user_policies(users)
+    return policy_for(username, users)
+
+
+def policy_for(username, user_policies=None):
+    """The retention policy that applies to a user"""
+    if user_policies is None:
+        user_policies = load_user_policies()
+    return RetentionPolicy.default().updated(user_policies.get(sanitize_username(username), {}))
+
+
+# ============================================
+# COMPACTION
+# ============================================
+
+def _message_time(message):
+    """A message's timestamp as a naive local datetime, or None if unreadable"""
+    try:
+        dt = datetime.fromisoformat(message.get('timestamp'))
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt
+
+
+def archive_point(username, policy, now=None):
+    """
+    Work out how much of an inbox a policy moves to the archive.
+
+    Returns:
+        tuple: (archive messages before this cursor, first cursor in the
+            inbox, cursor after the last message)
+    """
+    storage = get_storage()
+    end = storage.read_messages(username, sys.maxsize, 1)[1]
+    records = storage.iter_messages(username)
+    first_seq = next(records, (end, None))[0]
+    records.close()
+
+    cut = 0
+    if policy.max_messages:
+        cut = end - policy.max_messages
+    if policy.max_age_days:
+        cutoff = (now or datetime.now()) - timedelta(days=policy.max_age_days)
+        # Messages are stored in arrival order; stop at the first one
+        # that is new enough (or has no usable timestamp)
+        for seq, message in storage.iter_messages(username, first_seq):
+            sent = _message_time(message)
+            if sent is None or sent >= cutoff:
+                break
+            cut = max(cut, seq + 1)
+    if not policy.include_unread:
+        cut = min(cut, storage.get_read_cursor(username))
+    return max(cut, first_seq), first_seq, end
+
+
+def compact_user(username, policy=None, dry_run=False, only_due=False):
+    """
+    Apply a retention policy to one inbox.
+
+    Args:
+        username (str): Inbox owner
+        policy (RetentionPolicy): Defaults to the user's configured policy
+        dry_run (bool): Only report what would be archived
+        only_due (bool): Skip the rewrite unless something is archived
+
+    Returns:
+        dict: 'archived' and 'kept' message counts and whether the inbox
+            was 'rewritten'
+    """
+    username = sanitize_username(username)
+    if policy is None:
+        policy = policy_for(username)
+
+    setup_messages()
+    cut, first_seq, end = archive_point(username, policy)
+    if dry_run or (only_due and cut <= first_seq):
+        return {'archived': cut - first_seq, 'kept': end - cut, 'rewritten': False}
+    return get_storage().compact_inbox(username, cut)
+
+
+def compact_all(dry_run=False, only_due=False):
+    """
+    Apply every user's retention policy.
+
+    Returns:
+        dict: username -> compact_user() result, or {'error': message}
+    """
+    setup_messages()
+    user_policies = load_user_policies()
+    results = {}
+    for username in get_storage().list_inboxes():
+        try:
+            policy = policy_for(username, user_policies)
+            if only_due and not policy.enabled:
+                continue
+            results[username] = compact_user(username, policy, dry_run, only_due)
+        except Exception as e:
+            # One broken inbox mustn't stop the rest
+            results[username] = {'error': str(e)}
+    return results
+
+
+# ============================================
+# BACKGROUND JOB (API SERVER)
+# ============================================
+
+class CompactionWorker:
+    """
+    Runs compact_all() every `interval` seconds on a daemon thread.
+    Inboxes with nothing to archive are left alone.
+
+    Args:
+        interval (float): Seconds between runs (0 disables the worker)
+    """
+
+    def __init__(self, interval=None):
+        self.interval = config.COMPACTION_INTERVAL_SECONDS if interval is None else interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.archived = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_duration = None
+
+    def start(self):
+        """Start the compaction thread (no-op if already running or disabled)"""
+        with self._lock:
+            if self._thread is not None or self.interval <= 0:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run_loop, name="inbox-compaction", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run_loop(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        started = time.monotonic()
+        results = compact_all(only_due=True)
+        with self._lock:
+            self.runs += 1
+            self.last_run = datetime.now().isoformat()
+            self.last_duration = round(time.monotonic() - started, 3)
+            for result in results.values():
+                if 'error' in result:
+                    self.errors += 1
+                else:
+                    self.archived += result['archived']
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._thread is not None,
+                'interval_seconds': self.interval,
+                'runs': self.runs,
+                'archived': self.archived,
+                'errors': self.errors,
+                'last_run': self.last_run,
+                'last_duration_seconds': self.last_duration,
+            }
+
+
+# Shared by the API servers in this process
+compaction_worker = CompactionWorker()
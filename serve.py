@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# serve.py
+# E2E Encrypted Messenger - Multi-Process API Server
+#
+# `python api.py` serves everything from one Python process, so RSA work
+# (logins, sends, inbox decryption) is limited to one core by the GIL.
+# This runs api.py in several pre-forked worker processes instead:
+#
+#   python serve.py --workers 4 --port 5000
+#
+# The parent process:
+#   - runs setup()/setup_messages() and builds the user index once, by
+#     importing api.py, before any worker exists
+#   - opens the listening socket; every worker accepts from it, so the
+#     kernel spreads connections over whichever workers are free
+#   - forks the workers and restarts any that die; SIGTERM or Ctrl+C
+#     stops them all
+#
+# A login may be served by one worker and the next request by another,
+# so with more than one worker sessions go in the shared SQLite session
+# store (config.SESSION_STORE = "sqlite", see sessions.py). If
+# E2E_SESSION_SECRET isn't set, a random one is made for this run and
+# sessions from earlier runs are logged out. Everything else workers
+# share already goes through storage: inbox writes are locked across
+# processes, the user index polls for new users, and open streams
+# re-check the inbox every STREAM_HEARTBEAT_SECONDS for messages other
+# workers saved.
+#
+# Unix only (it needs fork); on Windows run api.py.
+
+import argparse
+import os
+import secrets
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import config
+
+# A worker that dies sooner than this after starting is restarted only
+# after a pause, so a crash at start-up doesn't become a fork loop
+MIN_WORKER_LIFETIME_SECONDS = 1.0
+
+
+def prepare_shared_state(workers):
+    """
+    Settings every worker must agree on, decided once before forking.
+
+    Args:
+        workers (int): Number of worker processes
+    """
+    if workers > 1 and config.SESSION_STORE == "memory":
+        # Any worker must be able to serve any login
+        config.SESSION_STORE = "sqlite"
+
+    if config.SESSION_STORE == "sqlite" and not config.SESSION_SECRET:
+        from sessions import SQLiteSessionBackend
+        config.SESSION_SECRET = secrets.token_hex(32)
+        # Sessions sealed with an earlier run's secret can't be opened now
+        SQLiteSessionBackend().clear()
+
+    if "E2E_DECRYPT_WORKERS" not in os.environ:
+        # The workers already use every core; split them for large inboxes
+        config.DECRYPT_WORKERS = max(1, (os.cpu_count() or 1) // workers)
+
+
+def open_listener(host, port, backlog=128):
+    """The listening socket shared by all workers"""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return socket.create_server((host, port), family=family, backlog=backlog)
+
+
+class WorkerManager:
+    """
+    Forks `workers` processes that serve `app` from `listener`, and keeps
+    that many running until stopped.
+
+    Args:
+        app: WSGI application
+        listener (socket.socket): Bound, listening socket
+        workers (int): Number of worker processes
+    """
+
+    def __init__(self, app, listener, workers):
+        self.app = app
+        self.listener = listener
+        self.workers = workers
+        self._children = {}  # pid -> (slot, start time)
+        self._pid = os.getpid()
+        self._stopping = False
+        self.restarts = 0
+
+    def run(self):
+        """Start the workers and supervise them until SIGTERM/SIGINT. Returns an exit code."""
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+        while self._children:
+            try:
+                pid, _status = os.wait()
+            except ChildProcessError:
+                break
+            slot, started = self._children.pop(pid, (None, None))
+            if slot is None or self._stopping:
+                continue
+
+            lifetime = time.monotonic() - started
+            print(f"✗ Worker {slot} (pid {pid}) exited after {lifetime:.1f}s; restarting", file=sys.stderr)
+            if lifetime < MIN_WORKER_LIFETIME_SECONDS:
+                time.sleep(MIN_WORKER_LIFETIME_SECONDS)
+            if not self._stopping:
+                self.restarts += 1
+                self._spawn(slot)
+
+        self.listener.close()
+        return 0
+
+    def stop(self):
+        """Ask every worker to finish (the workers exit; run() then returns)"""
+        self._stopping = True
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _handle_stop(self, signum, frame):
+        # A worker can get a signal before it has set up its own handlers
+        if os.getpid() != self._pid:
+            raise SystemExit(0)
+        self.stop()
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._serve()
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                # Never return into the parent's supervision loop
+                os._exit(code)
+        self._children[pid] = (slot, time.monotonic())
+
+    def _serve(self):
+        from werkzeug.serving import make_server
+        from durability import fsync_scheduler
+
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent turns Ctrl+C into SIGTERM
+        signal.signal(signal.SIGTERM, _raise_exit)
+
+        host, port = self.listener.getsockname()[:2]
+        server = make_server(host, port, self.app, threaded=True, fd=self.listener.fileno())
+        try:
+            server.serve_forever()
+        except SystemExit:
+            pass
+        finally:
+            server.server_close()
+            # Writes acknowledged under "batched" durability must hit the disk
+            fsync_scheduler.flush()
+
+
+def _raise_exit(signum, frame):
+    raise SystemExit(0)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Serve api.py from several worker processes")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=5000, help="Port to listen on (default: 5000)")
+    parser.add_argument(
+        "--workers", type=int, default=config.API_WORKERS,
+        help=f"Worker processes (default: E2E_API_WORKERS or one per core, here {config.API_WORKERS})"
+    )
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.workers < 1:
+        print("✗ --workers must be at least 1", file=sys.stderr)
+        return 1
+    if not hasattr(os, "fork"):
+        print("✗ serve.py needs fork(); on this platform run api.py instead", file=sys.stderr)
+        return 1
+
+    prepare_shared_state(args.workers)
+    try:
+        listener = open_listener(args.host, args.port)
+    except OSError as e:
+        print(f"✗ Can't listen on {args.host}:{args.port}: {e.strerror}", file=sys.stderr)
+        return 1
+
+    # One-time setup (directories, migrations, user index) happens here,
+    # in the parent, so workers never race each other through it
+    import api
+
+    print("=" * 60)
+    print("E2E Encrypted Messenger - API Server")
+    print("=" * 60)
+    print(f"\nListening on http://{args.host}:{args.port} with {args.workers} worker(s)")
+    print(f"Sessions: {config.SESSION_STORE} store")
+    print(f"Manager pid: {os.getpid()} (SIGTERM or Ctrl+C stops all workers)")
+    print("=" * 60 + "\n")
+    sys.stdout.flush()  # Or the workers would each print it again
+
+    return WorkerManager(api.app, listener, args.workers).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,573 @@
+# sessions.py
+# E2E Encrypted Messenger - Per-Session State for the API
+#
+# A login session holds the user's decrypted private key, so sessions
+# must not live forever. SessionStore keeps them by token with an idle
+# TTL (no request for a while), an absolute TTL (since login) and a cap
+# on their number (the least recently used is logged out first); a
+# background thread sweeps out expired ones.
+#
+# By default sessions live in the memory of one server process. With
+# config.SESSION_STORE = "sqlite" they are also written to a small SQLite
+# database shared by every worker process on the machine, so a token
+# issued by one worker works on all of them. The private key is stored
+# there encrypted (AES-GCM) under config.SESSION_SECRET, and tokens only
+# as hashes.
+
+import base64
+import hashlib
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import config
+
+SESSION_STORES = ("memory", "sqlite")
+
+
+class DecryptedMessageCache:
+    """
+    Memory-bounded LRU of decrypted message texts for one login session.
+
+    The web UI polls /api/inbox; with this cache a poll only pays the
+    RSA cost for messages the session hasn't seen before. Messages that
+    failed to decrypt are remembered too, since retrying can't succeed.
+    Keyed by message_storage.message_id().
+    """
+
+    FAILED = object()
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = config.SESSION_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _cost(message_id, text):
+        size = sys.getsizeof(message_id)
+        if text is not DecryptedMessageCache.FAILED:
+            size += sys.getsizeof(text)
+        return size
+
+    def get(self, message_id):
+        """Return the cached text, FAILED, or None if not cached"""
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(message_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, message_id, text):
+        """Cache a decrypted text (or FAILED), evicting least recently used entries"""
+        cost = self._cost(message_id, text)
+        if cost > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(message_id, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[message_id] = (text, cost)
+            self._bytes += cost
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_cost) = self._entries.popitem(last=False)
+                self._bytes -= evicted_cost
+
+    def clear(self):
+        """Drop every cached plaintext (on logout)"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# ============================================
+# SESSION STORE
+# ============================================
+
+class _Entry:
+    __slots__ = ('session', 'created', 'last_used')
+
+    def __init__(self, session, created, last_used):
+        self.session = session
+        self.created = created
+        self.last_used = last_used
+
+
+class SessionStore:
+    """
+    Login sessions by token: O(1) lookup, idle and absolute TTLs, and at
+    most max_sessions of them (least recently used evicted first).
+
+    Args:
+        build (callable): build(username, private_key, public_key) makes
+            a session dict; used for sessions loaded from a shared backend
+        on_end (callable): Called with each session that is logged out,
+            expires or is evicted (outside the store's lock)
+        idle_ttl (float): Seconds without a request before a session
+            expires (0 = never)
+        absolute_ttl (float): Seconds after login a session expires
+            whatever happens (0 = never)
+        max_sessions (int): Sessions kept at most (0 = no limit)
+        backend (SQLiteSessionBackend): Shared store, or None for this
+            process only
+    """
+
+    def __init__(self, build=None, on_end=None, idle_ttl=None, absolute_ttl=None, max_sessions=None,
+                 backend=None, sweep_interval=None):
+        self.build = build
+        self.on_end = on_end
+        self.idle_ttl = config.SESSION_IDLE_TTL_SECONDS if idle_ttl is None else idle_ttl
+        self.absolute_ttl = config.SESSION_ABSOLUTE_TTL_SECONDS if absolute_ttl is None else absolute_ttl
+        self.max_sessions = config.SESSION_MAX if max_sessions is None else max_sessions
+        self.sweep_interval = config.SESSION_SWEEP_INTERVAL_SECONDS if sweep_interval is None else sweep_interval
+        self.backend = backend
+        self._entries = OrderedDict()  # token -> _Entry, least recently used first
+        self._by_age = OrderedDict()   # token -> login time, oldest first
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.logins = 0
+        self.logouts = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _is_expired(self, created, last_used, now):
+        return (
+            (self.idle_ttl > 0 and now - last_used > self.idle_ttl)
+            or (self.absolute_ttl > 0 and now - created > self.absolute_ttl)
+        )
+
+    def _insert_locked(self, token, session, created, now):
+        self._entries[token] = _Entry(session, created, now)
+        self._by_age[token] = created
+        evicted = []
+        while self.max_sessions > 0 and len(self._entries) > self.max_sessions:
+            old_token, entry = self._entries.popitem(last=False)
+            del self._by_age[old_token]
+            evicted.append(entry.session)
+        self.evicted += len(evicted)
+        return evicted
+
+    def _pop_locked(self, token):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return None
+        del self._by_age[token]
+        return entry.session
+
+    def _end(self, sessions):
+        if self.on_end is not None:
+            for session in sessions:
+                self.on_end(session)
+
+    def add(self, token, session):
+        """Store a new session (from a login) under `token`"""
+        now = time.time()
+        if self.backend is not None:
+            self.backend.add(token, session, now, self.max_sessions)
+        with self._lock:
+            dropped = self._pop_locked(token)
+            evicted = self._insert_locked(token, session, now, now)
+            self.logins += 1
+        self._end(([dropped] if dropped is not None else []) + evicted)
+
+    def get(self, token):
+        """
+        The session for `token`, or None if there is none or it expired.
+        Counts as activity for the idle TTL.
+        """
+        if not isinstance(token, str) or not token:
+            return None
+        now = time.time()
+
+        if self.backend is not None:
+            return self._get_shared(token, now)
+
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            if not self._is_expired(entry.created, entry.last_used, now):
+                entry.last_used = now
+                self._entries.move_to_end(token)
+                return entry.session
+            self._pop_locked(token)
+            self.expired += 1
+        self._end([entry.session])
+        return None
+
+    def _get_shared(self, token, now):
+        # The shared row decides: it sees logouts, expiry and activity in
+        # every worker. The key is only unsealed when this process
+        # doesn't have the session yet.
+        with self._lock:
+            entry = self._entries.get(token)
+        record = self.backend.lookup(token, now, load_key=entry is None)
+        if record is None:
+            with self._lock:
+                session = self._pop_locked(token)
+                if session is not None:
+                    self.expired += 1
+            if session is not None:
+                self._end([session])
+            return None
+
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                entry.last_used = now
+                self._entries.move_to_end(token)
+                return entry.session
+        if record['private_key'] is None:
+            # Dropped here since we looked; load it properly
+            record = self.backend.lookup(token, now)
+            if record is None:
+                return None
+        session = self.build(record['username'], record['private_key'], record['public_key'])
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                # Another thread loaded it meanwhile
+                entry.last_used = now
+                return entry.session
+            evicted = self._insert_locked(token, session, record['created'], now)
+        self._end(evicted)
+        return session
+
+    def remove(self, token):
+        """Log a session out. Returns the session, or None if there was none."""
+        if not isinstance(token, str) or not token:
+            return None
+        if self.backend is not None:
+            self.backend.remove(token)
+        with self._lock:
+            session = self._pop_locked(token)
+            if session is not None:
+                self.logouts += 1
+        if session is not None:
+            self._end([session])
+        return session
+
+    def sweep(self, now=None):
+        """Drop every expired session. Returns how many were dropped here."""
+        now = time.time() if now is None else now
+        expired = []
+        with self._lock:
+            # Both orders are kept, so only the expired ends are looked at
+            while self._entries:
+                token, entry = next(iter(self._entries.items()))
+                if not self._is_expired(entry.created, entry.last_used, now):
+                    break
+                expired.append(self._pop_locked(token))
+            while self.absolute_ttl > 0 and self._by_age:
+                token, created = next(iter(self._by_age.items()))
+                if now - created <= self.absolute_ttl:
+                    break
+                expired.append(self._pop_locked(token))
+            self.expired += len(expired)
+        if self.backend is not None:
+            # Local copies idle here may still be in use by other workers;
+            # dropping them only frees memory
+            self.backend.sweep(now, self.idle_ttl, self.absolute_ttl)
+        self._end(expired)
+        return len(expired)
+
+    def __len__(self):
+        return len(self._entries)
+
+    # --- Background sweeping ---
+
+    def start(self):
+        """Start the sweeper thread (no-op if already running or disabled)"""
+        with self._lock:
+            if self._thread is not None or self.sweep_interval <= 0:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run_loop, name="session-sweeper", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run_loop(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception:
+                pass  # e.g. the shared database is locked; try again next time
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'backend': "memory" if self.backend is None else self.backend.name,
+                'sessions': len(self._entries),
+                'max_sessions': self.max_sessions,
+                'idle_ttl_seconds': self.idle_ttl,
+                'absolute_ttl_seconds': self.absolute_ttl,
+                'sweeping': self._thread is not None,
+                'logins': self.logins,
+                'logouts': self.logouts,
+                'expired': self.expired,
+                'evicted': self.evicted,
+            }
+        if self.backend is not None:
+            stats['shared_sessions'] = self.backend.count()
+        return stats
+
+
+# ============================================
+# SHARED BACKEND (SQLITE)
+# ============================================
+
+_SESSION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    token_hash BLOB PRIMARY KEY,
+    username TEXT NOT NULL,
+    public_key TEXT NOT NULL,
+    sealed_key BLOB NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (last_used);
+CREATE INDEX IF NOT EXISTS sessions_created ON sessions (created);
+"""
+
+
+class SQLiteSessionBackend:
+    """
+    Sessions shared by the worker processes on one machine.
+
+    Each row holds the username, public key and the private key sealed
+    with AES-GCM under a key derived from `secret` (every worker must
+    use the same one). last_used is written at most every
+    `touch_interval` seconds per session, so the idle TTL is that
+    approximate.
+
+    Args:
+        path (str): Database file
+        secret (str): config.SESSION_SECRET
+        idle_ttl, absolute_ttl (float): As for SessionStore
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path=None, secret=None, idle_ttl=None, absolute_ttl=None):
+        self.path = path or config.SESSION_DB_PATH
+        secret = config.SESSION_SECRET if secret is None else secret
+        if not secret:
+            raise ValueError("The shared session store needs E2E_SESSION_SECRET (the same in every worker)")
+        self._aead = AESGCM(hashlib.sha256(b"e2e-session-store\0" + secret.encode('utf-8')).digest())
+        self.idle_ttl = config.SESSION_IDLE_TTL_SECONDS if idle_ttl is None else idle_ttl
+        self.absolute_ttl = config.SESSION_ABSOLUTE_TTL_SECONDS if absolute_ttl is None else absolute_ttl
+        self.touch_interval = min(60.0, self.idle_ttl / 10) if self.idle_ttl > 0 else 60.0
+        self._local = threading.local()
+        self._setup_done = False
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Losing the last few logins in a power cut is fine
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._setup_done:
+                conn.executescript(_SESSION_SCHEMA)
+                self._setup_done = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _token_hash(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def _seal(self, token_hash, private_key):
+        der = private_key.private_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        nonce = os.urandom(12)
+        return nonce + self._aead.encrypt(nonce, der, token_hash)
+
+    def _unseal(self, token_hash, sealed):
+        der = self._aead.decrypt(sealed[:12], sealed[12:], token_hash)
+        return serialization.load_der_private_key(der, password=None)
+
+    def _expired(self, created, last_used, now):
+        return (
+            (self.idle_ttl > 0 and now - last_used > self.idle_ttl)
+            or (self.absolute_ttl > 0 and now - created > self.absolute_ttl)
+        )
+
+    def add(self, token, session, now, max_sessions=0):
+        token_hash = self._token_hash(token)
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (token_hash, username, public_key, sealed_key, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (token_hash, session['username'], session['public_key'],
+                 self._seal(token_hash, session['private_key']), now, now)
+            )
+            if max_sessions > 0:
+                conn.execute(
+                    "DELETE FROM sessions WHERE token_hash IN ("
+                    "SELECT token_hash FROM sessions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (max_sessions,)
+                )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def lookup(self, token, now, load_key=True):
+        """
+        Returns:
+            dict: username, public_key, private_key (None unless
+                load_key), created - or None if there is no such
+                session or it expired (it is then deleted)
+        """
+        token_hash = self._token_hash(token)
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT username, public_key, sealed_key, created, last_used FROM sessions WHERE token_hash = ?",
+            (token_hash,)
+        ).fetchone()
+        if row is None:
+            return None
+        username, public_key, sealed, created, last_used = row
+        if self._expired(created, last_used, now):
+            conn.execute("DELETE FROM sessions WHERE token_hash = ?", (token_hash,))
+            return None
+        if now - last_used > self.touch_interval:
+            conn.execute("UPDATE sessions SET last_used = ? WHERE token_hash = ?", (now, token_hash))
+        try:
+            private_key = self._unseal(token_hash, sealed) if load_key else None
+        except Exception:
+            # Sealed under a different secret: this worker is misconfigured,
+            # so leave the row for the others
+            return None
+        return {'username': username, 'public_key': public_key, 'private_key': private_key, 'created': created}
+
+    def remove(self, token):
+        self._connection().execute("DELETE FROM sessions WHERE token_hash = ?", (self._token_hash(token),))
+
+    def sweep(self, now, idle_ttl, absolute_ttl):
+        conditions, params = [], []
+        if idle_ttl > 0:
+            conditions.append("last_used < ?")
+            params.append(now - idle_ttl)
+        if absolute_ttl > 0:
+            conditions.append("created < ?")
+            params.append(now - absolute_ttl)
+        if conditions:
+            self._connection().execute(f"DELETE FROM sessions WHERE {' OR '.join(conditions)}", params)
+
+    def count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def clear(self):
+        """Log every session out (e.g. when the secret they were sealed with is gone)"""
+        self._connection().execute("DELETE FROM sessions")
+
+
+# ============================================
+# STREAM TICKETS
+# ============================================
+
+class StreamTickets:
+    """
+    Short-lived stand-ins for a session token, for /api/stream URLs:
+    EventSource can only send GET requests without a body or headers,
+    and a session token in a URL ends up in access logs, proxy logs and
+    browser history. A ticket is the session token sealed (AES-GCM) with
+    its expiry time, so any worker sharing the secret can redeem it and
+    nothing needs storing.
+
+    Args:
+        secret (str): config.SESSION_SECRET; if empty, a random key for
+            this process only
+        ttl (float): Seconds a ticket can be used to open a stream
+    """
+
+    _AAD = b"e2e-stream-ticket"
+
+    def __init__(self, secret=None, ttl=None):
+        secret = config.SESSION_SECRET if secret is None else secret
+        if secret:
+            key = hashlib.sha256(b"e2e-stream-ticket\0" + secret.encode('utf-8')).digest()
+        else:
+            key = os.urandom(32)
+        self._aead = AESGCM(key)
+        self.ttl = config.STREAM_TICKET_SECONDS if ttl is None else ttl
+
+    def issue(self, session_token, now=None):
+        """A ticket for `session_token`, valid for `ttl` seconds"""
+        expires = int((time.time() if now is None else now) + self.ttl)
+        nonce = os.urandom(12)
+        sealed = self._aead.encrypt(nonce, struct.pack('>Q', expires) + session_token.encode('utf-8'), self._AAD)
+        return base64.urlsafe_b64encode(nonce + sealed).decode('ascii').rstrip('=')
+
+    def redeem(self, ticket, now=None):
+        """The session token a ticket stands for, or None if it is invalid or expired"""
+        if not isinstance(ticket, str) or not ticket:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(ticket + '=' * (-len(ticket) % 4))
+            payload = self._aead.decrypt(raw[:12], raw[12:], self._AAD)
+        except Exception:
+            return None
+        expires, = struct.unpack('>Q', payload[:8])
+        if (time.time() if now is None else now) > expires:
+            return None
+        return payload[8:].decode('utf-8')
+
+
+def create_session_store(build, on_end):
+    """
+    The session store config.SESSION_STORE asks for.
+
+    Args:
+        build, on_end: As for SessionStore
+    """
+    if config.SESSION_STORE not in SESSION_STORES:
+        raise ValueError(
+            f"Unknown session store {config.SESSION_STORE!r}; choose one of: {', '.join(SESSION_STORES)}"
+        )
+    backend = SQLiteSessionBackend() if config.SESSION_STORE == "sqlite" else None
+    return SessionStore(build=build, on_end=on_end, backend=backend)
@@ -0,0 +1,1693 @@
+# storage.py
+# E2E Encrypted Messenger - Pluggable Storage Backends
+#
+# auth.py and message_storage.py never touch files directly; they go
+# through get_storage(), which returns one of:
+#   - FileBackend:   the original Users/, Keys/ and messages/ directories
+#   - SQLiteBackend: a single SQLite database (WAL mode)
+# Which one is used is set by config.STORAGE_BACKEND, and how hard their
+# writes wait for the disk by config.DURABILITY (see durability.py).
+
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import config
+from durability import check_level, fsync_scheduler, sync_written
+from envelope import MAGIC as ENVELOPE_MAGIC, MessageEnvelope, encode_record, decode_record
+from metrics import timer
+
+# Optional dependency for file locking
+try:
+    from filelock import FileLock, Timeout as FileLockTimeout
+except Exception:
+    FileLock = None
+    FileLockTimeout = None
+
+LOCK_TIMEOUT_SECONDS = 5
+
+# Messages fetched per query when a backend pages through an inbox
+ITER_PAGE_SIZE = 256
+
+# Where inbox writes spend their time (/api/metrics): waiting for the
+# lock, encoding records, writing, fsync (file backend) or commit
+# (SQLite), and renaming rewritten logs into place
+_write_phase = timer("e2e_inbox_write_phase_seconds", "Time spent in each step of writing to an inbox", label="phase")
+_LOCK_WAIT = _write_phase.labels("lock_wait")
+_SERIALIZE = _write_phase.labels("serialize")
+_WRITE = _write_phase.labels("write")
+_FSYNC = _write_phase.labels("fsync")
+_COMMIT = _write_phase.labels("commit")
+_RENAME = _write_phase.labels("rename")
+
+
+@contextmanager
+def _inbox_lock(log_file):
+    """Hold the recipient's file lock (if filelock is installed)"""
+    if FileLock is None:
+        # No locking available, write directly
+        yield
+        return
+
+    lock = FileLock(log_file + ".lock", timeout=LOCK_TIMEOUT_SECONDS)
+    try:
+        with _LOCK_WAIT.time():
+            lock.acquire()
+    except FileLockTimeout:
+        raise TimeoutError(f"Could not acquire file lock for {log_file!r} within {LOCK_TIMEOUT_SECONDS} seconds")
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+# ============================================
+# BACKEND INTERFACE
+# ============================================
+
+class StorageBackend:
+    """
+    Interface every storage backend implements.
+
+    Usernames passed to the message methods are already sanitized
+    (see message_storage.sanitize_username).
+    """
+
+    name = "base"
+
+    # One of durability.DURABILITY_LEVELS; see set_durability()
+    durability = "strict"
+
+    def setup(self):
+        """Create whatever directories/tables the backend needs"""
+        raise NotImplementedError
+
+    # --- Durability (see durability.py) ---
+
+    def set_durability(self, level):
+        """Choose how message writes reach the disk (a durability.DURABILITY_LEVELS entry)"""
+        previous, self.durability = self.durability, check_level(level)
+        if previous == "batched":
+            # Don't leave writes behind that the new level would have synced
+            fsync_scheduler.flush()
+
+    def durability_status(self):
+        """Durability level and, when batched, the fsync scheduler's numbers"""
+        status = {'level': self.durability}
+        if self.durability == "batched":
+            status['fsync_scheduler'] = fsync_scheduler.stats()
+        return status
+
+    # --- Users ---
+
+    def load_user(self, username):
+        """Return a user's data dict, or None if the user doesn't exist"""
+        raise NotImplementedError
+
+    def save_user(self, username, user_data):
+        """Create or overwrite a user's data dict"""
+        raise NotImplementedError
+
+    def list_users(self):
+        """Return a list of all registered usernames"""
+        raise NotImplementedError
+
+    def users_version(self):
+        """
+        Cheap token that changes whenever a user is added or removed,
+        used to invalidate the in-memory user directory. None means
+        "unknown" (the directory re-lists users on every check).
+        """
+        return None
+
+    # --- Private keys ---
+
+    def save_private_key(self, username, pem):
+        """Store a user's encrypted private key (PEM bytes)"""
+        raise NotImplementedError
+
+    def load_private_key(self, username):
+        """Return a user's encrypted private key (PEM bytes), or None"""
+        raise NotImplementedError
+
+    # --- Messages ---
+
+    def append_message(self, recipient, message_package):
+        """Add one message to the end of a recipient's inbox"""
+        self.append_messages(recipient, [message_package])
+
+    def append_messages(self, recipient, message_packages):
+        """Add several messages to the end of one recipient's inbox in one write"""
+        raise NotImplementedError
+
+    def append_message_groups(self, groups):
+        """
+        Store a batch of messages for many recipients.
+
+        Args:
+            groups (dict): recipient -> list of message packages
+        """
+        for recipient, message_packages in groups.items():
+            self.append_messages(recipient, message_packages)
+
+    def read_messages(self, recipient, since=0, limit=None):
+        """
+        Read messages from a recipient's inbox, oldest first.
+
+        Returns:
+            tuple: (list of message dicts, cursor for the next read)
+        """
+        raise NotImplementedError
+
+    def iter_messages(self, recipient, since=0):
+        """
+        Generator over a recipient's inbox, oldest first, without loading
+        it all into memory.
+
+        Yields:
+            tuple: (sequence number, message dict)
+        """
+        while True:
+            messages, next_cursor = self.read_messages(recipient, since, ITER_PAGE_SIZE)
+            if not messages:
+                return
+            first_seq = next_cursor - len(messages)
+            for i, message in enumerate(messages):
+                yield first_seq + i, message
+            since = next_cursor
+
+    def clear_messages(self, recipient):
+        """Delete every message in a recipient's inbox (and its archive)"""
+        raise NotImplementedError
+
+    def list_inboxes(self):
+        """Return the names of every recipient that has an inbox"""
+        raise NotImplementedError
+
+    # --- Retention (see retention.py) ---
+
+    def get_read_cursor(self, recipient):
+        """Cursor just past the last message the recipient has read (0 if none)"""
+        raise NotImplementedError
+
+    def set_read_cursor(self, recipient, cursor):
+        """Record that messages before `cursor` have been read (never moves back)"""
+        raise NotImplementedError
+
+    def compact_inbox(self, recipient, archive_before=0):
+        """
+        Rewrite a recipient's inbox compactly, moving the messages with
+        sequence numbers below `archive_before` into the archive. The
+        other messages keep their sequence numbers.
+
+        Returns:
+            dict: 'archived' and 'kept' message counts, and whether
+                anything was 'rewritten'
+        """
+        raise NotImplementedError
+
+    def iter_archived_messages(self, recipient):
+        """
+        Generator over a recipient's archived messages, oldest first.
+
+        Yields:
+            tuple: (sequence number, message dict)
+        """
+        raise NotImplementedError
+
+    # --- Conversation keys ---
+
+    def save_conversation_key(self, recipient, key_id, from_user, encrypted_key):
+        """
+        Remember the RSA-wrapped AES key that a recipient's session-key
+        messages refer to by key_id. An existing key_id is never replaced.
+
+        Returns:
+            bool: True if the key was new
+        """
+        raise NotImplementedError
+
+    def load_conversation_keys(self, recipient):
+        """Return key_id -> {'from_user', 'encrypted_key'} for a recipient"""
+        raise NotImplementedError
+
+    def migrate_legacy_inboxes(self):
+        """Convert inboxes written by older versions. Returns username -> count."""
+        return {}
+
+
+# ============================================
+# APPEND-ONLY INBOX LOG
+# ============================================
+#
+# FileBackend keeps an append-only log per recipient at messages/<user>.log:
+# the first line is a small JSON header, then one record per message.
+# Sending a message appends records instead of rewriting the whole inbox.
+#
+# Version 2 logs (written now) frame each record as a 4-byte little-endian
+# length followed by a binary envelope (see envelope.py), or by compact
+# JSON for the rare package an envelope can't hold. Version 1 logs (one
+# JSON object per line) are still read, and are rewritten as version 2
+# the next time something is appended to them.
+#
+# Next to it, messages/<user>.idx is an offset index: one 8-byte
+# little-endian file offset per record. A record's position in the log
+# is its sequence number, which is also the cursor handed to clients,
+# so reading "everything after cursor N" is one seek instead of a scan.
+# The index is only a hint - records missing from it are found by
+# scanning forward from the last indexed one.
+#
+# Compaction (see retention.py) moves the oldest records into archive
+# segments. The header of a compacted log carries "base_seq", the
+# sequence number of its first record, so numbers never move; index
+# entries are counted from there.
+
+INBOX_LOG_FORMAT = "e2e-inbox-log"
+INBOX_LOG_VERSION = 2
+_READABLE_LOG_VERSIONS = (1, 2)
+
+_INDEX_ENTRY = struct.Struct('<Q')
+_RECORD_LENGTH = struct.Struct('<I')
+
+
+def _index_path(log_file):
+    return log_file[:-len(".log")] + ".idx"
+
+
+def _log_header(base_seq=0):
+    header = {"format": INBOX_LOG_FORMAT, "version": INBOX_LOG_VERSION}
+    if base_seq:
+        header["base_seq"] = base_seq
+    return (json.dumps(header, separators=(',', ':')) + "\n").encode('utf-8')
+
+
+def _frame_record(payload):
+    return _RECORD_LENGTH.pack(len(payload)) + payload
+
+
+def _encode_record(message_package):
+    return _frame_record(encode_record(message_package))
+
+
+def _iter_records(f, version, log_size):
+    """
+    Yield (size on disk, payload) for each complete record from the
+    current position of f. Stops at a torn (partially written) last record.
+    """
+    if version == 1:
+        for line in iter(f.readline, b""):
+            # A record without its newline is still being written (or torn)
+            if not line.endswith(b"\n"):
+                return
+            yield len(line), line
+        return
+
+    while True:
+        prefix = f.read(_RECORD_LENGTH.size)
+        if len(prefix) < _RECORD_LENGTH.size:
+            return
+        (length,) = _RECORD_LENGTH.unpack(prefix)
+        if length > log_size - f.tell():
+            return
+        payload = f.read(length)
+        if len(payload) < length:
+            return
+        yield _RECORD_LENGTH.size + length, payload
+
+
+def _decode_payload(payload):
+    """Message dict for a record payload, or None if it can't be read"""
+    try:
+        return decode_record(payload)
+    except ValueError:
+        return None
+
+
+def _decoded_rows(rows):
+    """(seq, message dict) for each (seq, data) database row that can be read"""
+    for seq, data in rows:
+        message = _decode_payload(data)
+        if message is not None:
+            yield seq, message
+
+
+def _write_messages(log_file, message_packages, legacy_file=None, durability="strict"):
+    """
+    Helper function to append message records to the recipient's log with
+    (at most) one fsync, as the durability level asks
+    """
+    _migrate_legacy_inbox(log_file, legacy_file)
+    _upgrade_log(log_file)
+
+    with _SERIALIZE.time():
+        records = [_encode_record(message_package) for message_package in message_packages]
+
+    with open(log_file, 'a+b') as f:
+        _repair_log_tail(f, _index_path(log_file))
+        if f.seek(0, os.SEEK_END) == 0:
+            f.write(_log_header())
+        _sync_index(f, _index_path(log_file))
+
+        offset = f.seek(0, os.SEEK_END)
+        offsets = []
+        for record in records:
+            offsets.append(_INDEX_ENTRY.pack(offset))
+            offset += len(record)
+        with _WRITE.time():
+            f.write(b"".join(records))
+            f.flush()
+        with _FSYNC.time():
+            sync_written(f, durability)
+
+    # The index can always be rebuilt from the log, so it is not fsynced
+    with open(_index_path(log_file), 'ab') as idx:
+        idx.write(b"".join(offsets))
+
+
+def _repair_log_tail(f, index_file):
+    """
+    Drop a partially written last record left behind by a crash.
+    Must be called with the recipient's lock held.
+    """
+    end = f.seek(0, os.SEEK_END)
+    if end == 0:
+        return
+
+    f.seek(0)
+    first_offset, version, _ = _read_header(f, f.name)
+    if first_offset is None:
+        # Even the header is incomplete; start the log again
+        f.truncate(0)
+        return
+
+    # Walk forward from the last indexed record to the last complete one
+    _seek_record(f, index_file, sys.maxsize, first_offset, end, version)
+    offset = f.tell()
+    for size, _ in _iter_records(f, version, end):
+        offset += size
+    if offset < end:
+        f.truncate(offset)
+
+
+def _read_header(f, log_file):
+    """
+    Check the log header.
+
+    Returns:
+        tuple: (offset of the first record, log version, sequence number
+            of the first record), or (None, None, 0) if the header is incomplete
+    """
+    header = f.readline()
+    if not header.endswith(b"\n"):
+        return None, None, 0
+
+    try:
+        header = json.loads(header)
+    except json.JSONDecodeError:
+        return None, None, 0
+    if header.get('format') != INBOX_LOG_FORMAT or header.get('version') not in _READABLE_LOG_VERSIONS:
+        raise ValueError(f"Unsupported inbox log format in {log_file!r}: {header!r}")
+    base_seq = header.get('base_seq', 0)
+    if isinstance(base_seq, bool) or not isinstance(base_seq, int) or base_seq < 0:
+        raise ValueError(f"Bad base_seq in inbox log {log_file!r}: {base_seq!r}")
+    return f.tell(), header['version'], base_seq
+
+
+def _read_index_entry(idx, seq):
+    idx.seek(seq * _INDEX_ENTRY.size)
+    data = idx.read(_INDEX_ENTRY.size)
+    if len(data) != _INDEX_ENTRY.size:
+        return None
+    return _INDEX_ENTRY.unpack(data)[0]
+
+
+def _index_start(index_file, since, first_offset, log_size):
+    """
+    Find where to start scanning for record `since` (counted from the
+    first record in the log, not from sequence number 0).
+
+    Returns:
+        tuple: (position, file offset) of a record at or before `since`
+    """
+    try:
+        idx = open(index_file, 'rb')
+    except FileNotFoundError:
+        return 0, first_offset
+
+    with idx:
+        count = os.fstat(idx.fileno()).st_size // _INDEX_ENTRY.size
+        if count == 0:
+            return 0, first_offset
+
+        seq = min(since, count - 1)
+        offset = _read_index_entry(idx, seq)
+
+    # Ignore an index that points past the end of the log (stale or corrupt)
+    if offset is None or offset < first_offset or offset >= log_size:
+        return 0, first_offset
+    return seq, offset
+
+
+def _seek_record(f, index_file, since, first_offset, log_size, version):
+    """
+    Position f at a record at or before `since`, using the index when
+    it lines up with the log.
+
+    Returns:
+        int: Sequence number of the record f now points at
+    """
+    seq, offset = _index_start(index_file, since, first_offset, log_size)
+    if offset != first_offset:
+        f.seek(offset)
+        record = next(_iter_records(f, version, log_size), None)
+        if record is None or _decode_payload(record[1]) is None:
+            # The index belongs to an older copy of the log (e.g. one
+            # that was just rewritten); scan from the start instead
+            seq, offset = 0, first_offset
+    f.seek(offset)
+    return seq
+
+
+def _sync_index(f, index_file):
+    """
+    Make the offset index cover every complete record in the log.
+    Must be called with the recipient's lock held.
+    """
+    log_size = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    first_offset, version, _ = _read_header(f, f.name)
+    if first_offset is None:
+        return
+
+    try:
+        count = os.path.getsize(index_file) // _INDEX_ENTRY.size
+    except FileNotFoundError:
+        count = 0
+
+    seq = _seek_record(f, index_file, count, first_offset, log_size, version)
+    offset = f.tell()
+    if seq != count - 1 and count:
+        # Index doesn't match the log, rebuild it from scratch
+        seq, offset, count = 0, first_offset, 0
+        f.seek(offset)
+        with open(index_file, 'wb'):
+            pass
+
+    missing = []
+    for size, _ in _iter_records(f, version, log_size):
+        if seq >= count:
+            missing.append(_INDEX_ENTRY.pack(offset))
+        offset += size
+        seq += 1
+
+    if missing:
+        with open(index_file, 'ab') as idx:
+            idx.write(b"".join(missing))
+
+
+# A memory-mapped scan hands back the pages behind it every this many bytes
+_RELEASE_BYTES = 4 * 1024 * 1024
+
+
+class _LogReader:
+    """
+    Memory-mapped, read-only view of an inbox log.
+
+    Records are found through the offset index and decoded one at a
+    time, straight out of the mapping, so reading the newest few
+    messages of a huge inbox touches only those pages. Only records
+    complete when the reader was opened are seen.
+
+        with _LogReader(log_file) as reader:
+            for seq, start, end in reader.records(since):
+                message = reader.decode(start, end)
+    """
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.next_seq = 0
+        self._mm = None
+        self.version = None
+        self.first_offset = None
+        self.base_seq = 0
+
+        try:
+            with open(log_file, 'rb') as f:
+                self.first_offset, self.version, self.base_seq = _read_header(f, log_file)
+                size = os.fstat(f.fileno()).st_size
+                if self.first_offset is not None and size > self.first_offset:
+                    self._mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return
+
+        if self._mm is not None and hasattr(self._mm, 'madvise'):
+            self._mm.madvise(mmap.MADV_SEQUENTIAL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                pass  # A caller still holds a view into it; it's unmapped when collected
+            self._mm = None
+
+    def _release(self, start, upto):
+        end = upto - upto % mmap.PAGESIZE
+        if end > start and hasattr(mmap, 'MADV_DONTNEED'):
+            self._mm.madvise(mmap.MADV_DONTNEED, start, end - start)
+        return max(start, end)
+
+    def _record_at(self, offset):
+        """(start, end) of the record payload at `offset`, or None if incomplete"""
+        mm = self._mm
+        if self.version == 1:
+            newline = mm.find(b"\n", offset)
+            return None if newline == -1 else (offset, newline + 1)
+
+        payload_start = offset + _RECORD_LENGTH.size
+        if payload_start > len(mm):
+            return None
+        (length,) = _RECORD_LENGTH.unpack_from(mm, offset)
+        if payload_start + length > len(mm):
+            return None
+        return payload_start, payload_start + length
+
+    def payload(self, start, end):
+        """Raw bytes of the record payload at [start, end)"""
+        return self._mm[start:end]
+
+    def decode(self, start, end):
+        """Message dict for the payload at [start, end), or None if it can't be read"""
+        mm = self._mm
+        try:
+            if mm[start:start + len(ENVELOPE_MAGIC)] == ENVELOPE_MAGIC:
+                envelope = MessageEnvelope(mm, start)
+                if envelope.size != end - start:
+                    return None
+                return envelope.to_package()
+            return json.loads(mm[start:end])
+        except ValueError:
+            return None
+
+    def records(self, since=0):
+        """
+        Yield (seq, start, end) for every complete record from `since` on.
+        next_seq is kept up to date, ending as the cursor after the last
+        record looked at.
+        """
+        self.next_seq = self.base_seq
+        if self._mm is None:
+            return
+
+        # Positions in the log (and the index) count from base_seq
+        base = self.base_seq
+        since = max(since - base, 0)
+        log_size = len(self._mm)
+        pos, offset = _index_start(_index_path(self.log_file), since, self.first_offset, log_size)
+        if offset != self.first_offset:
+            record = self._record_at(offset)
+            if record is None or self.decode(*record) is None:
+                # The index belongs to an older copy of the log; scan from the start
+                pos, offset = 0, self.first_offset
+
+        self.next_seq = base + pos
+        released = offset - offset % mmap.PAGESIZE
+        while offset < log_size:
+            record = self._record_at(offset)
+            if record is None:
+                return  # Torn or still being written
+            start, end = record
+            offset = end
+            self.next_seq = base + pos + 1
+            if pos >= since:
+                yield base + pos, start, end
+            pos += 1
+
+            # Drop pages we've walked past, so a long scan doesn't keep the
+            # whole file resident in this process
+            if offset - released >= _RELEASE_BYTES:
+                released = self._release(released, offset)
+
+
+def _read_log(log_file, since=0, limit=None):
+    """
+    Read complete records from an inbox log, starting at sequence number `since`.
+
+    Returns:
+        tuple: (list of message dicts, cursor for the next read)
+    """
+    messages = []
+    with _LogReader(log_file) as reader:
+        for _, start, end in reader.records(since):
+            message = reader.decode(start, end)
+            if message is not None:
+                messages.append(message)
+            if limit is not None and len(messages) >= limit:
+                break
+        return messages, reader.next_seq
+
+
+def _iter_log(log_file, since=0):
+    """Generator of (seq, message dict) from `since` on, decoded lazily from a memory map"""
+    with _LogReader(log_file) as reader:
+        for seq, start, end in reader.records(since):
+            message = reader.decode(start, end)
+            if message is not None:
+                yield seq, message
+
+
+def _write_temp_log(target_dir, payloads, base_seq=0):
+    """
+    Write a complete, fsynced log holding `payloads` (record payloads,
+    in order) to a temporary file in target_dir.
+
+    Returns:
+        str: Path of the temporary file (the caller renames or removes it)
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix="msg_", dir=target_dir)
+    try:
+        with os.fdopen(fd, 'wb') as tmpf:
+            tmpf.write(_log_header(base_seq))
+            for payload in payloads:
+                tmpf.write(_frame_record(payload))
+            tmpf.flush()
+            os.fsync(tmpf.fileno())
+    except BaseException:
+        _remove_quietly(tmp_path)
+        raise
+    return tmp_path
+
+
+def _remove_quietly(path):
+    if path is not None and os.path.exists(path):
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
+
+def _replace_log(tmp_path, log_file):
+    """Move a finished temporary log over log_file (recipient's lock held)"""
+    try:
+        # Offsets change: drop the index first (it is rebuilt on the next
+        # write), so a crash can never leave it pointing into the new log
+        with _RENAME.time():
+            if os.path.exists(_index_path(log_file)):
+                os.remove(_index_path(log_file))
+            os.replace(tmp_path, log_file)
+    finally:
+        _remove_quietly(tmp_path)
+
+
+def _rewrite_log(log_file, payloads, base_seq=0):
+    """
+    Atomically replace a log with one holding `payloads` (record
+    payloads, in order). Must be called with the recipient's lock held.
+    """
+    _replace_log(_write_temp_log(os.path.dirname(log_file) or ".", payloads, base_seq), log_file)
+
+
+def _upgrade_log(log_file):
+    """
+    Rewrite a version 1 (JSON lines) log in the current format, keeping
+    every record - even unreadable ones - so sequence numbers don't move.
+    Must be called with the recipient's lock held.
+
+    Returns:
+        bool: True if the log was rewritten
+    """
+    try:
+        f = open(log_file, 'rb')
+    except FileNotFoundError:
+        return False
+
+    with f:
+        first_offset, version, _ = _read_header(f, log_file)
+        if first_offset is None or version == INBOX_LOG_VERSION:
+            return False
+        log_size = os.fstat(f.fileno()).st_size
+        payloads = []
+        for _, line in _iter_records(f, version, log_size):
+            message = _decode_payload(line)
+            payloads.append(encode_record(message) if isinstance(message, dict) else line.rstrip(b"\n"))
+
+    _rewrite_log(log_file, payloads)
+    return True
+
+
+def _load_legacy_inbox(legacy_file):
+    try:
+        with open(legacy_file, 'r') as f:
+            messages = json.load(f)
+    except json.JSONDecodeError:
+        return []
+    return messages if isinstance(messages, list) else []
+
+
+def _migrate_legacy_inbox(log_file, legacy_file=None):
+    """
+    Convert messages/<user>.json (the old JSON-array inbox) into the
+    append-only log. Must be called with the recipient's lock held.
+
+    Returns:
+        int: Number of legacy messages migrated (0 if nothing to do)
+    """
+    if legacy_file is None:
+        legacy_file = log_file[:-len(".log")] + ".json"
+    if not os.path.exists(legacy_file):
+        return 0
+
+    legacy_messages = _load_legacy_inbox(legacy_file)
+    # Keep anything already appended to the log after the legacy records
+    messages = legacy_messages + _read_log(log_file)[0]
+
+    _rewrite_log(log_file, [encode_record(message) for message in messages])
+    os.remove(legacy_file)
+    return len(legacy_messages)
+
+
+def _compacted_payload(payload):
+    """
+    A record payload in its smallest form: envelopes as they are, JSON
+    re-encoded (as an envelope where possible). Unreadable records
+    become empty placeholders, so the records after them keep their
+    sequence numbers.
+    """
+    if payload[:len(ENVELOPE_MAGIC)] == ENVELOPE_MAGIC:
+        return payload
+    message = _decode_payload(payload)
+    return encode_record(message) if isinstance(message, dict) else b""
+
+
+def _segment_name(first_seq):
+    # Zero-padded so segments sort in sequence order
+    return f"{first_seq:012d}.log"
+
+
+def _compact_log(log_file, segment_dir, archive_before):
+    """
+    Move the records of a log before sequence number `archive_before`
+    into a new archive segment in segment_dir and rewrite the rest
+    compactly. Nothing is rewritten if that would change nothing.
+    Must be called with the recipient's lock held.
+
+    Returns:
+        dict: See StorageBackend.compact_inbox
+    """
+    stats = {'archived': 0, 'kept': 0, 'rewritten': False}
+    segment_tmp = live_tmp = None
+    try:
+        with _LogReader(log_file) as reader:
+            if reader.first_offset is None:
+                return stats
+
+            base = reader.base_seq
+            records = list(reader.records())
+            cut = min(max(archive_before, base), reader.next_seq)
+            archived = [(start, end) for seq, start, end in records if seq < cut]
+            kept = [(start, end) for seq, start, end in records if seq >= cut]
+            stats['archived'] = len(archived)
+            stats['kept'] = len(kept)
+
+            if not archived and all(
+                _compacted_payload(reader.payload(start, end)) == reader.payload(start, end)
+                for start, end in kept
+            ):
+                return stats
+
+            if archived:
+                os.makedirs(segment_dir, exist_ok=True)
+                segment_tmp = _write_temp_log(
+                    segment_dir, (_compacted_payload(reader.payload(*r)) for r in archived), base
+                )
+            live_tmp = _write_temp_log(
+                os.path.dirname(log_file) or ".", (_compacted_payload(reader.payload(*r)) for r in kept), cut
+            )
+
+        # Archive first: after a crash in between, the next run archives
+        # the same records again over the same segment
+        if segment_tmp is not None:
+            os.replace(segment_tmp, os.path.join(segment_dir, _segment_name(base)))
+        _replace_log(live_tmp, log_file)
+        stats['rewritten'] = True
+
+        with open(log_file, 'r+b') as f:
+            _sync_index(f, _index_path(log_file))
+        return stats
+    finally:
+        _remove_quietly(segment_tmp)
+        _remove_quietly(live_tmp)
+
+
+def _iter_segments(segment_dir):
+    """Generator of (seq, message dict) over every archive segment in segment_dir"""
+    try:
+        names = sorted(name for name in os.listdir(segment_dir) if name.endswith(".log"))
+    except FileNotFoundError:
+        return
+    for name in names:
+        yield from _iter_log(os.path.join(segment_dir, name))
+
+
+# ============================================
+# FILE LAYOUT
+# ============================================
+#
+# With hundreds of thousands of users, one file per user in a single
+# directory makes every lookup and listing slow. In the "sharded" layout
+# (the default) per-user files live two directory levels down, picked
+# by a hash of the name:
+#
+#   Users/3b/a9/alice.json   Keys/3b/a9/alice.key   messages/7d/10/bob.log
+#
+# The "flat" layout is the original Users/alice.json etc. Files are
+# looked for in the configured layout first and the other one second,
+# so a data directory keeps working while `manage.py migrate-layout`
+# moves its files across (which is safe with servers running).
+
+FILE_LAYOUTS = ("sharded", "flat")
+
+
+def _shard(name):
+    digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+    return digest[0:2], digest[2:4]
+
+
+def _is_shard_name(name):
+    return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+
+def _flat_files(directory):
+    try:
+        with os.scandir(directory) as entries:
+            return [entry.name for entry in entries if entry.is_file()]
+    except FileNotFoundError:
+        return []
+
+
+def _flat_dirs(directory):
+    try:
+        with os.scandir(directory) as entries:
+            return [entry.name for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+def _sharded_files(directory):
+    names = []
+    for top in _flat_dirs(directory):
+        if not _is_shard_name(top):
+            continue
+        for sub in _flat_dirs(os.path.join(directory, top)):
+            if _is_shard_name(sub):
+                names.extend(_flat_files(os.path.join(directory, top, sub)))
+    return names
+
+
+def _move(source, target):
+    """Move a file or directory into place, creating its shard directories"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(source, target)
+
+
+# ============================================
+# FILE BACKEND
+# ============================================
+
+class FileBackend(StorageBackend):
+    """
+    Users/<name>.json, Keys/<name>.key and messages/<name>.log, with
+    archived messages in messages/archive/<name>/<first seq>.log - each
+    in a two-level shard directory in the sharded layout (see above)
+    """
+
+    name = "file"
+
+    # Files that make up one inbox, moved together by migrate_layout()
+    _INBOX_SUFFIXES = (".log", ".idx", ".json", ".keys", ".read")
+
+    # Touched whenever a user file is created, because in the sharded
+    # layout that no longer changes the mtime of Users/ itself
+    _USERS_STAMP = ".users-changed"
+
+    def __init__(self, user_dir=None, keys_dir=None, message_dir=None, archive_dir=None, layout=None,
+                 durability=None):
+        self.user_dir = user_dir or config.USER_DIR
+        self.keys_dir = keys_dir or config.KEYS_DIR
+        self.message_dir = message_dir or config.MESSAGE_DIR
+        if archive_dir is None:
+            # Follows a non-default message_dir unless configured explicitly
+            archive_dir = config.ARCHIVE_DIR if message_dir is None else os.path.join(message_dir, "archive")
+        self.archive_dir = archive_dir
+        self.layout = layout or config.FILE_LAYOUT
+        if self.layout not in FILE_LAYOUTS:
+            raise ValueError(f"Unknown file layout {self.layout!r}; choose one of: {', '.join(FILE_LAYOUTS)}")
+        self.durability = check_level(durability or config.DURABILITY)
+
+    def setup(self):
+        for directory in (self.user_dir, self.keys_dir, self.message_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    # --- Paths ---
+
+    @staticmethod
+    def _check_name(username):
+        # Usernames become file names; never let one escape its directory
+        if not isinstance(username, str) or not username or username.startswith('.') \
+                or '/' in username or '\\' in username or '\0' in username:
+            raise ValueError(f"invalid username for file storage: {username!r}")
+        return username
+
+    def _layout_paths(self, directory, name, filename):
+        """(path in the configured layout, path in the other layout)"""
+        sharded = os.path.join(directory, *_shard(name), filename)
+        flat = os.path.join(directory, filename)
+        return (sharded, flat) if self.layout == "sharded" else (flat, sharded)
+
+    def _resolve(self, directory, name, filename):
+        """
+        Where a per-user file is - or, if it doesn't exist yet, where it
+        should be created.
+        """
+        primary, fallback = self._layout_paths(directory, name, filename)
+        if os.path.exists(primary):
+            return primary
+        if os.path.exists(fallback):
+            return fallback
+        # New file - or one migrate_layout() moved across between the two checks
+        return primary
+
+    def _open(self, resolve, name, mode):
+        """Open a per-user file for reading, even if it is being migrated right now"""
+        try:
+            return open(resolve(name), mode)
+        except FileNotFoundError:
+            return open(resolve(name), mode)
+
+    def _user_path(self, username):
+        name = self._check_name(username)
+        return self._resolve(self.user_dir, name, f"{name}.json")
+
+    def _key_path(self, username):
+        name = self._check_name(username)
+        return self._resolve(self.keys_dir, name, f"{name}.key")
+
+    def _inbox_file(self, recipient, suffix):
+        return self._resolve(self.message_dir, recipient, f"{recipient}{suffix}")
+
+    def _inbox_log_path(self, recipient):
+        return self._inbox_file(recipient, ".log")
+
+    def _legacy_inbox_path(self, recipient):
+        return self._inbox_file(recipient, ".json")
+
+    def _conversation_keys_path(self, recipient):
+        return self._inbox_file(recipient, ".keys")
+
+    def _read_cursor_path(self, recipient):
+        return self._inbox_file(recipient, ".read")
+
+    def _segment_dir(self, recipient):
+        return self._resolve(self.archive_dir, recipient, recipient)
+
+    @contextmanager
+    def _inbox_locked(self, recipient):
+        """
+        Hold a recipient's inbox lock. The lock file is always at the
+        sharded path, whatever the layout and wherever the inbox files
+        are right now, so processes never disagree about it.
+        """
+        log_file = os.path.join(self.message_dir, *_shard(recipient), f"{recipient}.log")
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        with _inbox_lock(log_file):
+            yield
+
+    def _list_names(self, directory, suffixes):
+        # The other layout first: migrate_layout() moves files from it
+        # into this one, so a file moved mid-listing is still seen
+        layouts = (_flat_files, _sharded_files) if self.layout == "sharded" else (_sharded_files, _flat_files)
+        names = set()
+        for list_files in layouts:
+            for filename in list_files(directory):
+                stem, ext = os.path.splitext(filename)
+                if ext in suffixes and not stem.startswith('.'):
+                    names.add(stem)
+        return names
+
+    # --- Users ---
+
+    def load_user(self, username):
+        try:
+            with self._open(self._user_path, username, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_user(self, username, user_data):
+        path = self._user_path(username)
+        is_new = not os.path.exists(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(user_data, f, indent=2)
+        if is_new:
+            self._touch_users_stamp()
+
+    def _touch_users_stamp(self):
+        stamp = os.path.join(self.user_dir, self._USERS_STAMP)
+        with open(stamp, 'a'):
+            pass
+        os.utime(stamp, None)
+
+    def list_users(self):
+        return list(self._list_names(self.user_dir, ('.json',)))
+
+    def users_version(self):
+        # Creating a user touches the stamp file; deleting one from the
+        # flat layout (by hand) still updates the directory mtime
+        try:
+            version = os.stat(self.user_dir).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        try:
+            return max(version, os.stat(os.path.join(self.user_dir, self._USERS_STAMP)).st_mtime_ns)
+        except FileNotFoundError:
+            return version
+
+    # --- Private keys ---
+
+    def save_private_key(self, username, pem):
+        path = self._key_path(username)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(pem)
+
+    def load_private_key(self, username):
+        try:
+            with self._open(self._key_path, username, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    # --- Messages ---
+
+    def append_messages(self, recipient, message_packages):
+        with self._inbox_locked(recipient):
+            _write_messages(
+                self._inbox_log_path(recipient), message_packages, self._legacy_inbox_path(recipient), self.durability
+            )
+
+    def _migrate_if_legacy(self, recipient):
+        # Inboxes written by older versions are converted on first read
+        if os.path.exists(self._legacy_inbox_path(recipient)):
+            with self._inbox_locked(recipient):
+                _migrate_legacy_inbox(self._inbox_log_path(recipient), self._legacy_inbox_path(recipient))
+
+    def read_messages(self, recipient, since=0, limit=None):
+        self._migrate_if_legacy(recipient)
+
+        log_file = self._inbox_log_path(recipient)
+        messages, next_cursor = _read_log(log_file, since, limit)
+        if not messages and not os.path.exists(log_file):
+            # Moved to the other layout while we were reading
+            messages, next_cursor = _read_log(self._inbox_log_path(recipient), since, limit)
+        return messages, next_cursor
+
+    def iter_messages(self, recipient, since=0):
+        self._migrate_if_legacy(recipient)
+
+        # Memory-mapped: only the records actually consumed are decoded
+        log_file = self._inbox_log_path(recipient)
+        found = False
+        for seq, message in _iter_log(log_file, since):
+            found = True
+            yield seq, message
+        if not found and not os.path.exists(log_file):
+            # Moved to the other layout while we were reading
+            yield from _iter_log(self._inbox_log_path(recipient), since)
+
+    def clear_messages(self, recipient):
+        with self._inbox_locked(recipient):
+            for suffix in self._INBOX_SUFFIXES:
+                for message_file in self._layout_paths(self.message_dir, recipient, f"{recipient}{suffix}"):
+                    if os.path.exists(message_file):
+                        os.remove(message_file)
+            for segment_dir in self._layout_paths(self.archive_dir, recipient, recipient):
+                shutil.rmtree(segment_dir, ignore_errors=True)
+
+    def list_inboxes(self):
+        return sorted(self._list_names(self.message_dir, ('.log', '.json')))
+
+    # --- Retention ---
+
+    def get_read_cursor(self, recipient):
+        try:
+            with self._open(self._read_cursor_path, recipient, 'r') as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def set_read_cursor(self, recipient, cursor):
+        with self._inbox_locked(recipient):
+            if cursor <= self.get_read_cursor(recipient):
+                return
+            # Not fsynced: losing it only means fewer messages count as read
+            target = self._read_cursor_path(recipient)
+            fd, tmp_path = tempfile.mkstemp(prefix="read_", dir=os.path.dirname(target))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(str(cursor))
+                os.replace(tmp_path, target)
+            finally:
+                _remove_quietly(tmp_path)
+
+    def compact_inbox(self, recipient, archive_before=0):
+        with self._inbox_locked(recipient):
+            log_file = self._inbox_log_path(recipient)
+            _migrate_legacy_inbox(log_file, self._legacy_inbox_path(recipient))
+            _upgrade_log(log_file)
+            return _compact_log(log_file, self._segment_dir(recipient), archive_before)
+
+    def iter_archived_messages(self, recipient):
+        yield from _iter_segments(self._segment_dir(recipient))
+
+    # --- Conversation keys ---
+
+    def save_conversation_key(self, recipient, key_id, from_user, encrypted_key):
+        # messages/<user>.keys: one JSON line per key, first one wins
+        with self._inbox_locked(recipient):
+            if key_id in self.load_conversation_keys(recipient):
+                return False
+            line = json.dumps({'key_id': key_id, 'from_user': from_user, 'encrypted_key': encrypted_key})
+            with open(self._conversation_keys_path(recipient), 'ab') as f:
+                f.write(line.encode('utf-8') + b"\n")
+                f.flush()
+                sync_written(f, self.durability)
+            return True
+
+    def load_conversation_keys(self, recipient):
+        keys = {}
+        try:
+            with self._open(self._conversation_keys_path, recipient, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Torn last line
+                    keys.setdefault(record['key_id'], {
+                        'from_user': record['from_user'],
+                        'encrypted_key': record['encrypted_key'],
+                    })
+        except FileNotFoundError:
+            pass
+        return keys
+
+    # --- Maintenance ---
+
+    def migrate_legacy_inboxes(self):
+        migrated = {}
+        for recipient in sorted(self._list_names(self.message_dir, ('.json',))):
+            with self._inbox_locked(recipient):
+                migrated[recipient] = _migrate_legacy_inbox(
+                    self._inbox_log_path(recipient), self._legacy_inbox_path(recipient)
+                )
+        return migrated
+
+    def migrate_layout(self):
+        """
+        Move every per-user file still in the other layout into the
+        configured one. Safe to run while servers are using the data
+        directory, and to run again after an interruption.
+
+        Returns:
+            dict: Number of users, keys and inboxes moved, and 'conflicts':
+                files left in place because the target already exists
+        """
+        counts = {'users': 0, 'keys': 0, 'inboxes': 0, 'conflicts': 0}
+
+        def move(name, directory, filename):
+            target, source = self._layout_paths(directory, name, filename)
+            if not os.path.exists(source):
+                return False
+            if os.path.exists(target):
+                counts['conflicts'] += 1
+                return False
+            _move(source, target)
+            return True
+
+        for directory, suffix, kind in ((self.user_dir, '.json', 'users'), (self.keys_dir, '.key', 'keys')):
+            for name in sorted(self._list_names(directory, (suffix,))):
+                if move(name, directory, f"{name}{suffix}"):
+                    counts[kind] += 1
+
+        for recipient in sorted(self._list_names(self.message_dir, self._INBOX_SUFFIXES)):
+            with self._inbox_locked(recipient):
+                moved = False
+                for suffix in self._INBOX_SUFFIXES:
+                    if suffix == ".idx":
+                        # Rebuilt from the log; a stale copy isn't worth a conflict
+                        target, source = self._layout_paths(self.message_dir, recipient, f"{recipient}.idx")
+                        if os.path.exists(source) and os.path.exists(target):
+                            os.remove(source)
+                            continue
+                    moved = move(recipient, self.message_dir, f"{recipient}{suffix}") or moved
+                moved = move(recipient, self.archive_dir, recipient) or moved
+                if moved:
+                    counts['inboxes'] += 1
+
+                # Lock file left behind by older versions, which locked next to the flat log
+                _remove_quietly(os.path.join(self.message_dir, f"{recipient}.log.lock"))
+
+        if counts['users']:
+            self._touch_users_stamp()
+        return counts
+
+    def iter_inboxes(self):
+        """
+        Yield (recipient, records) for every inbox without modifying
+        anything on disk (legacy JSON-array inboxes are read as-is).
+        records is a list of (sequence number, message dict) pairs.
+        """
+        for recipient in self.list_inboxes():
+            log_file = self._inbox_log_path(recipient)
+            legacy_file = self._legacy_inbox_path(recipient)
+            if os.path.exists(legacy_file):
+                # Numbered the way _migrate_legacy_inbox will number them
+                messages = _load_legacy_inbox(legacy_file) + _read_log(log_file)[0]
+                yield recipient, list(enumerate(messages))
+            else:
+                yield recipient, list(_iter_log(log_file))
+
+
+# ============================================
+# SQLITE BACKEND
+# ============================================
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS private_keys (
+    username TEXT PRIMARY KEY,
+    pem BLOB NOT NULL
+);
+
+-- data holds either a v1 JSON package (TEXT) or a v2 binary envelope
+-- (BLOB); expect both in one table. Databases created before envelopes
+-- still declare data TEXT, which is harmless: TEXT affinity never
+-- converts BLOB values.
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    recipient TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    data BLOB NOT NULL,
+    UNIQUE (recipient, seq)
+);
+
+CREATE INDEX IF NOT EXISTS messages_recipient_timestamp
+    ON messages (recipient, timestamp);
+
+CREATE TABLE IF NOT EXISTS conversation_keys (
+    recipient TEXT NOT NULL,
+    key_id TEXT NOT NULL,
+    from_user TEXT NOT NULL,
+    encrypted_key TEXT NOT NULL,
+    PRIMARY KEY (recipient, key_id)
+);
+
+-- data: as in messages, TEXT and BLOB rows mixed
+CREATE TABLE IF NOT EXISTS messages_archive (
+    recipient TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (recipient, seq)
+);
+
+CREATE TABLE IF NOT EXISTS read_cursors (
+    recipient TEXT PRIMARY KEY,
+    cursor INTEGER NOT NULL
+);
+"""
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Everything in one SQLite database.
+
+    Each thread (and each process after a fork) gets its own connection.
+    Every inbox numbers its messages 0, 1, 2, ... in the `seq` column,
+    the same cursor scheme the file backend uses. Archived messages move
+    to messages_archive with their seq unchanged.
+    """
+
+    name = "sqlite"
+
+    # PRAGMA synchronous per durability level. In WAL mode NORMAL syncs
+    # the WAL only when it is checkpointed, which "batched" does on the
+    # fsync scheduler's thread; OFF never syncs.
+    _SYNCHRONOUS = {"strict": "FULL", "batched": "NORMAL", "none": "OFF"}
+
+    def __init__(self, path=None, durability=None):
+        self.path = path or config.SQLITE_PATH
+        self._local = threading.local()
+        self.durability = check_level(durability or config.DURABILITY)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT_SECONDS, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.durability = None
+        if self._local.durability != self.durability:
+            # Also picks up set_durability() on connections opened earlier
+            conn.execute(f"PRAGMA synchronous={self._SYNCHRONOUS[self.durability]}")
+            self._local.durability = self.durability
+        return conn
+
+    def _checkpoint(self):
+        # Syncs the WAL, then copies what it can into the database file
+        self._connection().execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT, so concurrent writers queue up on the write lock"""
+        conn = self._connection()
+        with _LOCK_WAIT.time():
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        with _COMMIT.time():
+            conn.execute("COMMIT")
+        if self.durability == "batched":
+            fsync_scheduler.mark_dirty(self.path, self._checkpoint)
+
+    def setup(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(_SQLITE_SCHEMA)
+
+    # --- Users ---
+
+    def load_user(self, username):
+        row = self._connection().execute(
+            "SELECT data FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_user(self, username, user_data):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)",
+                (username, json.dumps(user_data))
+            )
+
+    def list_users(self):
+        rows = self._connection().execute("SELECT username FROM users ORDER BY username")
+        return [row[0] for row in rows]
+
+    def users_version(self):
+        # INSERT OR REPLACE always allocates a new rowid
+        row = self._connection().execute("SELECT MAX(rowid) FROM users").fetchone()
+        return row[0]
+
+    # --- Private keys ---
+
+    def save_private_key(self, username, pem):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO private_keys (username, pem) VALUES (?, ?)",
+                (username, pem)
+            )
+
+    def load_private_key(self, username):
+        row = self._connection().execute(
+            "SELECT pem FROM private_keys WHERE username = ?", (username,)
+        ).fetchone()
+        return bytes(row[0]) if row else None
+
+    # --- Messages ---
+
+    def _next_seq(self, conn, recipient):
+        # The archive counts too: an inbox that was archived completely
+        # mustn't start again at 0
+        row = conn.execute(
+            "SELECT MAX("
+            "COALESCE((SELECT MAX(seq) + 1 FROM messages WHERE recipient = ?), 0), "
+            "COALESCE((SELECT MAX(seq) + 1 FROM messages_archive WHERE recipient = ?), 0))",
+            (recipient, recipient)
+        ).fetchone()
+        return row[0]
+
+    def _insert_messages(self, conn, recipient, message_packages):
+        seq = self._next_seq(conn, recipient)
+        with _SERIALIZE.time():
+            rows = [
+                (recipient, seq + i, message_package['timestamp'], encode_record(message_package))
+                for i, message_package in enumerate(message_packages)
+            ]
+        with _WRITE.time():
+            conn.executemany("INSERT INTO messages (recipient, seq, timestamp, data) VALUES (?, ?, ?, ?)", rows)
+
+    def append_messages(self, recipient, message_packages):
+        with self._transaction() as conn:
+            self._insert_messages(conn, recipient, message_packages)
+
+    def append_message_groups(self, groups):
+        # One transaction (and one WAL sync) for the whole batch
+        with self._transaction() as conn:
+            for recipient, message_packages in groups.items():
+                self._insert_messages(conn, recipient, message_packages)
+
+    def read_messages(self, recipient, since=0, limit=None):
+        conn = self._connection()
+        rows = conn.execute(
+            "SELECT seq, data FROM messages WHERE recipient = ? AND seq >= ? ORDER BY seq LIMIT ?",
+            (recipient, since, -1 if limit is None else limit)
+        ).fetchall()
+
+        if rows:
+            # Unreadable rows are skipped, as in the file backend, but the
+            # cursor still moves past them
+            return [message for _, message in _decoded_rows(rows)], rows[-1][0] + 1
+
+        # Nothing new: the cursor is the end of the inbox - not past it,
+        # and not before messages that have since been archived
+        return [], self._next_seq(conn, recipient)
+
+    def iter_messages(self, recipient, since=0):
+        # By the rows' own seq: read_messages may skip unreadable rows
+        yield from self._iter_table("messages", recipient, since)
+
+    def _iter_table(self, table, recipient, since=0):
+        while True:
+            rows = self._connection().execute(
+                f"SELECT seq, data FROM {table} WHERE recipient = ? AND seq >= ? ORDER BY seq LIMIT ?",
+                (recipient, since, ITER_PAGE_SIZE)
+            ).fetchall()
+            if not rows:
+                return
+            yield from _decoded_rows(rows)
+            since = rows[-1][0] + 1
+
+    def clear_messages(self, recipient):
+        with self._transaction() as conn:
+            for table in ("messages", "messages_archive", "conversation_keys", "read_cursors"):
+                conn.execute(f"DELETE FROM {table} WHERE recipient = ?", (recipient,))
+
+    def list_inboxes(self):
+        rows = self._connection().execute("SELECT DISTINCT recipient FROM messages ORDER BY recipient")
+        return [row[0] for row in rows]
+
+    # --- Retention ---
+
+    def get_read_cursor(self, recipient):
+        row = self._connection().execute(
+            "SELECT cursor FROM read_cursors WHERE recipient = ?", (recipient,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def set_read_cursor(self, recipient, cursor):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO read_cursors (recipient, cursor) VALUES (?, ?) "
+                "ON CONFLICT (recipient) DO UPDATE SET cursor = MAX(cursor, excluded.cursor)",
+                (recipient, cursor)
+            )
+
+    def compact_inbox(self, recipient, archive_before=0):
+        with self._transaction() as conn:
+            archived = conn.execute(
+                "INSERT OR REPLACE INTO messages_archive (recipient, seq, timestamp, data) "
+                "SELECT recipient, seq, timestamp, data FROM messages WHERE recipient = ? AND seq < ?",
+                (recipient, archive_before)
+            ).rowcount
+            conn.execute("DELETE FROM messages WHERE recipient = ? AND seq < ?", (recipient, archive_before))
+
+            # Rows still holding JSON text (written before envelopes) are re-encoded
+            rewritten = 0
+            rows = conn.execute(
+                "SELECT id, data FROM messages WHERE recipient = ? AND typeof(data) = 'text'", (recipient,)
+            ).fetchall()
+            for row_id, data in rows:
+                try:
+                    record = encode_record(decode_record(data))
+                except ValueError:
+                    continue
+                if isinstance(record, bytes) and record[:len(ENVELOPE_MAGIC)] == ENVELOPE_MAGIC:
+                    conn.execute("UPDATE messages SET data = ? WHERE id = ?", (record, row_id))
+                    rewritten += 1
+
+            kept = conn.execute("SELECT COUNT(*) FROM messages WHERE recipient = ?", (recipient,)).fetchone()[0]
+        return {'archived': archived, 'kept': kept, 'rewritten': bool(archived or rewritten)}
+
+    def iter_archived_messages(self, recipient):
+        yield from self._iter_table("messages_archive", recipient)
+
+    def save_conversation_key(self, recipient, key_id, from_user, encrypted_key):
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO conversation_keys (recipient, key_id, from_user, encrypted_key) "
+                "VALUES (?, ?, ?, ?)",
+                (recipient, key_id, from_user, encrypted_key)
+            )
+            return cursor.rowcount == 1
+
+    def load_conversation_keys(self, recipient):
+        rows = self._connection().execute(
+            "SELECT key_id, from_user, encrypted_key FROM conversation_keys WHERE recipient = ?",
+            (recipient,)
+        )
+        return {
+            key_id: {'from_user': from_user, 'encrypted_key': encrypted_key}
+            for key_id, from_user, encrypted_key in rows
+        }
+
+    def replace_inbox(self, recipient, records, archived=()):
+        """
+        Overwrite a recipient's inbox and archive (used by the importer).
+
+        Args:
+            records: (sequence number, message dict) pairs for the inbox
+            archived: The same for the archive
+        """
+        with self._transaction() as conn:
+            for table, rows in (("messages", records), ("messages_archive", archived)):
+                conn.execute(f"DELETE FROM {table} WHERE recipient = ?", (recipient,))
+                conn.executemany(
+                    f"INSERT INTO {table} (recipient, seq, timestamp, data) VALUES (?, ?, ?, ?)",
+                    [
+                        (recipient, seq, str(message.get('timestamp', '')), encode_record(message))
+                        for seq, message in rows
+                    ]
+                )
+
+
+# ============================================
+# BACKEND SELECTION
+# ============================================
+
+BACKENDS = {
+    FileBackend.name: FileBackend,
+    SQLiteBackend.name: SQLiteBackend,
+}
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Return the process-wide storage backend chosen by config.STORAGE_BACKEND"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                try:
+                    backend_class = BACKENDS[config.STORAGE_BACKEND]
+                except KeyError:
+                    raise ValueError(
+                        f"Unknown storage backend {config.STORAGE_BACKEND!r}; "
+                        f"choose one of: {', '.join(BACKENDS)}"
+                    )
+                _storage = backend_class()
+    return _storage
+
+
+def set_storage(backend):
+    """Replace the process-wide storage backend (tools and tests)"""
+    global _storage
+    _storage = backend
+
+
+# ============================================
+# IMPORT TOOL
+# ============================================
+
+def import_data_dir(source_dir, db_path):
+    """
+    Copy a file-backend data directory (Users/, Keys/, messages/) into
+    an SQLite database. The source directory is not modified; running
+    it again overwrites the imported users, keys and inboxes.
+
+    Args:
+        source_dir (str): Directory containing Users/, Keys/ and messages/
+        db_path (str): SQLite database to create or update
+
+    Returns:
+        dict: Counts of imported users, keys, inboxes and messages
+    """
+    source = FileBackend(
+        user_dir=os.path.join(source_dir, os.path.basename(config.USER_DIR)),
+        keys_dir=os.path.join(source_dir, os.path.basename(config.KEYS_DIR)),
+        message_dir=os.path.join(source_dir, os.path.basename(config.MESSAGE_DIR)),
+    )
+    target = SQLiteBackend(db_path)
+    target.setup()
+
+    counts = {'users': 0, 'keys': 0, 'inboxes': 0, 'messages': 0}
+
+    if os.path.isdir(source.user_dir):
+        for username in source.list_users():
+            target.save_user(username, source.load_user(username))
+            counts['users'] += 1
+
+            pem = source.load_private_key(username)
+            if pem is not None:
+                target.save_private_key(username, pem)
+                counts['keys'] += 1
+
+    if os.path.isdir(source.message_dir):
+        for recipient, records in source.iter_inboxes():
+            archived = list(source.iter_archived_messages(recipient))
+            target.replace_inbox(recipient, records, archived)
+            for key_id, key in source.load_conversation_keys(recipient).items():
+                target.save_conversation_key(recipient, key_id, key['from_user'], key['encrypted_key'])
+            read_cursor = source.get_read_cursor(recipient)
+            if read_cursor:
+                target.set_read_cursor(recipient, read_cursor)
+            counts['inboxes'] += 1
+            counts['messages'] += len(records) + len(archived)
+
+    return counts
@@ -0,0 +1,126 @@
+# test_envelope.py
+# E2E Encrypted Messenger - Tests for the binary message envelope
+#
+# Run with: python -m pytest
+
+import base64
+import json
+
+import pytest
+
+from envelope import (
+    MAGIC, MessageEnvelope, decode_record, encode_envelope, encode_record, is_envelope
+)
+
+
+def b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def package(**changes):
+    message = {
+        'from_user': 'alice',
+        'to_user': 'bob',
+        'encrypted_message': b64(b'\x00ciphertext\xff'),
+        'encrypted_key': b64(b'k' * 256),
+        'nonce': b64(b'n' * 12),
+        'timestamp': '2024-05-06T07:08:09.123456',
+    }
+    message.update(changes)
+    return message
+
+
+def test_round_trip():
+    data = encode_envelope(package())
+    assert is_envelope(data)
+    assert decode_record(data) == package()
+
+
+def test_round_trip_with_key_id():
+    message = package(key_id='0123456789abcdef0123456789abcdef')
+    del message['encrypted_key']
+    envelope = MessageEnvelope(encode_envelope(message))
+    assert envelope.encrypted_key is None
+    assert bytes(envelope.key_id) == bytes.fromhex(message['key_id'])
+    assert envelope.to_package() == message
+
+
+@pytest.mark.parametrize("timestamp", [
+    '2024-05-06T07:08:09',
+    '2024-05-06T07:08:09.123456',
+    '2024-05-06T07:08:09+02:00',
+    '1969-12-31T23:59:59.999999',
+])
+def test_timestamps_come_back_exactly(timestamp):
+    assert decode_record(encode_envelope(package(timestamp=timestamp)))['timestamp'] == timestamp
+
+
+def test_extra_fields_are_kept():
+    message = package(attachment={'name': 'a.txt'}, priority=2)
+    assert decode_record(encode_envelope(message)) == message
+
+
+def test_unicode_usernames():
+    message = package(from_user='zoë', to_user='日本')
+    assert decode_record(encode_envelope(message)) == message
+
+
+def test_fields_are_views_into_the_buffer():
+    buffer = bytearray(b'junk' + encode_envelope(package()))
+    envelope = MessageEnvelope(buffer, offset=4)
+    assert isinstance(envelope.ciphertext, memoryview)
+    assert bytes(envelope.ciphertext) == b'\x00ciphertext\xff'
+    assert envelope.size == len(buffer) - 4
+
+
+@pytest.mark.parametrize("changes", [
+    {'nonce': 'bm9uY2U'},           # missing padding: not canonical base64
+    {'encrypted_message': 'a b'},   # not base64 at all
+    {'encrypted_key': ''},
+    {'timestamp': 'yesterday'},
+    {'from_user': 'x' * 300},
+    {'key_id': 'abcd'},
+])
+def test_packages_an_envelope_cant_hold(changes):
+    message = package(**changes)
+    with pytest.raises(ValueError):
+        encode_envelope(message)
+    # encode_record falls back to JSON, which still round-trips
+    data = encode_record(message)
+    assert not is_envelope(data)
+    assert decode_record(data) == message
+
+
+def test_message_without_any_key_is_refused():
+    message = package()
+    del message['encrypted_key']
+    with pytest.raises(ValueError):
+        encode_envelope(message)
+
+
+def test_truncated_envelope():
+    data = encode_envelope(package())
+    for size in (len(MAGIC), 20, len(data) - 1):
+        with pytest.raises(ValueError):
+            MessageEnvelope(data[:size])
+
+
+def test_unknown_version():
+    data = bytearray(encode_envelope(package()))
+    data[4] = 99
+    with pytest.raises(ValueError):
+        MessageEnvelope(data)
+
+
+@pytest.mark.parametrize("record", [
+    json.dumps(package()),
+    json.dumps(package()).encode('utf-8'),
+    memoryview(json.dumps(package()).encode('utf-8')),
+    memoryview(encode_envelope(package())),
+])
+def test_decode_record_detects_the_format(record):
+    assert decode_record(record) == package()
+
+
+def test_envelope_is_smaller_than_json():
+    assert len(encode_envelope(package())) < len(json.dumps(package()))
@@ -0,0 +1,151 @@
+# test_group_commit.py
+# E2E Encrypted Messenger - Tests for group commit
+#
+# Run with: python -m pytest
+
+import threading
+import time
+
+import pytest
+
+from group_commit import GroupCommitter
+
+
+def submit_together(committer, count, recipient='bob'):
+    """Submit `count` single-message writes from as many threads at once"""
+    barrier = threading.Barrier(count)
+    errors = [None] * count
+
+    def submit(i):
+        barrier.wait()
+        try:
+            committer.submit(recipient, [i])
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def innermost_function(traceback):
+    while traceback.tb_next is not None:
+        traceback = traceback.tb_next
+    return traceback.tb_frame.f_code.co_name
+
+
+def slow_write(written, seconds=0.05):
+    """A write that takes about as long as an fsync might"""
+    def write(recipient, packages):
+        time.sleep(seconds)
+        written.append(list(packages))
+    return write
+
+
+def test_concurrent_writes_share_a_batch():
+    written = []
+    committer = GroupCommitter(slow_write(written), window_ms=200)
+
+    assert submit_together(committer, 8) == [None] * 8
+    assert sorted(sum(written, [])) == list(range(8))
+    assert len(written) < 8
+    assert committer.stats()['messages'] == 8
+
+
+def test_inboxes_are_batched_separately():
+    written = []
+    lock = threading.Lock()
+
+    def write(recipient, packages):
+        with lock:
+            written.append((recipient, list(packages)))
+
+    committer = GroupCommitter(write, window_ms=50)
+    threads = [threading.Thread(target=committer.submit, args=(name, [name])) for name in ('bob', 'carol')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(written) == [('bob', ['bob']), ('carol', ['carol'])]
+
+
+@pytest.mark.parametrize("linger", [True, False])
+def test_lone_writer_does_not_wait(linger):
+    written = []
+    committer = GroupCommitter(lambda recipient, packages: written.append(list(packages)), window_ms=10000)
+    started = time.monotonic()
+    for i in range(3):
+        committer.submit('bob', [i], linger=linger)
+    assert time.monotonic() - started < 1
+    assert written == [[0], [1], [2]]
+
+
+def test_writes_arriving_during_a_write_join_the_next_batch():
+    written = []
+    committer = GroupCommitter(slow_write(written, 0.2), window_ms=50)
+    first = threading.Thread(target=committer.submit, args=('bob', ['first']))
+    first.start()
+    while not committer.stats()['batches']:
+        time.sleep(0.001)
+    # The first batch is being written; these queue up behind it
+    assert submit_together(committer, 4) == [None] * 4
+    first.join()
+    assert written[0] == ['first']
+    assert sorted(written[1]) == [0, 1, 2, 3]
+
+
+def test_full_batch_is_written_straight_away():
+    written = []
+    committer = GroupCommitter(lambda recipient, packages: written.append(len(packages)), window_ms=10000,
+                               max_batch=3)
+    committer.submit('bob', [1, 2, 3])
+    assert written == [3]
+
+
+def test_every_caller_gets_its_own_error():
+    failure = OSError(28, 'No space left on device', 'bob.log')
+
+    def write(recipient, packages):
+        time.sleep(0.05)
+        raise failure
+
+    committer = GroupCommitter(write, window_ms=200)
+    errors = submit_together(committer, 6)
+
+    assert all(isinstance(e, OSError) for e in errors)
+    assert all(e.errno == 28 and e.filename == 'bob.log' for e in errors)
+    assert len({id(e) for e in errors}) == len(errors)
+    assert all(e.__cause__ is failure for e in errors)
+    # Each caller has its own traceback; the original still ends in the write
+    assert len({id(e.__traceback__) for e in errors}) == len(errors)
+    assert innermost_function(failure.__traceback__) == 'write'
+
+
+def test_error_that_cant_be_copied_is_still_raised():
+    class Odd(Exception):
+        def __init__(self, a, b):
+            super().__init__(a)
+
+    def write(recipient, packages):
+        raise Odd(1, 2)
+
+    with pytest.raises(Odd):
+        GroupCommitter(write, window_ms=0).submit('bob', [1])
+
+
+def test_failed_batch_does_not_block_the_next():
+    calls = []
+
+    def write(recipient, packages):
+        calls.append(list(packages))
+        if len(calls) == 1:
+            raise ValueError("first write fails")
+
+    committer = GroupCommitter(write, window_ms=0)
+    with pytest.raises(ValueError):
+        committer.submit('bob', [1])
+    committer.submit('bob', [2])
+    assert calls == [[1], [2]]
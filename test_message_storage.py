@@ -0,0 +1,71 @@
+# test_message_storage.py
+# E2E Encrypted Messenger - Tests for message_storage on top of the backends
+#
+# Run with: python -m pytest
+
+from datetime import datetime
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import config
+import message_storage
+from encryption import decrypt_message, encrypt_message
+from storage import FileBackend, SQLiteBackend, set_storage
+
+
+@pytest.fixture(scope="module")
+def private_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "file":
+        store = FileBackend(
+            user_dir=str(tmp_path / "Users"), keys_dir=str(tmp_path / "Keys"),
+            message_dir=str(tmp_path / "messages"), durability="none"
+        )
+    else:
+        store = SQLiteBackend(path=str(tmp_path / "messenger.db"), durability="none")
+    set_storage(store)
+    yield store
+    set_storage(None)
+
+
+def send(text, private_key):
+    public_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode('utf-8')
+    package = encrypt_message(text, public_pem, recipient='bob', sender='alice')
+    package.update(from_user='alice', to_user='bob', timestamp=datetime.now().isoformat())
+    message_storage.save_message(package)
+    return package
+
+
+def read_all(private_key):
+    return [decrypt_message(m, private_key) for m in message_storage.get_messages_for_user('bob')]
+
+
+# ============================================
+# CONVERSATION KEYS
+# ============================================
+
+@pytest.mark.parametrize("clear", ["here", "elsewhere"])
+def test_conversation_key_survives_a_cleared_inbox(backend, private_key, monkeypatch, clear):
+    monkeypatch.setattr(config, 'SESSION_KEYS_ENABLED', True)
+    first = send("before", private_key)
+    assert read_all(private_key) == ["before"]
+
+    if clear == "here":
+        message_storage.clear_messages_for_user('bob')
+    else:
+        # As manage.py or another serve.py worker would
+        backend.clear_messages('bob')
+    assert backend.load_conversation_keys('bob') == {}
+
+    second = send("after", private_key)
+    assert second['key_id'] == first['key_id']   # Still the same conversation key
+    assert read_all(private_key) == ["after"]
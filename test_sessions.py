@@ -0,0 +1,258 @@
+# test_sessions.py
+# E2E Encrypted Messenger - Tests for the session store
+#
+# Run with: python -m pytest
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import sessions
+from sessions import SessionStore, SQLiteSessionBackend, StreamTickets
+
+
+class Clock:
+    """Stands in for the time module in sessions.py"""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sessions, 'time', clock)
+    return clock
+
+
+@pytest.fixture(scope="module")
+def private_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def build(username, private_key, public_key):
+    return {'username': username, 'private_key': private_key, 'public_key': public_key}
+
+
+def memory_store(ended, **options):
+    options = {'idle_ttl': 60, 'absolute_ttl': 600, 'max_sessions': 0, 'sweep_interval': 0, **options}
+    return SessionStore(build=build, on_end=ended.append, **options)
+
+
+# ============================================
+# IN-MEMORY STORE
+# ============================================
+
+def test_add_get_remove(clock):
+    ended = []
+    store = memory_store(ended)
+    session = {'username': 'bob'}
+    store.add('t1', session)
+
+    assert store.get('t1') is session
+    assert store.get('other') is None
+    assert store.get(None) is None
+    assert store.remove('t1') is session
+    assert store.get('t1') is None
+    assert ended == [session]
+    assert store.remove('t1') is None
+
+
+def test_idle_ttl(clock):
+    ended = []
+    store = memory_store(ended)
+    store.add('t1', {'username': 'bob'})
+
+    clock.now += 50
+    assert store.get('t1') is not None   # Activity restarts the idle clock
+    clock.now += 50
+    assert store.get('t1') is not None
+    clock.now += 61
+    assert store.get('t1') is None
+    assert len(ended) == 1
+    assert store.stats()['expired'] == 1
+
+
+def test_absolute_ttl_despite_activity(clock):
+    store = memory_store([])
+    store.add('t1', {'username': 'bob'})
+    for _ in range(10):
+        clock.now += 59
+        assert store.get('t1') is not None
+    clock.now += 59
+    assert store.get('t1') is None
+
+
+def test_lru_cap_evicts_least_recently_used(clock):
+    ended = []
+    store = memory_store(ended, max_sessions=2)
+    store.add('a', {'username': 'a'})
+    store.add('b', {'username': 'b'})
+    store.get('a')                       # b is now the least recently used
+    store.add('c', {'username': 'c'})
+
+    assert store.get('b') is None
+    assert store.get('a') is not None and store.get('c') is not None
+    assert [s['username'] for s in ended] == ['b']
+    assert store.stats()['evicted'] == 1
+
+
+def test_replacing_a_token_ends_the_old_session(clock):
+    ended = []
+    store = memory_store(ended)
+    old, new = {'username': 'bob'}, {'username': 'bob'}
+    store.add('t1', old)
+    store.add('t1', new)
+    assert store.get('t1') is new
+    assert ended == [old]
+    assert len(store) == 1
+
+
+def test_sweep_drops_only_expired_sessions(clock):
+    ended = []
+    store = memory_store(ended)
+    store.add('old', {'username': 'old'})
+    clock.now += 40
+    store.add('new', {'username': 'new'})
+    clock.now += 30
+
+    assert store.sweep() == 1
+    assert [s['username'] for s in ended] == ['old']
+    assert store.get('new') is not None
+
+
+def test_sweep_by_absolute_age(clock):
+    store = memory_store([], idle_ttl=0)
+    store.add('first', {'username': 'first'})
+    clock.now += 300
+    store.add('second', {'username': 'second'})
+    store.get('first')                   # Recently used, but logged in long ago
+    clock.now += 301
+    assert store.sweep() == 1
+    assert store.get('first') is None and store.get('second') is not None
+
+
+def test_sweeper_thread_starts_and_stops():
+    store = SessionStore(build=build, idle_ttl=0.01, absolute_ttl=0, max_sessions=0, sweep_interval=0.01)
+    store.add('t1', {'username': 'bob'})
+    store.start()
+    try:
+        assert store.stats()['sweeping']
+        for _ in range(200):
+            if not len(store):
+                break
+            store._stop.wait(0.01)
+        assert len(store) == 0
+    finally:
+        store.stop(timeout=1)
+    assert not store.stats()['sweeping']
+
+
+# ============================================
+# SHARED (SQLITE) STORE
+# ============================================
+
+def shared_store(path, secret="secret", **options):
+    options = {'idle_ttl': 60, 'absolute_ttl': 600, 'max_sessions': 0, 'sweep_interval': 0, **options}
+    backend = SQLiteSessionBackend(path=str(path), secret=secret,
+                                   idle_ttl=options['idle_ttl'], absolute_ttl=options['absolute_ttl'])
+    return SessionStore(build=build, backend=backend, **options)
+
+
+def test_shared_store_needs_a_secret(tmp_path):
+    with pytest.raises(ValueError):
+        SQLiteSessionBackend(path=str(tmp_path / "sessions.db"), secret="")
+
+
+def test_sessions_are_shared_between_stores(tmp_path, clock, private_key):
+    # Two stores on one database stand in for two worker processes
+    first = shared_store(tmp_path / "sessions.db")
+    second = shared_store(tmp_path / "sessions.db")
+    first.add('t1', build('bob', private_key, 'PUBLIC KEY'))
+
+    session = second.get('t1')
+    assert session['username'] == 'bob'
+    assert session['public_key'] == 'PUBLIC KEY'
+    assert session['private_key'].private_numbers() == private_key.private_numbers()
+    assert second.get('t1') is session   # Loaded once, then served locally
+
+    second.remove('t1')
+    assert first.get('t1') is None
+
+
+def test_tokens_and_keys_are_not_stored_in_the_clear(tmp_path, clock, private_key):
+    store = shared_store(tmp_path / "sessions.db")
+    token = 'f' * 64
+    store.add(token, build('bob', private_key, 'PUBLIC KEY'))
+    data = b''.join(path.read_bytes() for path in tmp_path.glob("sessions.db*"))
+    assert token.encode() not in data
+    assert private_key.private_numbers().d.to_bytes(256, 'big')[:32] not in data
+
+
+def test_shared_expiry_counts_activity_in_any_store(tmp_path, clock, private_key):
+    first = shared_store(tmp_path / "sessions.db")
+    second = shared_store(tmp_path / "sessions.db")
+    first.add('t1', build('bob', private_key, 'PUBLIC KEY'))
+
+    clock.now += 50
+    assert second.get('t1') is not None
+    clock.now += 50
+    # Idle for 100s in `first`, but only 50s in the database
+    assert first.get('t1') is not None
+    clock.now += 61
+    assert first.get('t1') is None
+    assert second.get('t1') is None
+
+
+def test_wrong_secret_cannot_load_sessions(tmp_path, clock, private_key):
+    good = shared_store(tmp_path / "sessions.db")
+    good.add('t1', build('bob', private_key, 'PUBLIC KEY'))
+
+    assert shared_store(tmp_path / "sessions.db", secret="other").get('t1') is None
+    # ... and doesn't log anyone out by trying
+    assert shared_store(tmp_path / "sessions.db").get('t1') is not None
+
+
+def test_shared_cap_and_sweep(tmp_path, clock, private_key):
+    store = shared_store(tmp_path / "sessions.db", max_sessions=2)
+    for token in ('a', 'b', 'c'):
+        store.add(token, build(token, private_key, 'PUBLIC KEY'))
+        clock.now += 1
+    assert store.backend.count() == 2
+
+    clock.now += 100
+    store.sweep()
+    assert store.backend.count() == 0
+
+
+# ============================================
+# STREAM TICKETS
+# ============================================
+
+def test_stream_ticket_round_trip():
+    tickets = StreamTickets(secret="secret", ttl=60)
+    ticket = tickets.issue('session-token', now=1000)
+    assert 'session-token' not in ticket
+    assert tickets.redeem(ticket, now=1059) == 'session-token'
+    assert tickets.redeem(ticket, now=1061) is None
+
+
+def test_stream_tickets_are_shared_by_secret():
+    ticket = StreamTickets(secret="secret").issue('session-token')
+    assert StreamTickets(secret="secret").redeem(ticket) == 'session-token'
+    assert StreamTickets(secret="other").redeem(ticket) is None
+    assert StreamTickets(secret="").redeem(ticket) is None
+
+
+@pytest.mark.parametrize("ticket", [None, '', 'not a ticket', '!!!', 'A' * 40])
+def test_bad_stream_tickets(ticket):
+    assert StreamTickets(secret="secret").redeem(ticket) is None
+
+
+def test_tampered_stream_ticket():
+    tickets = StreamTickets(secret="secret")
+    ticket = tickets.issue('session-token')
+    tampered = ticket[:-2] + ('A' if ticket[-2] != 'A' else 'B') + ticket[-1]
+    assert tickets.redeem(tampered) is None
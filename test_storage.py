@@ -0,0 +1,310 @@
+# test_storage.py
+# E2E Encrypted Messenger - Tests for the storage backends
+#
+# Run with: python -m pytest
+
+import base64
+import json
+import os
+import sqlite3
+
+import pytest
+
+from envelope import encode_record
+from storage import (
+    FileBackend, SQLiteBackend, INBOX_LOG_FORMAT, _index_path, _shard
+)
+
+
+def package(i, to_user='bob', **extra):
+    """A message package with valid base64 fields (stored as an envelope)"""
+    message = {
+        'from_user': 'alice',
+        'to_user': to_user,
+        'encrypted_message': base64.b64encode(b'ciphertext %d' % i).decode('ascii'),
+        'encrypted_key': base64.b64encode(b'wrapped key').decode('ascii'),
+        'nonce': base64.b64encode(b'n' * 12).decode('ascii'),
+        'timestamp': '2024-01-01T00:00:%02d' % (i % 60),
+    }
+    message.update(extra)
+    return message
+
+
+def ciphertexts(messages):
+    return [base64.b64decode(m['encrypted_message']) for m in messages]
+
+
+def file_backend(root, layout="sharded", durability="none"):
+    return FileBackend(
+        user_dir=str(root / "Users"), keys_dir=str(root / "Keys"), message_dir=str(root / "messages"),
+        layout=layout, durability=durability
+    )
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "file":
+        store = file_backend(tmp_path)
+    else:
+        store = SQLiteBackend(path=str(tmp_path / "messenger.db"), durability="none")
+    store.setup()
+    return store
+
+
+# ============================================
+# BOTH BACKENDS
+# ============================================
+
+def test_append_and_read(backend):
+    backend.append_message('bob', package(0))
+    backend.append_messages('bob', [package(1), package(2)])
+
+    messages, cursor = backend.read_messages('bob')
+    assert cursor == 3
+    assert messages == [package(0), package(1), package(2)]
+    assert backend.list_inboxes() == ['bob']
+
+
+def test_read_empty_inbox(backend):
+    assert backend.read_messages('nobody') == ([], 0)
+
+
+def test_pages_follow_the_cursor(backend):
+    backend.append_messages('bob', [package(i) for i in range(10)])
+
+    pages, cursor = [], 0
+    while True:
+        messages, cursor = backend.read_messages('bob', cursor, 3)
+        if not messages:
+            break
+        pages.append(ciphertexts(messages))
+    assert [len(page) for page in pages] == [3, 3, 3, 1]
+    assert cursor == 10
+    assert sum(pages, []) == [b'ciphertext %d' % i for i in range(10)]
+
+
+def test_iter_messages_yields_sequence_numbers(backend):
+    backend.append_messages('bob', [package(i) for i in range(5)])
+    assert [seq for seq, _ in backend.iter_messages('bob', since=2)] == [2, 3, 4]
+
+
+def test_group_append(backend):
+    backend.append_message_groups({'bob': [package(0)], 'carol': [package(1, 'carol'), package(2, 'carol')]})
+    assert backend.read_messages('bob')[1] == 1
+    assert backend.read_messages('carol')[1] == 2
+
+
+def test_packages_that_dont_fit_an_envelope_round_trip(backend):
+    odd = package(0, encrypted_message='not base64!', note='kept')
+    backend.append_messages('bob', [odd, package(1)])
+    assert backend.read_messages('bob')[0] == [odd, package(1)]
+
+
+def test_compaction_keeps_sequence_numbers(backend):
+    backend.append_messages('bob', [package(i) for i in range(6)])
+
+    result = backend.compact_inbox('bob', archive_before=4)
+    assert result['archived'] == 4
+    assert result['kept'] == 2
+
+    messages, cursor = backend.read_messages('bob', 4)
+    assert ciphertexts(messages) == [b'ciphertext 4', b'ciphertext 5']
+    assert cursor == 6
+    # A cursor from before compaction resumes at the oldest kept message
+    assert ciphertexts(backend.read_messages('bob', 1)[0]) == [b'ciphertext 4', b'ciphertext 5']
+
+    archived = list(backend.iter_archived_messages('bob'))
+    assert [seq for seq, _ in archived] == [0, 1, 2, 3]
+    assert ciphertexts([m for _, m in archived]) == [b'ciphertext %d' % i for i in range(4)]
+
+
+def test_append_after_compaction_continues_numbering(backend):
+    backend.append_messages('bob', [package(i) for i in range(3)])
+    backend.compact_inbox('bob', archive_before=3)
+    backend.append_message('bob', package(3))
+
+    messages, cursor = backend.read_messages('bob', 3)
+    assert ciphertexts(messages) == [b'ciphertext 3']
+    assert cursor == 4
+
+    # And again: segments accumulate in order
+    backend.compact_inbox('bob', archive_before=4)
+    assert [seq for seq, _ in backend.iter_archived_messages('bob')] == [0, 1, 2, 3]
+    assert backend.read_messages('bob', 0) == ([], 4)
+
+
+def test_read_cursor_never_moves_back(backend):
+    assert backend.get_read_cursor('bob') == 0
+    backend.set_read_cursor('bob', 5)
+    backend.set_read_cursor('bob', 2)
+    assert backend.get_read_cursor('bob') == 5
+
+
+def test_first_conversation_key_wins(backend):
+    assert backend.save_conversation_key('bob', 'k1', 'alice', 'first')
+    assert not backend.save_conversation_key('bob', 'k1', 'mallory', 'second')
+    assert backend.load_conversation_keys('bob') == {'k1': {'from_user': 'alice', 'encrypted_key': 'first'}}
+
+
+def test_clear_messages(backend):
+    backend.append_messages('bob', [package(i) for i in range(3)])
+    backend.compact_inbox('bob', archive_before=1)
+    backend.clear_messages('bob')
+    assert backend.read_messages('bob') == ([], 0)
+    assert list(backend.iter_archived_messages('bob')) == []
+
+
+def test_durability_levels(backend):
+    for level in ("strict", "batched", "none"):
+        backend.set_durability(level)
+        backend.append_message('bob', package(0))
+        assert backend.durability_status()['level'] == level
+    with pytest.raises(ValueError):
+        backend.set_durability("sometimes")
+
+
+# ============================================
+# FILE BACKEND
+# ============================================
+
+def inbox_path(root, name, suffix=".log"):
+    return root / "messages" / os.path.join(*_shard(name)) / f"{name}{suffix}"
+
+
+def test_missing_or_stale_index_is_rebuilt(tmp_path):
+    store = file_backend(tmp_path)
+    store.setup()
+    store.append_messages('bob', [package(i) for i in range(20)])
+    index_file = _index_path(str(inbox_path(tmp_path, 'bob')))
+
+    os.remove(index_file)
+    assert ciphertexts(store.read_messages('bob', 15)[0]) == [b'ciphertext %d' % i for i in range(15, 20)]
+
+    # An index shorter than the log (crash before it was written)
+    store.append_messages('bob', [package(i) for i in range(20, 25)])
+    with open(index_file, 'r+b') as idx:
+        idx.truncate(8 * 3)
+    assert ciphertexts(store.read_messages('bob', 22)[0]) == [b'ciphertext 22', b'ciphertext 23', b'ciphertext 24']
+    store.append_message('bob', package(25))
+    assert store.read_messages('bob', 25)[1] == 26
+
+
+def test_torn_last_record_is_ignored_then_repaired(tmp_path):
+    store = file_backend(tmp_path)
+    store.setup()
+    store.append_messages('bob', [package(0), package(1)])
+    with open(inbox_path(tmp_path, 'bob'), 'ab') as f:
+        f.write(b'\x40\x00\x00\x00E2EM partial')
+
+    assert store.read_messages('bob') == ([package(0), package(1)], 2)
+    store.append_message('bob', package(2))
+    assert store.read_messages('bob') == ([package(0), package(1), package(2)], 3)
+
+
+def test_version_1_log_is_read_and_upgraded(tmp_path):
+    store = file_backend(tmp_path)
+    store.setup()
+    log_file = inbox_path(tmp_path, 'bob')
+    log_file.parent.mkdir(parents=True)
+    lines = [json.dumps({"format": INBOX_LOG_FORMAT, "version": 1})]
+    lines += [json.dumps(package(i)) for i in range(3)]
+    log_file.write_text("\n".join(lines) + "\n")
+
+    assert store.read_messages('bob', 1) == ([package(1), package(2)], 3)
+    store.append_message('bob', package(3))
+    with open(log_file, 'rb') as f:
+        assert json.loads(f.readline())['version'] == 2
+    assert store.read_messages('bob') == ([package(i) for i in range(4)], 4)
+
+
+def test_legacy_json_inbox_is_migrated(tmp_path):
+    store = file_backend(tmp_path, layout="flat")
+    store.setup()
+    (tmp_path / "messages" / "bob.json").write_text(json.dumps([package(0), package(1)]))
+
+    assert store.migrate_legacy_inboxes() == {'bob': 2}
+    assert not (tmp_path / "messages" / "bob.json").exists()
+    store.append_message('bob', package(2))
+    assert store.read_messages('bob') == ([package(0), package(1), package(2)], 3)
+
+
+def test_flat_to_sharded_migration(tmp_path):
+    flat = file_backend(tmp_path, layout="flat")
+    flat.setup()
+    flat.save_user('bob', {'username': 'bob'})
+    flat.save_private_key('bob', b'PEM')
+    flat.append_messages('bob', [package(i) for i in range(3)])
+    flat.compact_inbox('bob', archive_before=1)
+    flat.set_read_cursor('bob', 2)
+
+    sharded = file_backend(tmp_path, layout="sharded")
+    # Files still in the old layout are found before migrating
+    assert sharded.load_user('bob') == {'username': 'bob'}
+    assert sharded.read_messages('bob', 1)[1] == 3
+
+    counts = sharded.migrate_layout()
+    assert counts == {'users': 1, 'keys': 1, 'inboxes': 1, 'conflicts': 0}
+    assert inbox_path(tmp_path, 'bob').exists()
+    assert not (tmp_path / "messages" / "bob.log").exists()
+
+    assert sharded.load_private_key('bob') == b'PEM'
+    assert ciphertexts(sharded.read_messages('bob', 1)[0]) == [b'ciphertext 1', b'ciphertext 2']
+    assert [seq for seq, _ in sharded.iter_archived_messages('bob')] == [0]
+    assert sharded.get_read_cursor('bob') == 2
+    assert sharded.migrate_layout() == {'users': 0, 'keys': 0, 'inboxes': 0, 'conflicts': 0}
+
+
+def test_usernames_cannot_escape_their_directory(tmp_path):
+    store = file_backend(tmp_path)
+    store.setup()
+    for name in ('../bob', '.hidden', 'a/b', ''):
+        with pytest.raises(ValueError):
+            store.load_user(name)
+
+
+# ============================================
+# SQLITE BACKEND
+# ============================================
+
+def test_sqlite_reads_json_text_rows_next_to_envelopes(tmp_path):
+    store = SQLiteBackend(path=str(tmp_path / "messenger.db"), durability="none")
+    store.setup()
+    store.append_message('bob', package(0))
+    with sqlite3.connect(store.path) as conn:
+        conn.execute(
+            "INSERT INTO messages (recipient, seq, timestamp, data) VALUES ('bob', 1, ?, ?)",
+            (package(1)['timestamp'], json.dumps(package(1)))
+        )
+
+    assert store.read_messages('bob') == ([package(0), package(1)], 2)
+    store.compact_inbox('bob')
+    with sqlite3.connect(store.path) as conn:
+        kinds = [row[0] for row in conn.execute("SELECT typeof(data) FROM messages ORDER BY seq")]
+    assert kinds == ['blob', 'blob']
+    assert store.read_messages('bob') == ([package(0), package(1)], 2)
+
+
+def test_encode_record_matches_what_sqlite_stores(tmp_path):
+    store = SQLiteBackend(path=str(tmp_path / "messenger.db"), durability="none")
+    store.setup()
+    store.append_message('bob', package(0))
+    with sqlite3.connect(store.path) as conn:
+        (data,) = conn.execute("SELECT data FROM messages").fetchone()
+    assert data == encode_record(package(0))
+
+
+def test_sqlite_skips_unreadable_rows(tmp_path):
+    store = SQLiteBackend(path=str(tmp_path / "messenger.db"), durability="none")
+    store.setup()
+    store.append_messages('bob', [package(0), package(1)])
+    with sqlite3.connect(store.path) as conn:
+        conn.execute("UPDATE messages SET data = ? WHERE seq = 0", (b'\x00\xffnot a record',))
+    store.append_message('bob', package(2))
+
+    assert store.read_messages('bob') == ([package(1), package(2)], 3)
+    assert store.read_messages('bob', 0, 1) == ([], 1)   # The cursor still moves past it
+    assert [seq for seq, _ in store.iter_messages('bob')] == [1, 2]
+
+    store.compact_inbox('bob', archive_before=2)
+    assert [seq for seq, _ in store.iter_archived_messages('bob')] == [1]
+    assert store.read_messages('bob') == ([package(2)], 3)
@@ -0,0 +1,164 @@
+# user_directory.py
+# E2E Encrypted Messenger - In-Memory User Directory
+#
+# Login, signup and /api/users used to list the Users/ directory and
+# search the result on every request. The directory below is built
+# once, kept up to date by save_user, and only goes back to storage
+# when the backend reports that the set of users changed (another
+# process signed someone up).
+
+import bisect
+import threading
+import time
+
+import config
+from storage import get_storage
+
+
+class UserDirectory:
+    """
+    Index of registered users: username -> public metadata.
+
+    Only non-secret fields are kept (no password hashes).
+    """
+
+    def __init__(self, storage=None, poll_interval=None):
+        self._storage = storage
+        self.poll_interval = config.USER_INDEX_POLL_SECONDS if poll_interval is None else poll_interval
+        self._lock = threading.RLock()
+        self._users = {}
+        self._sorted = []
+        self._version = None
+        self._checked_at = None
+
+    @property
+    def storage(self):
+        return self._storage or get_storage()
+
+    # --- Building ---
+
+    @staticmethod
+    def _metadata(user_data):
+        return {'public_key': user_data.get('public_key')}
+
+    def refresh(self, force=False):
+        """
+        Re-sync with storage if the backend's users version changed.
+        Only users that are new since the last sync are loaded.
+        """
+        with self._lock:
+            version = self.storage.users_version()
+            self._checked_at = time.monotonic()
+            if not force and version is not None and version == self._version:
+                return
+
+            names = set(self.storage.list_users())
+            for username in list(self._users):
+                if username not in names:
+                    del self._users[username]
+            for username in names:
+                if username in self._users:
+                    continue
+                user_data = self.storage.load_user(username)
+                if user_data:
+                    self._users[username] = self._metadata(user_data)
+
+            self._sorted = sorted(self._users)
+            self._version = version
+
+    def _maybe_refresh(self, force_check=False):
+        """Check the backend version at most once per poll interval (or now, if forced)"""
+        checked_at = self._checked_at
+        if (
+            checked_at is None
+            or force_check
+            or time.monotonic() - checked_at >= self.poll_interval
+        ):
+            self.refresh()
+
+    def add(self, username, user_data):
+        """Record a user that was just saved by this process"""
+        with self._lock:
+            if username not in self._users:
+                bisect.insort(self._sorted, username)
+            self._users[username] = self._metadata(user_data)
+
+    # --- Lookups ---
+
+    def exists(self, username):
+        """O(1) existence check; a miss re-checks storage so new signups are never missed"""
+        self._maybe_refresh()
+        if username in self._users:
+            return True
+
+        self._maybe_refresh(force_check=True)
+        if username in self._users:
+            return True
+
+        # Directory mtimes are coarse, so a user created moments ago by
+        # another process may not have changed the version yet
+        try:
+            user_data = self.storage.load_user(username)
+        except ValueError:
+            return False
+        if not user_data:
+            return False
+        self.add(username, user_data)
+        return True
+
+    def get(self, username):
+        """Return a user's public metadata dict, or None"""
+        if not self.exists(username):
+            return None
+        return self._users.get(username)
+
+    def get_public_key(self, username):
+        """Return a user's public key (PEM string), or None"""
+        metadata = self.get(username)
+        return metadata.get('public_key') if metadata else None
+
+    def usernames(self):
+        """Return all usernames, sorted"""
+        self._maybe_refresh()
+        return list(self._sorted)
+
+    def search(self, prefix='', limit=None):
+        """Return sorted usernames starting with `prefix` (at most `limit` of them)"""
+        self._maybe_refresh()
+        names = self._sorted
+        results = []
+        start = bisect.bisect_left(names, prefix)
+        for i in range(start, len(names)):
+            username = names[i]
+            if not username.startswith(prefix):
+                break
+            results.append(username)
+            if limit is not None and len(results) >= limit:
+                break
+        return results
+
+    def __len__(self):
+        self._maybe_refresh()
+        return len(self._users)
+
+
+_directory = None
+_directory_lock = threading.Lock()
+
+
+def get_user_directory():
+    """Return the process-wide user directory (built on first use)"""
+    global _directory
+    if _directory is None:
+        with _directory_lock:
+            if _directory is None:
+                directory = UserDirectory()
+                directory.refresh(force=True)
+                _directory = directory
+    return _directory
+
+
+def reset_user_directory():
+    """Drop the process-wide directory; the next get_user_directory() rebuilds it"""
+    global _directory
+    _directory = None